@@ -0,0 +1,56 @@
+"""Measure the Bloom filter of discovered objects on a synthetic database:
+build time, size, false positive rate, and duration of membership tests.
+
+Usage, from the repository root:
+
+    python -m bench.bench_bloom [--records N]
+
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import bloom
+import pobject
+from bench import synthetic
+
+
+def per_test(func:callable, keys:[str], repeat:int=3) -> float:
+    """Return the best duration, in microseconds, of func for one key"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(keys)
+        best = min(best, time.perf_counter() - start)
+    return best / len(keys) * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=1000000)
+    parser.add_argument('--tests', type=int, default=200000,
+                        help='number of absent objects tested')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='pioneers-bench-') as directory:
+        database = os.path.join(directory, 'database.cfg')
+        filename = os.path.join(directory, 'objects.bloom')
+        synthetic.write_database(database, args.records)
+        start = time.perf_counter()
+        count = bloom.rebuild(database, filename)
+        print('{} objects, built in {:.2f}s, filter of {:.2f} MB'.format(
+            count, time.perf_counter() - start, os.path.getsize(filename) / 1e6))
+        present = [record.locname for record, _ in zip(pobject.parse_file(database), range(args.tests))]
+        # other seeds and dates: other objects
+        absent = [record.locname for record in pobject.parse(''.join(
+            synthetic.records(args.tests, seed=args.records + 1, first_index=args.records)))]
+        absent = list(set(absent) - set(present))
+        with bloom.BloomFilter.load(filename) as loaded:
+            assert all(loaded.contains_many(present)), "false negative"
+            positives = sum(loaded.contains_many(absent))
+            print('false positive rate: {:.3%}'.format(positives / len(absent)))
+            print('test, one by one: {:.3f} µs'.format(
+                per_test(lambda keys: [key in loaded for key in keys], absent)))
+            print('test, by batch:   {:.3f} µs{}'.format(
+                per_test(loaded.contains_many, absent),
+                '' if bloom.numpy else ' (without NumPy)'))
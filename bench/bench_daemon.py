@@ -0,0 +1,107 @@
+"""Latency of commands run cold, by pioneers.py, and warm, by the daemon.
+
+A synthetic database is pushed to a local bare repository, and a fake
+SpaceEngine directory is initialized from it. Each command is first run
+cold, in a new process, then sent to a daemon serving this directory:
+through daemonclient.py, in a new process, and through a connection
+kept open, as gui.py does.
+
+Usage, from the repository root:
+
+    python -m bench.bench_daemon [--records 100000] [--repeat 5]
+
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import pobject
+import daemonclient
+from bench import bench_pipeline
+from constants import LOCAL_GIT_DB, DAEMON_SOCKET
+
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TIMEOUT = 120.  # seconds
+
+
+def script(name:str, *args:str) -> [str]:
+    return [sys.executable, os.path.join(REPOSITORY, name)] + list(args)
+
+
+def best_run(command:[str], cwd:str, repeat:int) -> float:
+    """Return the best duration, in seconds, of given command"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def best_call(client:daemonclient.DaemonClient, command:str, params:dict, repeat:int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        client.call(command, **params)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def commands(spaceengine:str) -> [(str, [str], [str], str, dict)]:
+    """Return label, cold command, client arguments, and daemon
+    command and parameters of each measured command"""
+    record = next(pobject.parse_file(os.path.join(spaceengine, LOCAL_GIT_DB)))
+    sector = record.locname.rsplit('-', 3)[0]
+    return [
+        ('query object', script('pioneers.py', 'query', record.locname),
+         ['query', record.locname], 'query', {'object': record.locname}),
+        ('query sector', script('pioneers.py', 'query', '--sector', sector),
+         ['query', '--sector', sector], 'query', {'sector': sector}),
+        ('sync', [sys.executable, '-c', 'import gitctl; gitctl.synchronize()'],
+         ['sync'], 'sync', {}),
+        ('publish', script('pioneers.py'), ['publish'], 'publish', {}),
+    ]
+
+
+def start_daemon(spaceengine:str) -> subprocess.Popen:
+    daemon = subprocess.Popen(script('daemon.py'), cwd=spaceengine,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    socket_path = os.path.join(spaceengine, DAEMON_SOCKET)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not daemonclient.running(socket_path):
+        if daemon.poll() is not None or time.monotonic() > deadline:
+            raise RuntimeError("daemon did not start")
+        time.sleep(.05)
+    return daemon
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    os.environ.update(bench_pipeline.GIT_IDENTITY, PYTHONPATH=REPOSITORY)  # for the -c commands
+    with tempfile.TemporaryDirectory(prefix='pioneers-bench-') as directory:
+        remote, spaceengine = bench_pipeline.make_environment(directory, args.records)
+        best_run(script('pioneers.py', '--remote', remote), spaceengine, 1)  # initialization
+        measured = commands(spaceengine)
+        cold = [best_run(command, spaceengine, args.repeat) for _, command, *_ in measured]
+        daemon = start_daemon(spaceengine)
+        try:
+            thin = [best_run(script('daemonclient.py', *client_args), spaceengine, args.repeat)
+                    for _, _, client_args, *_ in measured]
+            with daemonclient.DaemonClient(os.path.join(spaceengine, DAEMON_SOCKET)) as client:
+                warm = [best_call(client, command, params, args.repeat)
+                        for *_, command, params in measured]
+                client.call('stop')
+        finally:
+            daemon.wait()
+        print('{} records, best of {}'.format(args.records, args.repeat))
+        print('{:<14} {:>10} {:>14} {:>12}'.format('command', 'cold', 'thin client', 'warm call'))
+        for (label, *_), *durations in zip(measured, cold, thin, warm):
+            print('{:<14} {:>9.0f}ms {:>13.1f}ms {:>11.1f}ms'.format(label, *(d * 1000 for d in durations)))
@@ -0,0 +1,130 @@
+"""Throughput of a Pioneers hub receiving discoveries from concurrent clients.
+
+A hub is started on localhost, on a clone of a synthetic database pushed
+to a local bare repository. For each number of clients, as many threads
+send their own discoveries, each through a HubClient keeping its
+connection alive. The last half of the records of each client is also
+sent by the next client, so deduplication is exercised. The duration of the
+final commit of all accepted records is then measured.
+
+Usage, from the repository root:
+
+    python -m bench.bench_hub [--clients 1 4 16 64] [--requests 50] [--records 10]
+
+"""
+
+import io
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+import hub
+import gitctl
+import hubclient
+from bench import synthetic
+from bench.bench_pipeline import make_environment, GIT_IDENTITY
+from constants import LOCAL_GIT_DIR
+
+
+class RunningHub:
+    """A hub served by a thread, as long as the context is open"""
+
+    def __init__(self, interval:float):
+        self.hub = hub.Hub(interval)
+        self.ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        def started(server):
+            self.loop = asyncio.get_running_loop()
+            self.task = asyncio.current_task()
+            self.port = server.sockets[0].getsockname()[1]
+            self.ready.set()
+        try:
+            asyncio.run(self.hub.serve('localhost', 0, started=started))
+        except asyncio.CancelledError:
+            pass
+
+    def flush(self):
+        asyncio.run_coroutine_threadsafe(self.hub.flush(), self.loop).result()
+
+    def __enter__(self):
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def __exit__(self, *_):
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join()
+
+
+def send(url:str, requests:[str], answers:list):
+    with hubclient.HubClient(url, pool_size=1) as client:
+        for discoveries in requests:
+            answers.append(client.submit(discoveries))
+
+
+def run_clients(url:str, clients:int, requests:int, records:int, offset:int) -> (float, int, int):
+    """Return duration, records accepted and duplicates found when given
+    number of clients send their requests at the same time"""
+    sent = []
+    for client in range(clients):
+        # second half of the records is the first half of the next client
+        index = offset + client * requests * records // 2
+        data = list(synthetic.records(requests * records, seed=index, first_index=index))
+        shared = list(synthetic.records(requests * records // 2, seed=index + requests * records // 2,
+                                        first_index=index + requests * records // 2))
+        data[len(data) // 2:] = shared
+        sent.append([''.join(data[start:start+records]) for start in range(0, len(data), records)])
+    answers = []
+    threads = [threading.Thread(target=send, args=(url, requests, answers)) for requests in sent]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    return (duration, sum(answer['accepted'] for answer in answers),
+            sum(answer['duplicates'] for answer in answers))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16, 64],
+                        help='numbers of concurrent clients')
+    parser.add_argument('--requests', type=int, default=50, help='requests sent by each client')
+    parser.add_argument('--records', type=int, default=10, help='records in each request')
+    parser.add_argument('--database', type=int, default=10000, help='records in the database')
+    args = parser.parse_args()
+    for key, value in GIT_IDENTITY.items():
+        os.environ.setdefault(key, value)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='pioneers-bench-') as directory:
+        remote, _ = make_environment(directory, args.database)
+        os.chdir(directory)
+        try:
+            gitctl.clone_repository(remote, target=LOCAL_GIT_DIR, shallow=True)
+            with contextlib.redirect_stdout(io.StringIO()), RunningHub(interval=3600) as running:
+                url = 'http://localhost:{}'.format(running.port)
+                results, offset = [], args.database
+                for clients in args.clients:
+                    duration, accepted, duplicates = run_clients(url, clients, args.requests,
+                                                                 args.records, offset)
+                    offset += (clients + 1) * args.requests * args.records
+                    start = time.perf_counter()
+                    running.flush()
+                    results.append((clients, duration, accepted, duplicates,
+                                    time.perf_counter() - start))
+        finally:
+            os.chdir(cwd)
+    print('{:>8} {:>12} {:>12} {:>10} {:>11} {:>10}'.format(
+        'clients', 'requests/s', 'records/s', 'accepted', 'duplicates', 'commit s'))
+    for clients, duration, accepted, duplicates, commit in results:
+        requests = clients * args.requests
+        print('{:>8} {:>12.0f} {:>12.0f} {:>10} {:>11} {:>10.3f}'.format(
+            clients, requests / duration, requests * args.records / duration,
+            accepted, duplicates, commit))
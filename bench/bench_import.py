@@ -0,0 +1,47 @@
+"""Measure the import of external database files, with 1 to N workers:
+duration, throughput, and speedup against a single process.
+
+Usage, from the repository root:
+
+    python -m bench.bench_import [--records N] [--workers 1 2 4 8]
+
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import importer
+from bench import synthetic
+
+
+def best_duration(filenames:[str], workers:int, chunk_size:int, repeat:int=3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        importer.read_records(filenames, workers, chunk_size)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=200000,
+                        help='records in each file to import')
+    parser.add_argument('--files', type=int, default=2)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--chunk-size', type=int, default=1 << 20)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='pioneers-bench-') as directory:
+        filenames = []
+        for index in range(args.files):
+            filenames.append(os.path.join(directory, 'user-eng-db-{}.cfg'.format(index)))
+            synthetic.write_database(filenames[-1], args.records, seed=index * args.records)
+        size = sum(map(os.path.getsize, filenames)) / 1e6
+        print('{} files, {:.1f} MB, {} cores'.format(args.files, size, os.cpu_count()))
+        reference = None
+        for workers in args.workers:
+            duration = best_duration(filenames, workers, args.chunk_size)
+            reference = reference or duration
+            print('{:>2} workers: {:6.2f}s  {:6.1f} MB/s  speedup {:.2f}'.format(
+                workers, duration, size / duration, reference / duration))
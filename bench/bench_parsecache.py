@@ -0,0 +1,45 @@
+"""Measure the parse cache on a synthetic database: duration of a parse
+of the file, of the storage of its records, and of the loading of the
+objects and of all the records from the cache.
+
+Usage, from the repository root:
+
+    python -m bench.bench_parsecache [--records 100000 1000000]
+
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import pobject
+import parsecache
+from bench import synthetic
+
+
+def timed(func:callable):
+    """Return the result of func, and its duration in milliseconds"""
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, nargs='+', default=[100000, 1000000])
+    args = parser.parse_args()
+    print('{:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'records', 'parse', 'store', 'objects', 'records', 'entry'))
+    for count in args.records:
+        with tempfile.TemporaryDirectory(prefix='pioneers-bench-') as directory:
+            database = os.path.join(directory, 'database.cfg')
+            cache_dir = os.path.join(directory, 'cache')
+            synthetic.write_database(database, count)
+            expected, parse = timed(lambda: list(pobject.parse_file(database)))
+            _, store = timed(lambda: parsecache.load(database, cache_dir))
+            keys, objects = timed(lambda: parsecache.load(database, cache_dir).keys())
+            records, load = timed(lambda: list(parsecache.load(database, cache_dir).records()))
+            assert records == expected and len(keys) == count
+            entry = os.path.join(cache_dir, parsecache.file_blob(database, cache_dir) + parsecache.SUFFIX)
+            print('{:>9} {:>7.0f}ms {:>7.0f}ms {:>7.0f}ms {:>7.0f}ms {:>7.1f}MB'.format(
+                count, parse, store, objects, load, os.path.getsize(entry) / 1e6))
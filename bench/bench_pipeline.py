@@ -0,0 +1,171 @@
+"""Time and memory of each stage of the Pioneers pipeline.
+
+For each database size, a synthetic database is pushed to a local bare
+repository acting as the remote, and a fake SpaceEngine directory is
+initialized from it. A session of discoveries is then appended to the
+used database, and integrated as pioneers.py would do.
+
+The pipeline runs twice: once to measure durations, once under tracemalloc
+to measure the peak of memory allocated by Python (git processes are
+not included). Results are compared to the stored baselines: a stage
+is a regression when it is slower or larger than its baseline by
+more than the threshold.
+
+Usage, from the repository root:
+
+    python -m bench.bench_pipeline [--records 1000 100000] [--session 100] [--save]
+
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import routines
+from bench import synthetic
+from constants import DATABASE_FILE, DATABASE_FILENAME, CHECKPOINT_FILE
+
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+TIME_THRESHOLD = 1.5  # ratio to the baseline
+MEMORY_THRESHOLD = 1.3
+TIME_NOISE = 0.05  # seconds: smaller differences are not regressions
+MEMORY_NOISE = 1 << 20  # bytes
+GIT_IDENTITY = {
+    'GIT_AUTHOR_NAME': 'pioneers-bench', 'GIT_AUTHOR_EMAIL': 'bench@pioneers',
+    'GIT_COMMITTER_NAME': 'pioneers-bench', 'GIT_COMMITTER_EMAIL': 'bench@pioneers',
+}
+
+
+def git(*args:str, cwd:str=None):
+    subprocess.run(('git',) + args, cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_environment(directory:str, records:int) -> (str, str):
+    """Create in directory a remote holding a database of given size,
+    and a SpaceEngine install directory. Return their paths."""
+    remote = os.path.join(directory, 'remote.git')
+    seed = os.path.join(directory, 'seed')
+    git('init', '--bare', remote)
+    git('clone', remote, seed)
+    synthetic.write_database(os.path.join(seed, DATABASE_FILENAME), records)
+    git('add', DATABASE_FILENAME, cwd=seed)
+    git('commit', '-m', 'Synthetic database', cwd=seed)
+    git('push', 'origin', 'HEAD', cwd=seed)
+    shutil.rmtree(seed)
+    spaceengine = os.path.join(directory, 'SpaceEngine')
+    for subdir in ('config', 'data', 'system', 'docs'):
+        os.makedirs(os.path.join(spaceengine, subdir))
+    return remote, spaceengine
+
+
+def timed(func:callable) -> (float, object):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def traced(func:callable) -> (int, object):
+    tracemalloc.start()
+    try:
+        result = func()
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+
+def run_pipeline(records:int, session:int, measure:callable) -> {str: float}:
+    """Return the measure of each stage of the pipeline"""
+    results = {}
+    def stage(name:str, func:callable):
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name], result = measure(func)
+        return result
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='pioneers-bench-') as directory:
+        remote, spaceengine = make_environment(directory, records)
+        os.chdir(spaceengine)
+        try:
+            stage('initialize', lambda: routines.initialize(remote))
+            with open(DATABASE_FILE, 'a') as fd:
+                fd.write(synthetic.session(session, records))
+            discoveries = stage('user_discoveries', lambda: ''.join(routines.user_discoveries()))
+            assert discoveries, "no discoveries found"
+            os.rename(CHECKPOINT_FILE, CHECKPOINT_FILE + '.bak')
+            stage('user_discoveries (full diff)', lambda: ''.join(routines.user_discoveries()))
+            os.rename(CHECKPOINT_FILE + '.bak', CHECKPOINT_FILE)
+            stage('commit_message_from_addendum',
+                  lambda: routines.commit_message_from_addendum(discoveries))
+            commited = stage('integrate_discoveries_to_pioneers',
+                             lambda: routines.integrate_discoveries_to_pioneers([discoveries]))
+            assert commited, "discoveries not commited"
+            stage('detect_spaceengine_pid', routines.detect_spaceengine_pid)
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def compare(measures:dict, baselines:dict) -> [str]:
+    """Return the description of each regression found in measures"""
+    regressions = []
+    for key, measure in sorted(measures.items()):
+        baseline = baselines.get(key)
+        if not baseline:
+            continue
+        for field, threshold, noise in (('seconds', TIME_THRESHOLD, TIME_NOISE),
+                                        ('peak_bytes', MEMORY_THRESHOLD, MEMORY_NOISE)):
+            value, reference = measure[field], baseline[field]
+            if value > reference * threshold and value - reference > noise:
+                regressions.append('{} {}: {:.3g} against {:.3g}'.format(key, field, value, reference))
+    return regressions
+
+
+def load_baselines(filename:str=BASELINES_FILE) -> dict:
+    try:
+        with open(filename) as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='sizes of the databases')
+    parser.add_argument('--session', type=int, default=100,
+                        help='number of discoveries made during the session')
+    parser.add_argument('--baselines', type=str, default=BASELINES_FILE)
+    parser.add_argument('--save', action='store_true', default=False,
+                        help='store the measures as new baselines')
+    args = parser.parse_args()
+    for key, value in GIT_IDENTITY.items():  # commits must work on any box
+        os.environ.setdefault(key, value)
+
+    measures = {}
+    print('{:<36} {:>10} {:>12} {:>12}'.format('stage', 'records', 'seconds', 'peak KiB'))
+    for records in args.records:
+        durations = run_pipeline(records, args.session, timed)
+        peaks = run_pipeline(records, args.session, traced)
+        for stage in durations:
+            key = '{}@{}'.format(stage, records)
+            measures[key] = {'seconds': durations[stage], 'peak_bytes': peaks[stage]}
+            print('{:<36} {:>10} {:>12.4f} {:>12}'.format(stage, records, durations[stage],
+                                                           peaks[stage] // 1024))
+    baselines = load_baselines(args.baselines)
+    if args.save:
+        baselines.update(measures)
+        with open(args.baselines, 'w') as fd:
+            json.dump(baselines, fd, indent=1, sort_keys=True)
+        print('Baselines saved in {}'.format(args.baselines))
+    regressions = compare(measures, baselines)
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    sys.exit(1 if regressions else 0)
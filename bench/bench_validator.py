@@ -0,0 +1,34 @@
+"""Measure the throughput of the validator on a synthetic database.
+
+Usage, from the repository root:
+
+    python -m bench.bench_validator [--records N]
+
+"""
+
+import time
+import argparse
+import pobject
+import validator
+from bench import synthetic
+
+
+def throughput(func:callable, data:bytes, repeat:int=3) -> float:
+    """Return the best throughput, in MB/s, of func applied on data"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        best = min(best, time.perf_counter() - start)
+    return len(data) / best / 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+    data = synthetic.database(args.records)
+    print('{} records, {:.1f} MB'.format(args.records, len(data) / 1e6))
+    unlimited = dict(max_records=None, max_bytes=None)
+    print('validation: {:.1f} MB/s'.format(throughput(lambda d: validator.validate(d, **unlimited), data)))
+    print('parsing:    {:.1f} MB/s'.format(throughput(lambda d: sum(1 for _ in pobject.parse(d)), data)))
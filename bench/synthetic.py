@@ -0,0 +1,76 @@
+"""Generation of synthetic Pioneers databases, for benchmarks.
+
+Records look like the ones written by SpaceEngine: RS codes in a few
+galaxies, a small population of pioneers, increasing dates.
+Databases of any size can be written, since records are generated
+by chunks.
+
+"""
+
+import random
+
+
+PIONEERS = ('lucas', 'aluriak', 'vega', 'kepler', 'tycho', 'halley', 'messier', 'herschel')
+GALAXIES = ('0-4-1388-500', '0-3-397-1581', '0-5-2016-42', '1-2-77-9')
+WORDS = ('blue', 'giant', 'ocean', 'ice', 'ring', 'storm', 'desert', 'moon',
+         'binary', 'nebula', 'frozen', 'volcanic', 'tidally', 'locked', 'world')
+RECORD_TEMPLATE = '''PObject
+{{
+\tLocName "{locname}"
+\tName    "{name}"
+\tPioneer "{pioneer}"
+\tDate    "{date}"
+\tDescr   "{descr}"
+}}
+'''
+
+
+def locname(rand:random.Random) -> str:
+    """Return the RS code of a star: galaxy, sector, octree level and block, star"""
+    level = rand.randrange(4, 9)
+    return 'RS {}-{}-{}-{}-{}'.format(rand.choice(GALAXIES), rand.randrange(1 << 24), level,
+                                      rand.randrange(8 ** level), rand.randrange(200))
+
+
+def date(index:int) -> str:
+    """Return the date of the index-th discovery, one each 7 minutes from 2017"""
+    minutes = index * 7
+    day = minutes // (24 * 60)
+    year, day = 2017 + day // 360, day % 360
+    return '{}.{:02}.{:02} {:02}:{:02}:{:02}.00'.format(year, day // 30 + 1, day % 30 + 1,
+                                                        minutes // 60 % 24, minutes % 60,
+                                                        index % 60)
+
+
+def records(count:int, seed:int=0, first_index:int=0) -> [str]:
+    """Yield count records in database format"""
+    rand = random.Random(seed)
+    for index in range(first_index, first_index + count):
+        code = locname(rand)
+        yield RECORD_TEMPLATE.format(
+            locname=code,
+            name=code if rand.random() < .7 else rand.choice(WORDS).title() + ' ' + str(index),
+            pioneer=rand.choice(PIONEERS),
+            date=date(index),
+            descr=' '.join(rand.choice(WORDS) for _ in range(rand.randrange(20))),
+        )
+
+
+def database(count:int, seed:int=0) -> bytes:
+    """Return a database of count records, most recent first as in Pioneers"""
+    return ''.join(reversed(list(records(count, seed)))).encode()
+
+
+def write_database(filename:str, count:int, seed:int=0, chunk:int=10000):
+    """Write a database of count records in given file, most recent first,
+    without holding it in memory"""
+    with open(filename, 'w') as fd:
+        for start in reversed(range(0, count, chunk)):
+            fd.write(''.join(reversed(list(records(min(chunk, count - start), seed + start, start)))))
+
+
+def session(count:int, database_count:int, seed:int=1) -> str:
+    """Return the records appended by SpaceEngine during a session,
+    following a database of database_count records. As SpaceEngine
+    does, the most recent records are the last ones."""
+    return ''.join(records(count, seed, first_index=database_count))
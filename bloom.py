@@ -0,0 +1,302 @@
+"""Bloom filter of the objects of the git database.
+
+It tells, without reading the database, whether an object is maybe
+discovered already, or certainly not. Discoveries of objects already
+in the database, by someone else or by the explorer themselves, can thus
+be dropped before being commited: the first record wins anyway, and the
+database stays small.
+Only the hits are checked against the database, through its index
+(see dbindex.py) when it is up to date.
+
+The filter is register-blocked: each object sets some bits of a single
+64-bits word, so a test reads only one word. Objects are hashed with
+CRC32, mixed by a multiplication, giving the word and the mask of bits
+(one among 2^MASK_BITS precomputed masks). With BLOOM_BITS_PER_KEY bits
+per object, the false positive rate is about 0.5%.
+
+The filter is stored in a file, read with mmap: a header, then the words.
+As the index of the database (see dbindex.py), it is updated after each
+synchronization, and only the records added on top of the database
+are added to the filter. Any other modification leads to a rebuild.
+
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import sqlite3
+import deploy
+import dbindex
+import pobject
+import parsecache
+from array import array
+from dbindex import _hash_range
+from constants import LOCAL_GIT_DB, BLOOM_FILE, BLOOM_BITS_PER_KEY, BLOOM_HASHES
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAGIC = b'PBLM'
+FORMAT = 1
+# magic, format, hashes, words, objects, size and sha1 of the database
+HEADER = struct.Struct('<4sHHQQQ20s')
+WORD = struct.Struct('<Q')
+MASK_BITS = 12
+MULTIPLIER = 0x9E3779B97F4A7C15  # golden ratio, spreading the bits of the hash
+UINT64 = 0xFFFFFFFFFFFFFFFF
+MIN_WORDS = 64
+
+_masks = {}  # hashes -> masks
+
+
+def masks(hashes:int) -> [int]:
+    """Return the masks of hashes bits among 64 (splitmix64 sequence)"""
+    if hashes not in _masks:
+        table, state = [], 0
+        for _ in range(1 << MASK_BITS):
+            mask = 0
+            while bin(mask).count('1') < hashes:
+                state = (state + MULTIPLIER) & UINT64
+                value = ((state ^ (state >> 30)) * 0xBF58476D1CE4E5B9) & UINT64
+                value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & UINT64
+                mask |= 1 << ((value ^ (value >> 31)) & 63)
+            table.append(mask)
+        _masks[hashes] = table
+    return _masks[hashes]
+
+
+def key_hash(key:str) -> int:
+    return zlib.crc32(key.encode(pobject.ENCODING))
+
+
+class BloomFilter:
+    """Set of objects, with false positives.
+
+    words -- bytes-like object holding the filter (bytearray, or mmap)
+
+    """
+
+    def __init__(self, words, hashes:int=BLOOM_HASHES, count:int=0,
+                 database_size:int=0, database_sha1:bytes=bytes(20)):
+        self.words = words
+        self.nb_words = len(words) // WORD.size
+        self.hashes = hashes
+        self.masks = masks(hashes)
+        self.numpy_masks = numpy.array(self.masks, dtype=numpy.uint64) if numpy else None
+        self.count = count
+        self.database_size = database_size
+        self.database_sha1 = database_sha1
+        self._mmap = None
+
+    @staticmethod
+    def for_capacity(capacity:int, hashes:int=BLOOM_HASHES,
+                     bits_per_key:int=BLOOM_BITS_PER_KEY) -> 'BloomFilter':
+        """Return an empty filter able to hold capacity objects"""
+        nb_words = max(MIN_WORDS, -(-capacity * bits_per_key // 64))
+        return BloomFilter(bytearray(nb_words * WORD.size), hashes)
+
+    @property
+    def capacity(self) -> int:
+        return self.nb_words * 64 // BLOOM_BITS_PER_KEY
+
+    def _position(self, hashed:int) -> (int, int):
+        """Return offset of the word and mask of given hash"""
+        mixed = (hashed * MULTIPLIER) & UINT64
+        return ((mixed >> MASK_BITS) % self.nb_words) * WORD.size, self.masks[mixed & ((1 << MASK_BITS) - 1)]
+
+    def add(self, key:str):
+        self.add_hashes((key_hash(key),))
+
+    def add_hashes(self, hashes:[int]):
+        words = self.words
+        for hashed in hashes:
+            offset, mask = self._position(hashed)
+            WORD.pack_into(words, offset, WORD.unpack_from(words, offset)[0] | mask)
+            self.count += 1
+
+    def __contains__(self, key:str) -> bool:
+        mixed = (zlib.crc32(key.encode(pobject.ENCODING)) * MULTIPLIER) & UINT64
+        mask = self.masks[mixed & ((1 << MASK_BITS) - 1)]
+        return WORD.unpack_from(self.words, ((mixed >> MASK_BITS) % self.nb_words) << 3)[0] & mask == mask
+
+    def contains_many(self, keys:[str]) -> [bool]:
+        """Return, for each given key, whether it may be in the filter"""
+        if numpy is None:
+            return [key in self for key in keys]
+        keys = tuple(keys)
+        hashed = numpy.fromiter(map(key_hash, keys), dtype=numpy.uint64, count=len(keys))
+        mixed = hashed * numpy.uint64(MULTIPLIER)  # wraps modulo 2^64
+        mask = self.numpy_masks[(mixed & numpy.uint64((1 << MASK_BITS) - 1)).astype(numpy.intp)]
+        words = numpy.frombuffer(self.words, dtype='<u8', count=self.nb_words)
+        word = words[((mixed >> numpy.uint64(MASK_BITS)) % numpy.uint64(self.nb_words)).astype(numpy.intp)]
+        return ((word & mask) == mask).tolist()
+
+    def write(self, filename:str):
+        """Write the filter in given file, atomically"""
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with deploy.replacing(filename) as fd:
+            fd.write(HEADER.pack(MAGIC, FORMAT, self.hashes, self.nb_words, self.count,
+                                 self.database_size, self.database_sha1))
+            fd.write(self.words)
+
+    @staticmethod
+    def load(filename:str, writable:bool=False) -> 'BloomFilter' or None:
+        """Return the filter stored in given file, or None if there is
+        no valid one. It is read with mmap, or in memory if writable."""
+        try:
+            with open(filename, 'rb') as fd:
+                header = fd.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return None
+                magic, version, hashes, nb_words, count, size, sha1 = HEADER.unpack(header)
+                if magic != MAGIC or version != FORMAT or not nb_words:
+                    return None
+                if writable:
+                    words = bytearray(fd.read())
+                    mapped = None
+                else:
+                    mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                    words = memoryview(mapped)[HEADER.size:]
+        except OSError:
+            return None
+        if len(words) != nb_words * WORD.size:
+            return None
+        bloom = BloomFilter(words, hashes, count, size, sha1)
+        bloom._mmap = mapped
+        return bloom
+
+    def close(self):
+        if self._mmap is not None:
+            self.words.release()
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def rebuild(database:str=LOCAL_GIT_DB, filename:str=BLOOM_FILE) -> int:
+    """Build the filter of the whole database, return the number of objects"""
+    hashes = array('L', (key_hash(key) for key in parsecache.keys(database) if key is not None))
+    bloom = BloomFilter.for_capacity(2 * len(hashes))  # room for the next discoveries
+    bloom.add_hashes(hashes)
+    with open(database, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        bloom.database_size, bloom.database_sha1 = size, bytes.fromhex(_hash_range(fd, 0, size))
+    bloom.write(filename)
+    return bloom.count
+
+
+def update(database:str=LOCAL_GIT_DB, filename:str=BLOOM_FILE) -> int:
+    """Bring the filter up to date with the database.
+    Return the number of newly added objects."""
+    bloom = BloomFilter.load(filename, writable=True)
+    if bloom is None:
+        return rebuild(database, filename)
+    size = os.path.getsize(database)
+    added = size - bloom.database_size
+    with open(database, 'rb') as fd:
+        if added < 0 or bytes.fromhex(_hash_range(fd, added, bloom.database_size)) != bloom.database_sha1:
+            return rebuild(database, filename)
+        if not added:
+            return 0
+        fd.seek(0)
+        head = fd.read(added)
+        sha1 = _hash_range(fd, 0, size)
+    keys = [pobject.record_key(record) for record in pobject.parse(head)]
+    keys = [key for key in keys if key is not None]
+    if bloom.count + len(keys) > bloom.capacity:  # false positives would increase
+        return rebuild(database, filename)
+    bloom.add_hashes(map(key_hash, keys))
+    bloom.database_size, bloom.database_sha1 = size, bytes.fromhex(sha1)
+    bloom.write(filename)
+    return len(keys)
+
+
+def already_discovered(records:[pobject.PObject], database:str=LOCAL_GIT_DB,
+                       filename:str=BLOOM_FILE) -> {str: pobject.PObject}:
+    """Return the objects of given records found in the database, with
+    the record of their first explorer. Without filter, nothing is found."""
+    return known_objects({pobject.record_key(record) for record in records} - {None},
+                         database, filename)
+
+
+def known_objects(keys:[str], database:str=LOCAL_GIT_DB,
+                  filename:str=BLOOM_FILE, exact:bool=False) -> {str: pobject.PObject}:
+    """Return the given objects found in the database, with the record
+    of their first explorer. Without filter, nothing is found, unless
+    exact is True: all objects are then looked for in the database,
+    as they are when the filter was not built from its exact content."""
+    keys = tuple(keys)
+    bloom = BloomFilter.load(filename)
+    if exact and bloom is not None and not _built_from(bloom, database):
+        bloom.close()
+        bloom = None
+    if exact and bloom is None:
+        candidates = set(keys)
+    else:
+        with bloom or _NO_FILTER as bloom:
+            candidates = {key for key, hit in zip(keys, bloom.contains_many(keys)) if hit}
+    if not candidates:
+        return {}
+    positions = _indexed_positions(candidates, database)
+    if positions is None:
+        parsed = parsecache.cached(database)
+        if parsed is None:
+            return _last_records(pobject.parse_file(database), candidates)
+        offsets, lengths = parsed.positions('offsets'), parsed.positions('lengths')
+        positions = [(offsets[index], lengths[index])
+                     for index, key in enumerate(parsed.keys()) if key in candidates]
+    if not positions:
+        return {}
+    # only the records found are parsed, at their position in the database
+    with open(database, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return _last_records((next(pobject.parse(data[offset:offset+length], offset))
+                              for offset, length in positions), candidates)
+
+
+def _indexed_positions(keys:set, database:str) -> [(int, int)] or None:
+    """Return offset and length of the records of the first explorers
+    of given objects, found in the index of the database (see dbindex.py),
+    or None if the index does not describe the current database"""
+    try:
+        if not dbindex.is_current(database):
+            return None
+        return list(dbindex.first_explorers(keys).values())
+    except (OSError, sqlite3.Error):
+        return None
+
+
+def _last_records(records:[pobject.PObject], keys:set) -> {str: pobject.PObject}:
+    found = {}  # the last record of an object is the one of its first explorer
+    for record in records:
+        if pobject.record_key(record) in keys:
+            found[pobject.record_key(record)] = record
+    return found
+
+
+def _built_from(bloom:BloomFilter, database:str) -> bool:
+    """True if given filter was built from the current content of the
+    database: a merge or a rebase may change it without changing its size"""
+    with open(database, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        return size == bloom.database_size and bytes.fromhex(_hash_range(fd, 0, size)) == bloom.database_sha1
+
+
+class _NoFilter:
+    """Filter of an unknown database, containing nothing"""
+    def contains_many(self, keys:[str]) -> [bool]:
+        return [False] * len(keys)
+    def __enter__(self):
+        return self
+    def __exit__(self, *_):
+        pass
+
+_NO_FILTER = _NoFilter()
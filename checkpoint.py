@@ -0,0 +1,111 @@
+"""Checkpoint of the used database, recorded when it is installed.
+
+SpaceEngine only appends new descriptions at the end of the used database.
+Knowing the size and the hash of the installed content is therefore enough
+to find the user discoveries: if the beginning of the file still has
+the same hash, only the bytes after the checkpoint are new.
+
+"""
+
+import io
+import os
+import json
+import hashlib
+import pobject
+from constants import DATABASE_FILE, CHECKPOINT_FILE
+
+
+CHUNK_SIZE = 1 << 20  # bytes hashed at once
+
+
+def _hash(fd, size:int=None, chunk_size:int=CHUNK_SIZE) -> (str, int):
+    """Return the hash of the size first bytes of given binary file
+    (all if size is None), and the number of bytes actually hashed"""
+    digest, hashed = hashlib.sha1(), 0
+    while size is None or hashed < size:
+        chunk = fd.read(chunk_size if size is None else min(chunk_size, size - hashed))
+        if not chunk:
+            break
+        digest.update(chunk)
+        hashed += len(chunk)
+    return digest.hexdigest(), hashed
+
+
+def record(filename:str=DATABASE_FILE, checkpoint_file:str=CHECKPOINT_FILE,
+           size:int=None) -> dict:
+    """Save and return the checkpoint of given file, or of its size first bytes"""
+    with open(filename, 'rb') as fd:
+        sha1, size = _hash(fd, size)
+    checkpoint = {'file': filename, 'size': size, 'sha1': sha1}
+    os.makedirs(os.path.dirname(checkpoint_file) or '.', exist_ok=True)
+    with open(checkpoint_file, 'w') as fd:
+        json.dump(checkpoint, fd)
+    return checkpoint
+
+
+def load(checkpoint_file:str=CHECKPOINT_FILE) -> dict or None:
+    """Return the saved checkpoint, or None if there is none"""
+    try:
+        with open(checkpoint_file) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def appended_data(filename:str=DATABASE_FILE,
+                  checkpoint_file:str=CHECKPOINT_FILE) -> bytes or None:
+    """Return the bytes added to given file since its checkpoint,
+    or None if the checkpointed content has been modified (or if
+    there is no checkpoint for it)"""
+    checkpoint = load(checkpoint_file)
+    if not checkpoint or checkpoint.get('file') != filename:
+        return None
+    try:
+        with open(filename, 'rb') as fd:
+            sha1, size = _hash(fd, checkpoint['size'])
+            if size != checkpoint['size'] or sha1 != checkpoint['sha1']:
+                return None
+            return fd.read()
+    except OSError:
+        return None
+
+
+def appended_lines(filename:str=DATABASE_FILE,
+                   checkpoint_file:str=CHECKPOINT_FILE) -> [str] or None:
+    """Return the lines added to given file since its checkpoint,
+    decoded as open() would do, or None if the checkpoint can't be used"""
+    data = appended_data(filename, checkpoint_file)
+    if data is None:
+        return None
+    return io.TextIOWrapper(io.BytesIO(data)).readlines()
+
+
+def is_unchanged(filename:str=DATABASE_FILE, checkpoint_file:str=CHECKPOINT_FILE) -> bool:
+    """True if given file is exactly in its checkpointed state"""
+    return appended_data(filename, checkpoint_file) == b''
+
+
+def appended_records(filename:str=DATABASE_FILE,
+                     checkpoint_file:str=CHECKPOINT_FILE) -> bytes or None:
+    """Return the complete records added to given file since its checkpoint.
+    Return None if the checkpointed content has been modified.
+    The checkpoint is left in place: see consume."""
+    data = appended_data(filename, checkpoint_file)
+    if not data:
+        return data
+    end = 0
+    try:
+        for obj in pobject.parse(data):
+            end = obj.offset + obj.length
+    except pobject.ParseError:  # last record is still being written
+        pass
+    if end and data[end:end+1] == b'\n':
+        end += 1
+    return data[:end]
+
+
+def consume(filename:str, data:bytes, checkpoint_file:str=CHECKPOINT_FILE):
+    """Move the checkpoint of given file after given data,
+    returned by appended_records"""
+    if data:
+        record(filename, checkpoint_file, size=load(checkpoint_file)['size'] + len(data))
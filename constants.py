@@ -6,9 +6,71 @@ DATABASE_FILE = 'config/' + DATABASE_FILENAME
 REMOTE_GIT_DB = 'https://github.com/aluriak/se-pioneers-db.git'
 LOCAL_GIT_DIR = 'pioneers-db'
 LOCAL_GIT_DB = os.path.join(LOCAL_GIT_DIR, DATABASE_FILENAME)
+LOCAL_GIT_SHARDS = os.path.join(LOCAL_GIT_DIR, 'shards')  # only in sharded layout
+# paths of the git database repository to checkout, in addition to files at its root
+SPARSE_PATHS = ('shards',)
 DIFFLIB_TO_HUMAN = {' ': 'unchanged', '+': 'added', '-': 'modified', '?': 'unexpected'}
 
 REG_DATA_LOCATION = re.compile(r'LocName\s"([^"]+)"')
 REG_DATA_NAME = re.compile(r'Name\s+"([^"]+)"')
 REG_DATA_PIONEER = re.compile(r'Pioneer\s+"([^"]+)"')
 REG_DATA_DATE = re.compile(r'Date\s+"([^"]+)"')
+
+LOCAL_STATE_DIR = 'pioneers-state'  # local data about the Pioneers installation
+CHECKPOINT_FILE = os.path.join(LOCAL_STATE_DIR, 'checkpoint.json')
+OUTBOX_FILE = os.path.join(LOCAL_STATE_DIR, 'outbox.journal')
+OUTBOX_TRAILER = 'Outbox-Batch: {}'  # line of the commit messages, to find the commit of an outbox batch
+PUSH_ATTEMPTS = 3  # before giving up until next session
+PUSH_BASE_DELAY = 1.  # seconds before second attempt, doubled at each attempt
+PUSH_REBASE_ATTEMPTS = 5  # pushes rejected because of concurrent explorers
+
+WATCH_DEBOUNCE_DELAY = 2.  # seconds without writes before reading the used database
+WATCH_POLL_INTERVAL = 1.  # seconds between checks, when watchdog is not available
+WATCH_PUBLISH_INTERVAL = 30.  # minimal seconds between two publications
+
+# limits of the discoveries accepted for a push
+VALIDATION_MAX_RECORDS = 1000
+VALIDATION_MAX_FIELD_LENGTH = 4096  # characters in a field value
+VALIDATION_MAX_BYTES = 1 << 20
+
+INDEX_FILE = os.path.join(LOCAL_STATE_DIR, 'index.sqlite')  # local index of the git database
+INDEX_BATCH_SIZE = 10000  # records inserted at once
+INDEX_LOOKUP_SIZE = 400  # objects looked up at once (twice as many SQL variables)
+
+MAP_DIR = 'pioneers-map'  # where the map of the explored universe is exported
+MAP_RESOLUTION = 256  # pixels on each side of the map of a galaxy
+MAP_TILE_SIZE = 64  # pixels on each side of an exported tile
+MAP_CHUNK_SIZE = 100000  # records aggregated at once
+
+# how the git database is installed as used database: 'auto' (reflink if supported,
+#  else copy), 'hardlink' or 'copy'. PIONEERS_DEPLOY_MODE environment variable overrides it.
+DEPLOY_MODE = 'auto'
+DEPLOY_JOURNAL = os.path.join(LOCAL_STATE_DIR, 'deploy.journal')  # temporary files being written
+
+HUB_HOST = 'localhost'  # where the hub listens
+HUB_PORT = 8765
+HUB_BATCH_INTERVAL = 10.  # seconds between two commits of the hub
+HUB_POOL_SIZE = 4  # connections to the hub kept open by a client
+HUB_TIMEOUT = 30.  # seconds
+
+PACKS_STATE_FILE = os.path.join(LOCAL_STATE_DIR, 'packs.json')  # version of the local database
+PACK_SNAPSHOT_INTERVAL = 50  # versions between two snapshots of the whole database
+
+BLOOM_FILE = os.path.join(LOCAL_STATE_DIR, 'objects.bloom')  # filter of the objects of the git database
+BLOOM_BITS_PER_KEY = 16  # size of the filter: about 0.5% of false positives
+BLOOM_HASHES = 6  # bits set by each object
+
+IMPORT_CHUNK_SIZE = 4 << 20  # bytes of the files to import parsed by a worker at once
+IMPORT_WORKERS = None  # processes parsing the files to import (default: one per core)
+
+DAEMON_SOCKET = os.path.join(LOCAL_STATE_DIR, 'daemon.sock')  # where the daemon of the install listens
+DAEMON_TIMEOUT = 600.  # seconds a client waits for an answer (sync and publish use the network)
+
+# background fetches of the remote database during a session, so the final pull is local
+PREFETCH_MIN_INTERVAL = 30.  # seconds between two fetches, while the remote moves
+PREFETCH_MAX_INTERVAL = 600.  # seconds, reached when the remote does not move, or is unreachable
+PREFETCH_JITTER = .2  # random part of the interval, so explorers do not fetch all at once
+PREFETCH_MAX_AGE = 2 * PREFETCH_MAX_INTERVAL  # seconds a fetch stays recent enough to pull without the remote
+
+PARSE_CACHE_DIR = os.path.join(LOCAL_STATE_DIR, 'parsecache')  # parsed git database, by git blob
+PARSE_CACHE_MAX_BYTES = 256 << 20  # older entries are removed beyond
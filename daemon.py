@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+"""Pioneers daemon: a resident agent of a SpaceEngine install.
+
+Each run of pioneers.py starts cold: modules are imported, the working
+directory checked, git spawned and the databases read again. The daemon
+does it once, then keeps its state warm: the repository handle, the index
+and the RS trie of the git database, the state of SpaceEngine. It answers
+commands on a Unix domain socket of the install (see daemonclient.py),
+so pioneers.py and gui.py become thin clients while it runs.
+
+Each request is a JSON object on a line, answered by a JSON object on a
+line, holding "ok", and "output" (what the command printed):
+
+    {"command": "status"}    state of the install, answered at once
+    {"command": "sync"}      pull the git database, install it, update index and filter
+    {"command": "publish"}   publish the discoveries of the used database
+    {"command": "query", "object": ..., "pioneer": ..., "since": ...,
+                         "sector": ..., "nearest": ..., "limit": ...}
+    {"command": "stop"}
+
+sync and publish are run one at a time by a single writer thread. Queries
+are run by other threads, on the state of the last synchronization.
+The remote is prefetched in background (see prefetch.py), so sync and
+publish merge what was fetched, without waiting for the network.
+While SpaceEngine runs, publish leaves the used database untouched.
+
+Usage: run it in the install directory of SpaceEngine, once initialized.
+
+    python daemon.py
+
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import threading
+import contextlib
+import concurrent.futures
+import gitctl
+import outbox
+import prefetch
+import rstrie
+import shards
+import parsecache
+import routines
+import checkpoint
+import instrument
+import proctracker
+from constants import LOCAL_GIT_DB, DATABASE_FILE, DAEMON_SOCKET
+
+
+# parameters of the commands run in threads
+PARAMETERS = {'sync': (), 'publish': (),
+              'query': ('object', 'pioneer', 'since', 'sector', 'nearest', 'limit')}
+
+
+class Daemon:
+    """Warm state of an install, and the commands using it.
+
+    Must be used from the thread running its event loop: commands
+    modifying the databases are run by a single writer thread.
+
+    """
+
+    def __init__(self, socket_path:str=DAEMON_SOCKET):
+        self.socket_path = socket_path
+        self.started = time.time()
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.commands = []  # commands run, or waiting to be run, by the writer
+        self.stamp = None  # size and modification time of the loaded git database
+        self.trie = None  # RS trie of the loaded git database
+        self.unpushed = 0
+        self.last_sync = None
+        self.spaceengine = None  # pid of SpaceEngine, if running
+        self.tracker = proctracker.tracker()
+        self.prefetcher = prefetch.Prefetcher()  # so sync and publish do not wait for the network
+        self.output = _Output(sys.stdout)
+        self.connections = {}  # task answering a client -> its writer
+        self.stopped = None  # created in the event loop
+
+    def load(self):
+        """Bring the index and the trie up to date with the git database,
+        if it changed since last load"""
+        if shards.is_sharded():
+            shards.compile_database()
+        stamp = _stamp(LOCAL_GIT_DB)
+        if stamp == self.stamp:
+            return
+        gitctl.update_index()
+        gitctl.update_filter()
+        self.trie = parsecache.rs_trie()
+        self.stamp = stamp
+        self.unpushed = int(gitctl.has_unpushed_commits())
+
+    def sync(self) -> dict:
+        try:
+            gitctl.synchronize()
+        except gitctl.GitError as err:
+            print("WARNING: repository not updated ({}).".format(err))
+        else:
+            self.last_sync = time.time()
+        self.load()
+        return {'objects': len(self.trie)}
+
+    def publish(self) -> dict:
+        """Publish the discoveries of the used database. While SpaceEngine
+        runs, only the records appended since last publication are read,
+        and the used database is not replaced."""
+        data = None  # records appended while SpaceEngine runs
+        if self.spaceengine:
+            data = checkpoint.appended_records(DATABASE_FILE)
+            if data is None:
+                print("Used database modified before its end. "
+                      "Discoveries will be detected once SpaceEngine is stopped.")
+            discoveries = data.decode() if data else ''
+        else:
+            discoveries = ''.join(routines.user_discoveries())
+            try:
+                gitctl.synchronize()
+            except gitctl.GitError as err:  # discoveries will wait in the outbox
+                print("WARNING: {}".format(err))
+        # invalid records stay after the checkpoint, to be reported once SpaceEngine is stopped
+        if discoveries.strip() and routines.verified_discoveries(discoveries):
+            if data:
+                checkpoint.consume(DATABASE_FILE, data)
+            discoveries = routines.drop_known_discoveries(discoveries)
+            if discoveries:
+                outbox.Outbox().enqueue(discoveries)
+        commited = routines.publish_outbox(install=not self.spaceengine)
+        self.load()
+        return {'commited': commited}
+
+    def query(self, object:str=None, pioneer:str=None, since:str=None, sector:str=None,
+              nearest:str=None, limit:int=None) -> dict:
+        routines.print_query(object, pioneer, since, sector, nearest, limit, trie=lambda: self.trie or rstrie.RSTrie())
+        return {}
+
+    def status(self) -> dict:
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started,
+                'objects': len(self.trie) if self.trie else 0,
+                'pending': len(outbox.Outbox()), 'unpushed': self.unpushed,
+                'last_sync': self.last_sync, 'commands': self.commands,
+                'spaceengine': self.spaceengine}
+
+    async def run(self, request:dict) -> dict:
+        """Return the answer to given request"""
+        command = request.pop('command', None)
+        if command == 'status':
+            return dict(self.status(), ok=True, output='')
+        if command == 'stop':
+            self.stopped.set()
+            return {'ok': True, 'output': "Daemon stopped.\n"}
+        if command not in PARAMETERS:
+            return {'ok': False, 'error': 'unknown command {!r}'.format(command)}
+        unexpected = request.keys() - set(PARAMETERS[command])
+        if unexpected:
+            return {'ok': False, 'error': 'unexpected parameters: ' + ', '.join(sorted(unexpected))}
+        # queries are run by the default executor, concurrently with the writer
+        executor = None if command == 'query' else self.writer
+        loop = asyncio.get_running_loop()
+        if executor is self.writer:
+            self.commands.append(command)
+        try:
+            answer, output = await loop.run_in_executor(executor, self.output.capture,
+                                                        getattr(self, command), request)
+        except Exception as err:
+            return {'ok': False, 'error': '{}: {}'.format(type(err).__name__, err)}
+        finally:
+            if executor is self.writer:
+                self.commands.remove(command)
+        return dict(answer, ok=True, output=output)
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        """Answer the requests sent on given connection, until it is closed"""
+        self.connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                try:
+                    request = json.loads(line)
+                    answer = await self.run(dict(request))
+                except (ValueError, TypeError) as err:  # not a JSON object
+                    answer = {'ok': False, 'error': 'invalid request: {}'.format(err)}
+                writer.write(json.dumps(answer).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass  # client gone
+        finally:
+            self.connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+    def _on_start(self, pid:int):
+        self.spaceengine = pid
+
+    def _on_stop(self, pid:int):
+        self.spaceengine = None
+
+    async def serve(self, started:callable=None):
+        """Serve until the stop command, or until cancelled.
+
+        started -- called with the server once it listens
+
+        """
+        self.stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.writer, self.load)
+        self.tracker.on_start, self.tracker.on_stop = self._on_start, self._on_stop
+        self.tracker.start()
+        self.prefetcher.start()
+        sys.stdout = self.output
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        server = await asyncio.start_unix_server(self.handle, self.socket_path)
+        if started:
+            started(server)
+        try:
+            async with server:
+                await self.stopped.wait()
+                for writer in self.connections.values():
+                    writer.close()  # the clients waiting for a command get an end of file
+                await asyncio.gather(*self.connections, return_exceptions=True)
+        finally:
+            sys.stdout = self.output.stdout
+            self.tracker.stop()
+            self.prefetcher.stop()
+            self.writer.shutdown()
+            with contextlib.suppress(OSError):
+                os.remove(self.socket_path)
+
+
+class _Output(io.TextIOBase):
+    """Standard output of the daemon: what is printed by a command goes
+    to the buffer of its thread, the rest to the real standard output"""
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, 'buffer', None) or self.stdout
+
+    def write(self, text:str) -> int:
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def capture(self, func:callable, params:dict) -> (dict, str):
+        """Return the answer of func called with given parameters,
+        and what it printed"""
+        self.local.buffer = io.StringIO()
+        try:
+            return func(**params), self.local.buffer.getvalue()
+        finally:
+            self.local.buffer = None
+
+
+def _stamp(filename:str) -> (int, int) or None:
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def remove_stale_socket(socket_path:str=DAEMON_SOCKET) -> bool:
+    """Remove the socket left by a daemon that did not stop properly.
+    Return False if a daemon is listening on it."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except FileNotFoundError:
+            return True
+        except OSError:
+            os.remove(socket_path)
+            return True
+    return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', type=str, default=DAEMON_SOCKET,
+                        help='path of the socket to listen on')
+    parser.add_argument('--profile', type=str, default=None, metavar='FILE',
+                        help='Write duration, memory and counts of each phase in FILE')
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable(args.profile)
+    if not hasattr(socket, 'AF_UNIX'):
+        print("ERROR: Unix domain sockets are not available on this system.")
+        exit(1)
+    missing_dirs = set(routines.missings_in_working_directory())
+    if missing_dirs or not routines.initialization_done():
+        print("ERROR: run the daemon in the SpaceEngine install directory, "
+              "once Pioneers is initialized (with pioneers.py).")
+        exit(1)
+    if not remove_stale_socket(args.socket):
+        print("ERROR: a daemon is already running on {}.".format(args.socket))
+        exit(1)
+    gitctl.recover_interrupted_writes()
+    print("Serving on {} (ctrl-c to stop)".format(args.socket))
+    try:
+        asyncio.run(Daemon(args.socket).serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+"""Client of the Pioneers daemon of the install (see daemon.py).
+
+It needs only the standard library, so a command answered by a warm
+daemon takes a few milliseconds, instead of the seconds of a cold run.
+
+Usage, in the install directory of SpaceEngine, once the daemon runs:
+
+    python daemonclient.py status
+    python daemonclient.py sync
+    python daemonclient.py publish
+    python daemonclient.py query "RS 0-4-1388-500-11085-8-6447711-79"
+    python daemonclient.py query --pioneer lucas --since 2017.10 --limit 10
+    python daemonclient.py stop
+
+"""
+
+import sys
+import json
+import socket
+import argparse
+from constants import DAEMON_SOCKET, DAEMON_TIMEOUT
+
+
+class DaemonError(Exception):
+    """Raised when the daemon could not run a command"""
+
+
+class DaemonClient:
+    """Send commands to the daemon listening on given socket.
+    The connection is opened at first command, and kept open."""
+
+    def __init__(self, socket_path:str=DAEMON_SOCKET, timeout:float=DAEMON_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+
+    def call(self, command:str, **params) -> dict:
+        """Return the answer of the daemon to given command.
+        Raise DaemonError if it failed, OSError if there is no daemon."""
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            try:
+                self.sock.connect(self.socket_path)
+            except OSError:
+                self.close()
+                raise
+            self.reader = self.sock.makefile('rb')
+        try:
+            self.sock.sendall(json.dumps(dict(params, command=command)).encode() + b'\n')
+            line = self.reader.readline()
+        except OSError:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise ConnectionResetError("daemon closed the connection")
+        answer = json.loads(line.decode())
+        if not answer.get('ok'):
+            raise DaemonError(answer.get('error', 'unknown error'))
+        return answer
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def running(socket_path:str=DAEMON_SOCKET) -> bool:
+    """True if a daemon listens on given socket"""
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def run(command:str, socket_path:str=DAEMON_SOCKET, **params) -> dict:
+    """Send given command to the daemon, print its output, and return
+    its answer. Raise DaemonError or OSError on failure."""
+    with DaemonClient(socket_path) as client:
+        answer = client.call(command, **params)
+    print(answer.get('output', ''), end='', flush=True)
+    return answer
+
+
+def cli_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', type=str, default=DAEMON_SOCKET,
+                        help='path of the socket of the daemon')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ('status', 'sync', 'publish', 'stop'):
+        subparsers.add_parser(command)
+    query = subparsers.add_parser('query', help='Search the git database, as pioneers.py query')
+    query.add_argument('object', type=str, nargs='?', default=None)
+    query.add_argument('--pioneer', type=str, default=None)
+    query.add_argument('--since', type=str, default=None)
+    query.add_argument('--sector', type=str, default=None)
+    query.add_argument('--nearest', type=str, default=None)
+    query.add_argument('--limit', type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = cli_args()
+    params = {key: value for key, value in vars(args).items()
+              if key not in ('command', 'socket') and value is not None}
+    try:
+        answer = run(args.command, args.socket, **params)
+    except (OSError, DaemonError) as err:
+        print("ERROR: {}".format(err))
+        sys.exit(1)
+    if args.command == 'status':
+        for key, value in answer.items():
+            if key not in ('ok', 'output'):
+                print('{}: {}'.format(key, value))
@@ -0,0 +1,234 @@
+"""Local SQLite index of the git database.
+
+Each record of the database is stored with its byte position, allowing
+to answer quickly who discovered an object, what a pioneer found,
+or what was discovered after a date.
+
+The index is updated after each synchronization. Since discoveries
+are added on top of the database, the new file usually ends with
+the indexed one: only its beginning is then parsed. Positions are stored
+relative to the end of the file, so that indexed records are left
+untouched. Any other modification leads to a full rebuild.
+
+"""
+
+import os
+import sqlite3
+import hashlib
+import itertools
+import pobject
+from constants import LOCAL_GIT_DB, INDEX_FILE, INDEX_BATCH_SIZE, INDEX_LOOKUP_SIZE
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS record (
+    rear INTEGER PRIMARY KEY,  -- bytes between the record start and the end of file
+    length INTEGER NOT NULL,
+    locname TEXT, name TEXT, pioneer TEXT, date TEXT, descr TEXT
+);
+CREATE TABLE IF NOT EXISTS source (
+    key TEXT PRIMARY KEY,
+    value
+);
+"""
+INDEXES = """
+CREATE INDEX IF NOT EXISTS record_locname ON record(locname);
+CREATE INDEX IF NOT EXISTS record_name ON record(name);
+CREATE INDEX IF NOT EXISTS record_pioneer ON record(pioneer);
+CREATE INDEX IF NOT EXISTS record_date ON record(date);
+"""
+FIELDS = ('rear', 'length', 'locname', 'name', 'pioneer', 'date', 'descr')
+
+
+def _hash_range(fd, start:int, size:int, chunk_size:int=1 << 20) -> str:
+    """Return the hash of size bytes of given binary file, from start"""
+    fd.seek(start)
+    digest = hashlib.sha1()
+    while size > 0:
+        chunk = fd.read(min(chunk_size, size))
+        if not chunk:
+            break
+        digest.update(chunk)
+        size -= len(chunk)
+    return digest.hexdigest()
+
+
+def connect(index_file:str=INDEX_FILE) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+    db = sqlite3.connect(index_file)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    return db
+
+
+def _source(db:sqlite3.Connection) -> dict:
+    return dict(db.execute('SELECT key, value FROM source'))
+
+
+def _insert(db:sqlite3.Connection, records:[pobject.PObject], size:int):
+    """Insert given records by batches. size is the size of the database"""
+    rows = ((size - record.offset, record.length, record.locname, record.name,
+             record.pioneer, record.date, record.descr) for record in records)
+    insert = 'INSERT INTO record VALUES ({})'.format(', '.join('?' * len(FIELDS)))
+    while True:
+        batch = tuple(itertools.islice(rows, INDEX_BATCH_SIZE))
+        if not batch:
+            break
+        db.executemany(insert, batch)
+
+
+def _save_source(db:sqlite3.Connection, database:str, size:int, sha1:str):
+    db.executemany('INSERT OR REPLACE INTO source VALUES (?, ?)', (
+        ('file', os.path.abspath(database)), ('size', size), ('sha1', sha1),
+        ('mtime', os.path.getmtime(database)),
+    ))
+
+
+def rebuild(database:str=LOCAL_GIT_DB, index_file:str=INDEX_FILE) -> int:
+    """Index the whole database, return the number of indexed records"""
+    db = connect(index_file)
+    try:
+        db.execute('PRAGMA synchronous = OFF')  # the index can always be rebuilt
+        with db:
+            for name in ('locname', 'name', 'pioneer', 'date'):  # faster without indexes
+                db.execute('DROP INDEX IF EXISTS record_' + name)
+            db.execute('DELETE FROM record')
+            with open(database, 'rb') as fd:
+                size = os.fstat(fd.fileno()).st_size
+                _insert(db, pobject.parse_file(database), size)
+                for statement in INDEXES.strip().splitlines():
+                    db.execute(statement)
+                _save_source(db, database, size, _hash_range(fd, 0, size))
+        return db.execute('SELECT count(*) FROM record').fetchone()[0]
+    finally:
+        db.close()
+
+
+def update(database:str=LOCAL_GIT_DB, index_file:str=INDEX_FILE) -> int:
+    """Bring the index up to date with the database.
+    Return the number of newly indexed records."""
+    db = connect(index_file)
+    try:
+        source = _source(db)
+        if source.get('file') != os.path.abspath(database):
+            db.close()
+            return rebuild(database, index_file)
+        size = os.path.getsize(database)
+        if size == source['size'] and os.path.getmtime(database) == source['mtime']:
+            return 0
+        added = size - source['size']
+        with open(database, 'rb') as fd:
+            if added < 0 or _hash_range(fd, added, source['size']) != source['sha1']:
+                db.close()
+                return rebuild(database, index_file)
+            fd.seek(0)
+            head = fd.read(added)
+            sha1 = _hash_range(fd, 0, size)
+        records = tuple(pobject.parse(head))
+        with db:
+            _insert(db, records, size)
+            _save_source(db, database, size, sha1)
+        return len(records)
+    finally:
+        db.close()
+
+
+def _select(where:str, params:tuple, limit:int=None, order:str='rear DESC',
+            index_file:str=INDEX_FILE) -> [dict]:
+    """Return the records matching given SQL condition, with their offset
+    in the indexed database"""
+    db = connect(index_file)
+    try:
+        size = _source(db).get('size', 0)
+        query = 'SELECT * FROM record WHERE {} ORDER BY {}'.format(where, order)
+        if limit:
+            query += ' LIMIT {:d}'.format(limit)
+        records = [dict(row) for row in db.execute(query, params)]
+    finally:
+        db.close()
+    for record in records:
+        record['offset'] = size - record.pop('rear')
+    return records
+
+
+def locnames(index_file:str=INDEX_FILE) -> [(str, int)]:
+    """Yield LocName and offset of all indexed records"""
+    db = connect(index_file)
+    try:
+        size = _source(db).get('size', 0)
+        for locname, rear in db.execute('SELECT locname, rear FROM record WHERE locname IS NOT NULL'):
+            yield locname, size - rear
+    finally:
+        db.close()
+
+
+def is_current(database:str=LOCAL_GIT_DB, index_file:str=INDEX_FILE) -> bool:
+    """True if the index was built from the current content of given database"""
+    if not os.path.exists(index_file):
+        return False
+    db = connect(index_file)
+    try:
+        source = _source(db)
+    finally:
+        db.close()
+    return (source.get('file') == os.path.abspath(database)
+            and source.get('size') == os.path.getsize(database)
+            and source.get('mtime') == os.path.getmtime(database))
+
+
+def first_explorers(keys:[str], index_file:str=INDEX_FILE) -> {str: (int, int)}:
+    """Return offset and length of the record of the first explorer of
+    each given object found in the index. Objects are identified as in
+    pobject.record_key: by LocName, or by Name for records without LocName."""
+    keys, found = tuple(keys), {}
+    db = connect(index_file)
+    try:
+        size = _source(db).get('size', 0)
+        for start in range(0, len(keys), INDEX_LOOKUP_SIZE):
+            batch = keys[start:start+INDEX_LOOKUP_SIZE]
+            marks = ', '.join('?' * len(batch))
+            query = ('SELECT locname, min(rear), length FROM record WHERE locname IN ({0}) GROUP BY locname'
+                     ' UNION ALL SELECT name, min(rear), length FROM record'
+                     ' WHERE locname IS NULL AND name IN ({0}) GROUP BY name').format(marks)
+            for key, rear, length in db.execute(query, batch + batch):
+                if key not in found or rear < found[key][0]:  # the last record wins
+                    found[key] = rear, length
+    finally:
+        db.close()
+    return {key: (size - rear, length) for key, (rear, length) in found.items()}
+
+
+def discoverer(name:str, index_file:str=INDEX_FILE) -> dict or None:
+    """Return the record of the first explorer of given object (LocName
+    or Name), or None if it was never discovered.
+
+    This is the record used by SpaceEngine, i.e. the last one in the database.
+
+    """
+    found = _select('locname = ?1 OR name = ?1', (name,), limit=1,
+                    order='rear', index_file=index_file)
+    return found[0] if found else None
+
+
+def search(locname:str=None, pioneer:str=None, since:str=None,
+           limit:int=None, index_file:str=INDEX_FILE) -> [dict]:
+    """Return records matching all given criterions, most recent first.
+
+    locname -- LocName or Name of the object
+    pioneer -- name of the pioneer
+    since -- date (in database format, or any prefix of it) after which
+             records were discovered
+
+    """
+    criterions, params = ['1'], []
+    if locname is not None:
+        criterions.append('(locname = ? OR name = ?)')
+        params += [locname, locname]
+    if pioneer is not None:
+        criterions.append('pioneer = ?')
+        params.append(pioneer)
+    if since is not None:
+        criterions.append('date >= ?')
+        params.append(since)
+    order = 'date DESC, rear DESC' if since is not None else 'rear DESC'
+    return _select(' AND '.join(criterions), tuple(params), limit, order, index_file)
@@ -0,0 +1,178 @@
+"""Atomic installation of files, without copy when possible.
+
+A file is never written in place: a sibling temporary file receives the
+content, then replaces the target with os.replace, so the target is
+always either the old or the new version, even if Pioneers is killed.
+
+When installing a file, the sibling receives the content of the source
+by, in order of preference:
+
+- reflink: a copy-on-write clone sharing the data blocks of the source
+  (Linux filesystems like btrfs or xfs),
+- hardlink, only in hardlink mode: the source itself, under another name,
+- copy.
+
+Temporary files are listed in a journal while they exist: if Pioneers
+is interrupted, recover() removes them at next run.
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import threading
+from contextlib import contextmanager
+from constants import DEPLOY_JOURNAL, DEPLOY_MODE
+
+if sys.platform.startswith('linux'):
+    import fcntl
+    FICLONE = 0x40049409  # ioctl of linux/fs.h, cloning a whole file
+else:
+    fcntl = None
+
+
+MODES = ('auto', 'hardlink', 'copy')  # auto: reflink, or copy
+ENV_VARIABLE = 'PIONEERS_DEPLOY_MODE'
+
+_journal_lock = threading.Lock()
+
+
+def mode() -> str:
+    """Return the installation mode, given by the environment or DEPLOY_MODE"""
+    chosen = os.environ.get(ENV_VARIABLE, DEPLOY_MODE)
+    if chosen not in MODES:
+        raise ValueError("Unknown installation mode {!r}, expected one of {}"
+                         "".format(chosen, ', '.join(MODES)))
+    return chosen
+
+
+def _update_journal(journal:str, add:str=None, remove:str=None):
+    """Add or remove a temporary file of the journal"""
+    with _journal_lock:
+        temps = set(pending(journal))
+        if add:
+            temps.add(add)
+        temps.discard(remove)
+        os.makedirs(os.path.dirname(journal) or '.', exist_ok=True)
+        with open(journal, 'w') as fd:
+            json.dump(sorted(temps), fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+
+def pending(journal:str=DEPLOY_JOURNAL) -> [str]:
+    """Return the temporary files of the operations not finished"""
+    try:
+        with open(journal) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return []
+
+
+def recover(journal:str=DEPLOY_JOURNAL) -> [str]:
+    """Remove temporary files left by interrupted operations,
+    return their paths. Targets are complete, since they are only
+    modified by os.replace."""
+    removed = []
+    for temp in pending(journal):
+        if os.path.exists(temp):
+            os.remove(temp)
+            removed.append(temp)
+        _update_journal(journal, remove=temp)
+    return removed
+
+
+def _sibling(target:str) -> str:
+    directory, name = os.path.split(target)
+    return os.path.join(directory, '.{}.{}-{}.tmp'.format(name, os.getpid(), threading.get_ident()))
+
+
+def _sync_directory(path:str):
+    """Make the rename in directory of given file durable"""
+    if os.name != 'posix':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def replacing(target:str, journal:str=DEPLOY_JOURNAL):
+    """Yield a binary file that replaces target when the block ends
+    without error. Target is left untouched otherwise."""
+    temp = _sibling(target)
+    _update_journal(journal, add=temp)
+    try:
+        with open(temp, 'wb') as fd:
+            yield fd
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(temp, target)
+        _sync_directory(target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+        _update_journal(journal, remove=temp)
+
+
+def reflink(source:str, target:str):
+    """Create target as a copy-on-write clone of source.
+    Raise OSError if the filesystem does not support it."""
+    if fcntl is None:
+        raise OSError("reflink is not supported on {}".format(sys.platform))
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+
+def install(source:str, target:str, install_mode:str=None,
+            journal:str=DEPLOY_JOURNAL) -> str:
+    """Replace atomically target by the content of source.
+    Return the method used: 'reflink', 'hardlink' or 'copy'."""
+    install_mode = install_mode or mode()
+    temp = _sibling(target)
+    _update_journal(journal, add=temp)
+    try:
+        method = _fill(source, temp, install_mode)
+        os.replace(temp, target)
+        _sync_directory(target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+        _update_journal(journal, remove=temp)
+    return method
+
+
+def _fill(source:str, temp:str, install_mode:str) -> str:
+    """Give to temp the content of source, return the method used"""
+    if install_mode == 'hardlink':
+        try:
+            os.link(source, temp)
+            return 'hardlink'
+        except OSError:  # other filesystem, or not supported
+            pass
+    if install_mode != 'copy':
+        try:
+            reflink(source, temp)
+            return 'reflink'
+        except OSError:
+            pass
+    shutil.copyfile(source, temp)
+    with open(temp, 'rb+') as fd:
+        os.fsync(fd.fileno())
+    return 'copy'
+
+
+def same_file(first:str, second:str) -> bool:
+    """True if both paths are the same file, as after a hardlink installation"""
+    try:
+        return os.path.samefile(first, second)
+    except OSError:
+        return False
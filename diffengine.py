@@ -0,0 +1,128 @@
+"""Streaming comparison of the git database and the used database.
+
+Both files are read by chunks from the start until they differ,
+then from the end until they differ again. Only the divergent window
+in between is given to difflib, so memory and time are bounded
+by the changed region, not by the size of the database.
+
+"""
+
+import io
+import os
+import difflib
+from collections import Counter
+
+
+CHUNK_SIZE = 1 << 16  # bytes read at once
+
+
+def _mismatch_index(a:bytes, b:bytes) -> int:
+    """Return index of the first differing byte of given strings,
+    or the length of the shortest one if it is a prefix of the other"""
+    lo, hi = 0, min(len(a), len(b))
+    if a[:hi] == b[:hi]:
+        return hi
+    while lo < hi:  # invariant: a[:lo] == b[:lo] and a[:hi] != b[:hi]
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_prefix(fref, fnew, chunk_size:int=CHUNK_SIZE) -> (int, int, bool):
+    """Return (size, lines, identical) of the common prefix of given binary
+    files, stopping at the last line boundary.
+
+    identical is True if both files have exactly the same content,
+    in which case size is the size of the files.
+
+    """
+    position, boundary, lines = 0, 0, 0
+    while True:
+        cref, cnew = fref.read(chunk_size), fnew.read(chunk_size)
+        if not cref and not cnew:  # both files ended together
+            lines += 1 if position > boundary else 0  # last line without newline
+            return position, lines, True
+        common = _mismatch_index(cref, cnew)
+        last_newline = cref.rfind(b'\n', 0, common)
+        if last_newline >= 0:
+            lines += cref.count(b'\n', 0, common)
+            boundary = position + last_newline + 1
+        if common < len(cref) or common < len(cnew):  # divergence found
+            return boundary, lines, False
+        position += common
+
+
+def _read_backward(fd, end:int, stop:int, chunk_size:int):
+    """Yield chunks of given binary file, from end to stop"""
+    while end > stop:
+        start = max(stop, end - chunk_size)
+        fd.seek(start)
+        yield fd.read(end - start)
+        end = start
+
+
+def common_suffix(fref, fnew, ref_size:int, new_size:int, prefix:int,
+                  chunk_size:int=CHUNK_SIZE) -> (int, int):
+    """Return (size, lines) of the common suffix of given binary files,
+    not overlapping the common prefix of given size, and starting
+    at a line boundary in both files."""
+    limit = min(ref_size, new_size) - prefix
+    size, chunks = 0, []
+    for cref, cnew in zip(_read_backward(fref, ref_size, ref_size - limit, chunk_size),
+                          _read_backward(fnew, new_size, new_size - limit, chunk_size)):
+        common = _mismatch_index(cref[::-1], cnew[::-1])
+        if common:
+            chunks.append(cref[len(cref)-common:])
+        size += common
+        if common < len(cref):
+            break
+    suffix = b''.join(reversed(chunks))
+    # the suffix must start a line in both files
+    def starts_a_line(fd, file_size):
+        start = file_size - size
+        if start == prefix:
+            return True
+        fd.seek(start - 1)
+        return fd.read(1) == b'\n'
+    if size and not (starts_a_line(fref, ref_size) and starts_a_line(fnew, new_size)):
+        first_newline = suffix.find(b'\n')
+        suffix = suffix[first_newline+1:] if first_newline >= 0 else b''
+        size = len(suffix)
+    lines = suffix.count(b'\n') + (1 if suffix and not suffix.endswith(b'\n') else 0)
+    return size, lines
+
+
+def _text_lines(data:bytes, encoding:str=None) -> [str]:
+    """Return lines of given data, decoded as open() would do in text mode"""
+    return io.TextIOWrapper(io.BytesIO(data), encoding=encoding).readlines()
+
+
+def compare_files(ref_file:str, new_file:str, chunk_size:int=CHUNK_SIZE,
+                  encoding:str=None) -> (Counter, tuple):
+    """Return the counts of difflib states ('+', '-', ' ', '?') for the lines
+    of given files, and the difflib.Differ lines of the divergent window.
+
+    Lines of the common prefix and suffix are counted as unchanged,
+    but are never read in memory all at once.
+
+    """
+    ref_size, new_size = os.path.getsize(ref_file), os.path.getsize(new_file)
+    with open(ref_file, 'rb') as fref, open(new_file, 'rb') as fnew:
+        prefix, prefix_lines, identical = common_prefix(fref, fnew, chunk_size)
+        if identical:
+            return Counter({' ': prefix_lines} if prefix_lines else {}), ()
+        suffix, suffix_lines = common_suffix(fref, fnew, ref_size, new_size,
+                                             prefix, chunk_size)
+        fref.seek(prefix)
+        fnew.seek(prefix)
+        ref = fref.read(ref_size - suffix - prefix)
+        new = fnew.read(new_size - suffix - prefix)
+    lines = tuple(difflib.Differ().compare(_text_lines(ref, encoding),
+                                           _text_lines(new, encoding)))
+    counts = Counter(line[0] for line in lines)
+    if prefix_lines or suffix_lines:
+        counts[' '] += prefix_lines + suffix_lines
+    return counts, lines
@@ -0,0 +1,433 @@
+"""Backends running git operations on the local repository.
+
+Two implementations share the same interface:
+
+- GitPythonBackend, using GitPython to work in-process as much as possible,
+- SubprocessBackend, running the git command line.
+
+Both work with the repository path, never changing the working directory,
+and serialize the operations on a repository with a lock, held by each
+git call and by each timed operation, so they can be used from many threads. Failures are raised as GitError.
+
+Clones can be shallow (only the tip of the default branch) and sparse
+(only the given paths are checked out, and their blobs downloaded).
+History is then fetched only when an operation needs it.
+
+The remote branch can be prefetched in background (see prefetch.py):
+a pull following a recent prefetch is then a local merge only.
+
+Duration of each operation is recorded in the timings attribute
+(and in an instrumentation span), allowing to compare the backends
+(set PIONEERS_GIT_BACKEND to 'subprocess' or 'gitpython' to choose one).
+
+"""
+
+import os
+import re
+import time
+import threading
+import subprocess
+import instrument
+from contextlib import contextmanager
+from collections import defaultdict
+
+try:
+    import git
+except ImportError:
+    git = None
+
+
+REG_PROGRESS = re.compile(r'([A-Za-z][A-Za-z ]*):\s+(\d+)%')
+REG_REJECTED = re.compile(r'rejected|non-fast-forward|fetch first')  # remote moved
+
+
+class GitError(Exception):
+    """Raised when a git operation fails"""
+    def __init__(self, operation:str, message:str, returncode:int=None):
+        super().__init__('git {} failed: {}'.format(operation, message.strip()))
+        self.operation = operation
+        self.message = message
+        self.returncode = returncode
+
+
+class Backend:
+    """Common behavior of git backends"""
+
+    def __init__(self, path:str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.timings = defaultdict(list)  # operation -> durations in seconds
+        self.fetched = None  # time.monotonic() of the last prefetch
+
+    @contextmanager
+    def timed(self, operation:str):
+        """Hold the lock while running given operation, and time it"""
+        with self.lock, instrument.span('git ' + operation):
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.timings[operation].append(time.perf_counter() - start)
+
+    def upstream(self) -> (str, str):
+        """Return (remote, branch) tracked by current branch"""
+        remote, _, branch = self.tracked().partition('/')
+        return remote, branch
+
+    def tracked(self) -> str:
+        """Return the remote branch tracked by current branch, like origin/master"""
+        return self.rev_parse('--abbrev-ref', '@{u}')
+
+    def remote_moved(self) -> bool:
+        """True if the remote branch is not the one known locally,
+        or if the known one is not merged in local branch"""
+        remote, branch = self.upstream()
+        known = self.rev_parse(remote + '/' + branch)
+        return self.ls_remote(remote, branch) != known or not self.is_ancestor(known, 'HEAD')
+
+    def pull(self, force:bool=False, max_age:float=None) -> bool:
+        """Pull the remote branch, return False if it was not necessary
+        because the remote has not moved since last pull.
+
+        max_age -- if the remote branch was prefetched less than max_age
+                   seconds ago, merge it without contacting the remote
+
+        """
+        with self.timed('pull'):
+            if max_age is not None and self.fetched is not None and time.monotonic() - self.fetched < max_age:
+                update = self._merge_fetched
+                if not force and self.is_ancestor(self.tracked(), 'HEAD'):
+                    return False
+            else:
+                update = self._pull
+                if not force and not self.remote_moved():
+                    return False
+            try:
+                update()
+            except GitError:
+                if not self.is_shallow():
+                    raise
+                self.ensure_history()  # the merge may need more than the tip
+                update()
+            return True
+
+    def prefetch(self) -> bool:
+        """Fetch the remote branch, without merging it.
+        Return True if it moved since last fetch."""
+        with self.timed('prefetch'):
+            remote, branch = self.upstream()
+            known = self.rev_parse(remote + '/' + branch)
+            self.fetch(remote, branch)
+            self.fetched = time.monotonic()
+            return self.rev_parse(remote + '/' + branch) != known
+
+    def _merge_fetched(self):
+        self.command('merge', '--no-edit', self.tracked())
+
+    def rebase_on_upstream(self):
+        """Fetch the remote branch and rebase local commits on it.
+        The rebase is aborted if it fails."""
+        with self.timed('rebase'):
+            try:
+                self.command('pull', '--rebase')
+            except GitError:
+                try:
+                    self.command('rebase', '--abort')
+                except GitError:
+                    pass  # the rebase did not even start
+                raise
+
+    def push_with_retry(self, max_attempts:int):
+        """Push, and if rejected because the remote moved, rebase local
+        commits on it and retry, at most max_attempts times"""
+        for attempt in range(max_attempts):
+            try:
+                self.push()
+                return
+            except GitError as err:
+                if not REG_REJECTED.search(err.message) or attempt == max_attempts - 1:
+                    raise
+            try:
+                self.rebase_on_upstream()
+            except GitError:
+                if not self.is_shallow():
+                    raise
+                self.ensure_history()  # rebase may need more than the tip
+                self.rebase_on_upstream()
+
+    def config_get(self, key:str) -> str or None:
+        """Return value of given configuration key, or None if unset"""
+        try:
+            return self.command('config', '--get', key)
+        except GitError:
+            return None
+
+    def unpushed(self) -> int:
+        """Return the number of local commits not in the remote branch"""
+        return int(self.command('rev-list', '--count', '@{u}..HEAD'))
+
+    def reachable(self) -> bool:
+        """True if the remote can be contacted"""
+        try:
+            self.ls_remote(*self.upstream())
+        except GitError:
+            return False
+        return True
+
+    def is_shallow(self) -> bool:
+        return self.rev_parse('--is-shallow-repository') == 'true'
+
+    def ensure_history(self):
+        """Fetch the whole history if the repository is a shallow clone.
+        To be called by features needing more than the last commit."""
+        with self.timed('unshallow'):
+            if self.is_shallow():
+                self.fetch('--unshallow')
+
+
+class SubprocessBackend(Backend):
+    """Run git command line in the repository directory"""
+
+    def run(self, operation:str, *args, cwd:str=None) -> str:
+        """Run git with given arguments, return its output"""
+        with self.lock:
+            proc = subprocess.run(['git', *args], cwd=cwd or self.path,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  universal_newlines=True)
+        if proc.returncode:
+            raise GitError(operation, proc.stderr or proc.stdout, proc.returncode)
+        return proc.stdout.strip()
+
+    def run_with_progress(self, operation:str, *args, progress:callable, cwd:str=None):
+        """Run git with given arguments, giving its progress to given callback"""
+        proc = subprocess.Popen(['git', *args, '--progress'], cwd=cwd or self.path,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        output, line = [], ''
+        while True:
+            char = proc.stderr.read(1)
+            if char in {'\r', '\n', ''}:
+                match = REG_PROGRESS.search(line)
+                if match:
+                    progress(match.group(1), float(match.group(2)), line.strip())
+                elif line:
+                    output.append(line)
+                line = ''
+                if not char:
+                    break
+            else:
+                line += char
+        if proc.wait():
+            raise GitError(operation, '\n'.join(output), proc.returncode)
+
+    @classmethod
+    def clone(cls, remote_url:str, target:str, shallow:bool=False,
+              sparse_paths:[str]=None, progress:callable=None) -> 'SubprocessBackend':
+        backend = cls(target)
+        args = ['clone', remote_url, target]
+        if shallow:
+            args += ['--depth', '1', '--single-branch']
+        if sparse_paths is not None:
+            args += ['--filter=blob:none', '--sparse']
+        with backend.timed('clone'):
+            if progress:
+                backend.run_with_progress('clone', *args, progress=progress, cwd='.')
+            else:
+                backend.run('clone', *args, cwd='.')
+            if sparse_paths:
+                backend.run('sparse-checkout', 'sparse-checkout', 'set', *sparse_paths)
+        return backend
+
+    def fetch(self, *args):
+        self.run('fetch', 'fetch', *args)
+
+    def command(self, name:str, *args) -> str:
+        """Run given git command, return its output"""
+        return self.run(name, name, *args)
+
+    def rev_parse(self, *args) -> str:
+        return self.command('rev-parse', *args)
+
+    def is_ancestor(self, ancestor:str, rev:str) -> bool:
+        with self.lock:
+            proc = subprocess.run(['git', 'merge-base', '--is-ancestor', ancestor, rev],
+                                  cwd=self.path, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode not in {0, 1}:
+            raise GitError('merge-base', proc.stderr, proc.returncode)
+        return proc.returncode == 0
+
+    def ls_remote(self, remote:str, branch:str) -> str:
+        with self.timed('ls-remote'):
+            output = self.run('ls-remote', 'ls-remote', remote, 'refs/heads/' + branch)
+        return output.split()[0] if output else None
+
+    def _pull(self):
+        self.run('pull', 'pull')
+
+    def commit(self, message:str, paths:[str]) -> bool:
+        """Add given paths (relative to repository) and commit them.
+        Return False if there was nothing to commit."""
+        with self.timed('commit'):
+            self.run('add', 'add', *paths)
+            if not self.run('status', 'status', '--porcelain', '--untracked-files=no'):
+                return False
+            self.run('commit', 'commit', '-m', message)
+            return True
+
+    def push(self):
+        with self.timed('push'):
+            self.run('push', 'push')
+
+
+class GitPythonBackend(Backend):
+    """Use GitPython with one Repo handle"""
+
+    def __init__(self, path:str, repo:'git.Repo'=None):
+        super().__init__(path)
+        self.repo = repo or git.Repo(path)
+
+    @classmethod
+    def clone(cls, remote_url:str, target:str, shallow:bool=False,
+              sparse_paths:[str]=None, progress:callable=None) -> 'GitPythonBackend':
+        options = {}
+        if shallow:
+            options.update(depth=1, single_branch=True)
+        if sparse_paths is not None:
+            options.update(filter='blob:none', sparse=True)
+        try:
+            start = time.perf_counter()
+            with instrument.span('git clone'):
+                repo = git.Repo.clone_from(remote_url, target, progress=_RemoteProgress(progress)
+                                           if progress else None, **options)
+                if sparse_paths:
+                    repo.git.sparse_checkout('set', *sparse_paths)
+            backend = cls(target, repo)
+            backend.timings['clone'].append(time.perf_counter() - start)
+        except git.GitCommandError as err:
+            raise GitError('clone', str(err.stderr), err.status)
+        return backend
+
+    def fetch(self, *args):
+        try:
+            with self.lock:
+                self.repo.git.fetch(*args)
+        except git.GitCommandError as err:
+            raise GitError('fetch', str(err.stderr), err.status)
+
+    def command(self, name:str, *args) -> str:
+        """Run given git command, return its output"""
+        try:
+            with self.lock:
+                return getattr(self.repo.git, name.replace('-', '_'))(*args)
+        except git.GitCommandError as err:
+            raise GitError(name, str(err.stderr), err.status)
+
+    def rev_parse(self, *args) -> str:
+        return self.command('rev-parse', *args)
+
+    def is_ancestor(self, ancestor:str, rev:str) -> bool:
+        try:
+            with self.lock:
+                return self.repo.is_ancestor(ancestor, rev)
+        except git.GitCommandError as err:
+            raise GitError('merge-base', str(err.stderr), err.status)
+
+    def ls_remote(self, remote:str, branch:str) -> str:
+        with self.timed('ls-remote'):
+            try:
+                output = self.repo.git.ls_remote(remote, 'refs/heads/' + branch)
+            except git.GitCommandError as err:
+                raise GitError('ls-remote', str(err.stderr), err.status)
+        return output.split()[0] if output else None
+
+    def _pull(self):
+        remote, branch = self.upstream()
+        try:
+            with self.lock:
+                self.repo.remote(remote).pull(branch)
+        except git.GitCommandError as err:
+            raise GitError('pull', str(err.stderr), err.status)
+
+    def commit(self, message:str, paths:[str]) -> bool:
+        """Add given paths (relative to repository) and commit them.
+        Return False if there was nothing to commit."""
+        with self.timed('commit'):
+            self.repo.index.add(paths)
+            if not self.repo.index.diff('HEAD'):
+                return False
+            self.repo.index.commit(message)
+            return True
+
+    def push(self):
+        with self.timed('push'):
+            remote, branch = self.upstream()
+            try:
+                infos = self.repo.remote(remote).push(branch)
+            except git.GitCommandError as err:
+                raise GitError('push', str(err.stderr), err.status)
+            failed = git.PushInfo.ERROR | git.PushInfo.REJECTED | git.PushInfo.REMOTE_REJECTED
+            for info in infos:
+                if info.flags & failed:
+                    raise GitError('push', info.summary)
+
+
+if git:
+    class _RemoteProgress(git.RemoteProgress):
+        """Give GitPython progress to a callback, like SubprocessBackend"""
+        STAGES = {
+            git.RemoteProgress.COUNTING: 'Counting objects',
+            git.RemoteProgress.COMPRESSING: 'Compressing objects',
+            git.RemoteProgress.RECEIVING: 'Receiving objects',
+            git.RemoteProgress.RESOLVING: 'Resolving deltas',
+            git.RemoteProgress.CHECKING_OUT: 'Updating files',
+        }
+
+        def __init__(self, callback:callable):
+            super().__init__()
+            self.callback = callback
+
+        def update(self, op_code, cur_count, max_count=None, message=''):
+            stage = self.STAGES.get(op_code & self.OP_MASK, 'Working')
+            percent = 100. * cur_count / max_count if max_count else None
+            self.callback(stage, percent, message or '')
+
+
+def backend_class() -> type:
+    """Return the backend class to use, following PIONEERS_GIT_BACKEND
+    environment variable, defaulting to GitPython when available"""
+    choice = os.environ.get('PIONEERS_GIT_BACKEND', 'gitpython' if git else 'subprocess')
+    if choice == 'gitpython' and git:
+        return GitPythonBackend
+    return SubprocessBackend
+
+
+_BACKENDS = {}  # repository path -> backend
+_BACKENDS_LOCK = threading.Lock()
+
+
+def get(path:str) -> Backend:
+    """Return the backend for repository at given path, created once per run"""
+    path = os.path.abspath(path)
+    with _BACKENDS_LOCK:
+        if path not in _BACKENDS:
+            _BACKENDS[path] = backend_class()(path)
+        return _BACKENDS[path]
+
+
+def clone(remote_url:str, target:str, shallow:bool=False,
+          sparse_paths:[str]=None, progress:callable=None) -> Backend:
+    """Clone given remote in target, return the backend for it.
+
+    shallow -- only get the last commit of the default branch
+    sparse_paths -- if not None, only checkout (and download) these paths
+                    and the files at the root of the repository
+    progress -- callable receiving (stage name, percent or None, message)
+
+    """
+    target = os.path.abspath(target)
+    backend = backend_class().clone(remote_url, target, shallow=shallow,
+                                    sparse_paths=sparse_paths, progress=progress)
+    with _BACKENDS_LOCK:
+        _BACKENDS[target] = backend
+    return backend
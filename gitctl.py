@@ -6,41 +6,245 @@ git database -- the cfg file under git control
 """
 
 import os
-import shutil
-import subprocess
-from constants import LOCAL_GIT_DIR, LOCAL_GIT_DB
+import sys
+import threading
+import shards
+import deploy
+import bloom
+import dbindex
+import pobject
+import parsecache
+import sqlite3
+import checkpoint
+import gitbackend
+import instrument
+from gitbackend import GitError
+from constants import LOCAL_GIT_DIR, LOCAL_GIT_DB, DATABASE_FILE, DATABASE_FILENAME, SPARSE_PATHS
+from constants import PUSH_REBASE_ATTEMPTS, PREFETCH_MAX_AGE
 
 
+MERGE_DRIVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mergedriver.py')
+
+
+@instrument.traced('synchronize')
 def synchronize():
     """Pull git database from remote and copy to used database.
+
+    The used database is not replaced if it holds modifications
+    made since its installation (discoveries not yet integrated).
+
     """
     #TODO: stash changes if any, or warn about it.
-    os.chdir(LOCAL_GIT_DIR)
-    subprocess.call(['git', 'pull'])
-    os.chdir('..')
-
-
-def commit_discoveries(commit_message:str):
-    """Add modifications in index, commit & push them with given message"""
-    # TODO: use a better tech for that. gitpython for instance.
-    # TODO: handle conflicts
-    os.chdir(LOCAL_GIT_DIR)
-    subprocess.call(['git', 'add', DATABASE_FILENAME])
-    subprocess.call(['git', 'commit', '-m', commit_message])
-    subprocess.call(['git', 'push'])
-    os.chdir('..')
-
-
-def update_repository():
-    """Will update the repository"""
-    # TODO: use a better tech for that. gitpython for instance.
-    # TODO: handle conflicts
-    os.chdir(LOCAL_GIT_DIR)
-    subprocess.call(['git', 'pull'])
-    os.chdir('..')
-
-
-def clone_repository(remote_url:str, target:str):
-    """Will clone the repository"""
-    # TODO: use a better tech for that. gitpython for instance.
-    subprocess.call(['git', 'clone', remote_url, target])
+    if update_repository():  # HEAD moved: the parsed database is outdated
+        parsecache.forget()
+    refresh_used_database()
+    update_index()
+    update_filter()
+
+
+@instrument.traced('update index')
+def update_index():
+    """Update the local index of the git database"""
+    try:
+        dbindex.update()
+    except (OSError, sqlite3.Error, pobject.ParseError) as err:
+        print("WARNING: local index not updated ({}).".format(err))
+
+
+@instrument.traced('update filter')
+def update_filter():
+    """Update the Bloom filter of the objects of the git database"""
+    try:
+        bloom.update()
+    except (OSError, pobject.ParseError) as err:
+        print("WARNING: filter of discovered objects not updated ({}).".format(err))
+
+
+@instrument.traced('refresh used database')
+def refresh_used_database():
+    """Install the git database as used database, unless the used database
+    holds modifications made since its installation"""
+    if shards.is_sharded():
+        shards.compile_database()
+    if not os.path.exists(DATABASE_FILE) or checkpoint.is_unchanged(DATABASE_FILE):
+        install_database()
+    else:
+        print("WARNING: the used database holds unintegrated modifications. "
+              "It is therefore not replaced by the git database.")
+
+
+@instrument.traced('install database')
+def install_database():
+    """Install git database as used database, and record its checkpoint.
+    The used database is replaced atomically, by a clone, a link or
+    a copy of the git database (see deploy module)."""
+    deploy.install(LOCAL_GIT_DB, DATABASE_FILE)
+    checkpoint.record(DATABASE_FILE)
+    instrument.current().add(bytes=os.path.getsize(DATABASE_FILE))
+
+
+def repository() -> gitbackend.Backend:
+    """Return the backend handling the local repository"""
+    return gitbackend.get(LOCAL_GIT_DIR)
+
+
+def commit_discoveries(commit_message:str, paths:[str]=None):
+    """Add modifications in index, commit & push them with given message.
+
+    paths -- files to add, relative to working directory (default: git database)
+
+    Raise GitError if any operation fails.
+
+    """
+    if commit(commit_message, paths):
+        push()
+
+
+def commit(commit_message:str, paths:[str]=None) -> bool:
+    """Add modifications in index and commit them with given message.
+    Return False if there was nothing to commit.
+
+    paths -- files to add, relative to working directory (default: git database)
+
+    """
+    paths = [os.path.relpath(path, LOCAL_GIT_DIR) for path in paths] if paths else [DATABASE_FILENAME]
+    return repository().commit(commit_message, paths)
+
+
+def has_commit_with(text:str) -> bool:
+    """True if the message of a commit of the current branch holds given text"""
+    return bool(repository().command('log', '-F', '-n1', '--format=%H', '--grep=' + text))
+
+
+def discard_database_changes():
+    """Give back to the database files their commited content"""
+    discard_changes(shards.shard_files() if shards.is_sharded() else [LOCAL_GIT_DB])
+
+
+def discard_changes(paths:[str]):
+    """Give back to given files their commited content, in index and
+    working tree. Files of the sharded layout are compiled again."""
+    paths = [os.path.relpath(path, LOCAL_GIT_DIR) for path in paths]
+    repo = repository()
+    tracked = set(repo.command('ls-tree', '--name-only', 'HEAD', '--', *paths).splitlines())
+    repo.command('reset', '-q', 'HEAD', '--', *paths)
+    if tracked:
+        repo.command('checkout', '--', *tracked)
+    for path in set(paths) - tracked:  # created by the discoveries
+        os.remove(os.path.join(LOCAL_GIT_DIR, path))
+    if shards.is_sharded():
+        shards.compile_database(force=True)
+
+
+def push(max_attempts:int=PUSH_REBASE_ATTEMPTS):
+    """Push local commits to remote. If the remote moved, local commits
+    are rebased on it, and the push retried, at most max_attempts times.
+    Concurrent modifications of the database are merged record by record
+    by the Pioneers merge driver."""
+    register_merge_driver()
+    repository().push_with_retry(max_attempts)
+
+
+def register_merge_driver():
+    """Make git use mergedriver.py to merge the database files"""
+    repo = repository()
+    driver = '"{}" "{}" %O %A %B %P'.format(sys.executable, MERGE_DRIVER_SCRIPT)
+    if repo.config_get('merge.pioneers.driver') == driver:
+        return
+    repo.command('config', 'merge.pioneers.name', 'Pioneers record-level merge')
+    repo.command('config', 'merge.pioneers.driver', driver)
+    attributes = os.path.join(repo.command('rev-parse', '--git-dir'), 'info', 'attributes')
+    attributes = os.path.join(LOCAL_GIT_DIR, attributes) if not os.path.isabs(attributes) else attributes
+    os.makedirs(os.path.dirname(attributes), exist_ok=True)
+    try:
+        with open(attributes) as fd:
+            present = set(fd.read().splitlines())
+    except FileNotFoundError:
+        present = set()
+    lines = ['{} merge=pioneers'.format(DATABASE_FILENAME), 'shards/*.cfg merge=pioneers']
+    missing = [line for line in lines if line not in present]
+    if missing:
+        with open(attributes, 'a') as fd:
+            fd.write(''.join(line + '\n' for line in missing))
+
+
+def push_with_backoff(max_attempts:int, base_delay:float,
+                      cancelled:threading.Event=None) -> bool:
+    """Try to push local commits, waiting base_delay, then twice that,
+    and so on, between attempts.
+    Return False if all attempts failed, or if cancelled was set
+    (the wait is then interrupted)."""
+    cancelled = cancelled or threading.Event()
+    for attempt in range(max_attempts):
+        if attempt and cancelled.wait(base_delay * 2 ** (attempt - 1)):
+            return False
+        if cancelled.is_set():
+            return False
+        if not remote_reachable():
+            continue
+        try:
+            push()
+            return True
+        except GitError:
+            pass
+    return False
+
+
+def has_unpushed_commits() -> bool:
+    return repository().unpushed() > 0
+
+
+def remote_reachable() -> bool:
+    return repository().reachable()
+
+
+def update_repository() -> bool:
+    """Will update the repository, if the remote moved since last pull.
+    If it was prefetched recently, the remote is not contacted.
+    Return True if a pull was performed."""
+    register_merge_driver()
+    detach_git_database()
+    return repository().pull(max_age=PREFETCH_MAX_AGE)
+
+
+def prefetch() -> bool:
+    """Fetch the remote database without touching the local one.
+    Return True if it moved since last fetch. Raise GitError on failure."""
+    return repository().prefetch()
+
+
+def detach_git_database():
+    """After an installation by hardlink, SpaceEngine writes in the git
+    database too. Give back to the git database its own content, in another
+    file, so it can be compared to the used database, and modified."""
+    if not deploy.same_file(LOCAL_GIT_DB, DATABASE_FILE):
+        return
+    if shards.is_sharded():  # git database is not versionned, but compiled
+        shards.compile_database(force=True)
+    else:  # git writes a new file, leaving the used database alone
+        repository().command('checkout', '--', DATABASE_FILENAME)
+
+
+def recover_interrupted_writes():
+    """Remove the temporary files left by an interrupted run"""
+    for temp in deploy.recover():
+        print("Temporary file {} of an interrupted run removed.".format(temp))
+
+
+def clone_repository(remote_url:str, target:str, shallow:bool=False,
+                     progress:callable=None):
+    """Will clone the repository.
+
+    shallow -- only get the last version of the database files, not the history
+    progress -- callable receiving (stage name, percent or None, message)
+
+    """
+    gitbackend.clone(remote_url, target, shallow=shallow,
+                     sparse_paths=SPARSE_PATHS if shallow else None,
+                     progress=progress)
+
+
+def ensure_history():
+    """Get the whole history of the repository, if it was cloned
+    with shallow option"""
+    repository().ensure_history()
@@ -4,13 +4,22 @@ a tkinter gui.
 """
 
 import os
+import time
+import queue
+import argparse
 import textwrap
+import threading
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import font
 from enum import Enum
 
 import routines
 import gitctl
+import prefetch
+import daemonclient
+import proctracker
+import instrument
 
 
 class State:
@@ -38,6 +47,8 @@ SE_STATE_AS_COLOR = {
 }
 SE_STATES = frozenset(SE_STATE_AS_COLOR.keys())
 
+POLL_DELAY = 50  # ms between two reads of the worker messages
+
 TEXT_WIDTH, TEXT_HEIGHT = 50, 7
 TEXT_AT_START = (
     '#' * TEXT_WIDTH
@@ -46,6 +57,136 @@ TEXT_AT_START = (
 )
 
 
+def progress_message(stage:str, percent:float or None, message:str) -> str:
+    """Return the message to show for given progress of a git operation"""
+    return stage if percent is None else '{}: {:.0f}%'.format(stage, percent)
+
+
+class Cancelled(Exception):
+    """Raised in a task when its cancellation is detected"""
+
+
+class Task:
+    """Sequence of named phases, run by a TaskRunner on a worker thread.
+
+    Each phase is a callable receiving the task, and can use its report
+    method to send progress messages, and its results attribute
+    to access results of previous phases.
+
+    A cancelled task stops after its current phase. Git operations
+    are not interrupted, since that would leave the repository
+    in an intermediate state, but phases can give the cancelled event
+    to the waits between push attempts.
+
+    """
+
+    def __init__(self, phases:[(str, callable)], on_progress:callable=None,
+                 on_done:callable=None, on_error:callable=None, on_cancel:callable=None):
+        self.phases = tuple(phases)
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self.results = {}  # phase name -> returned value
+        self.timings = {}  # phase name -> duration in seconds
+        self.cancelled = threading.Event()
+        self.messages = None  # set by the runner
+
+    def report(self, message:str):
+        """Send given progress message to the main thread"""
+        self.messages.put((self.on_progress, (message,)))
+
+    def cancel(self):
+        """Stop the task after the current step"""
+        self.cancelled.set()
+
+    def run(self):
+        """Run the phases, then give the result to the callbacks"""
+        try:
+            for name, phase in self.phases:
+                if self.cancelled.is_set():
+                    raise Cancelled()
+                start = time.perf_counter()
+                with instrument.span('phase ' + name):
+                    self.results[name] = phase(self)
+                self.timings[name] = time.perf_counter() - start
+        except Cancelled:
+            self.messages.put((self.on_cancel, ()))
+        except Exception as err:
+            self.messages.put((self.on_error, (err,)))
+        else:
+            self.messages.put((self.on_done, (self.results,)))
+
+
+class TaskRunner:
+    """Run tasks outside of the tk main thread, and their callbacks inside it.
+
+    Tasks are run one at a time by a worker thread. Short calls
+    (see call method) use another worker, so they are not delayed
+    by a long task.
+
+    """
+
+    def __init__(self, widget:tk.Widget, poll_delay:int=POLL_DELAY):
+        self.widget = widget
+        self.poll_delay = poll_delay
+        self.messages = queue.Queue()  # (callback, args) to run in main thread
+        self.tasks = ThreadPoolExecutor(max_workers=1)
+        self.calls = ThreadPoolExecutor(max_workers=1)
+        self.current = None
+        self.widget.after(self.poll_delay, self._poll)
+
+    @property
+    def busy(self) -> bool:
+        return self.current is not None
+
+    def run(self, task:Task) -> Task:
+        task.messages = self.messages
+        self.current = task
+        self.tasks.submit(task.run)
+        return task
+
+    def call(self, func:callable, callback:callable, on_error:callable=None):
+        """Run func in a worker, then give its result to callback,
+        or the exception it raised to on_error (printed if none)"""
+        def work():
+            try:
+                result = func()
+            except Exception as err:
+                if on_error is None:
+                    print("ERROR: {} failed ({}).".format(getattr(func, '__name__', func), err))
+                self.messages.put((on_error, (err,)))
+            else:
+                self.messages.put((callback, (result,)))
+        self.calls.submit(work)
+
+    def notify(self, callback:callable, *args):
+        """Run callback in main thread. Can be called from any thread."""
+        self.messages.put((callback, args))
+
+    def cancel(self):
+        if self.current:
+            self.current.cancel()
+
+    def shutdown(self):
+        self.cancel()
+        self.tasks.shutdown(wait=False)
+        self.calls.shutdown(wait=False)
+
+    def _poll(self):
+        while True:
+            try:
+                callback, args = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if self.current and callback in {self.current.on_done, self.current.on_error,
+                                             self.current.on_cancel}:
+                self.current = None
+            if callback:
+                callback(*args)
+        self.widget.after(self.poll_delay, self._poll)
+
+
 class Application(tk.Frame):
     """Allow user to explore the lattice of an input context.
 
@@ -58,7 +199,11 @@ class Application(tk.Frame):
         super().__init__(master)
         self.master.wm_title(DEFAULT_WM_TITLE)
         self.state = State.Starting
+        self.current_se_state = 'unknow'
+        self.runner = TaskRunner(self)
+        self.prefetcher = prefetch.Prefetcher()  # while SpaceEngine runs
         self.create_widgets()
+        self.follow_se_state()
 
     def create_widgets(self):
         if hasattr(self, 'current_text'):
@@ -89,7 +234,7 @@ class Application(tk.Frame):
         self.render_se_state()
         self.lab_se_state = tk.Label(self.middle_frame, width=2*TEXT_WIDTH//3,
                                      textvariable=self.str_se_state, font=state_font,
-                                     fg=SE_STATE_AS_COLOR[self.se_state()])
+                                     fg=SE_STATE_AS_COLOR[self.current_se_state])
         self.lab_se_state.pack(side="left")
         self.middle_frame.pack()
 
@@ -115,6 +260,10 @@ class Application(tk.Frame):
 
     def next_step(self, _):
         """Compute the next step, ensure user knows it"""
+        if self.runner.busy:  # the button cancels the running operation
+            self.info("Cancelling after the current step…")
+            self.runner.cancel()
+            return
         new_state = None  # to be set if state change necessary
         if self.state is State.Starting:
             missing_dirs = set(routines.missings_in_working_directory())
@@ -129,37 +278,96 @@ class Application(tk.Frame):
                 )
                 new_state = State.DoneWithError
             else:
-                if not routines.initialization_done():
-                    self.info("Initialization not performed. Will do…")
-                    routines.initialize()
-                self.info("Synchronize with remote repository…")
-                gitctl.synchronize()
-                self.log("Synchronization performed.")
-                new_state = State.WaitSE
+                self.run_task(self.initialization_phases(), State.WaitSE,
+                              "Synchronization performed.", "ERROR: restart needed.")
 
         elif self.state is State.WaitSE:
-            if self.se_state() == 'running':
+            if self.current_se_state == 'running':
                 self.button_next['background'] = COLOR_ERR
                 self.err('SpaceEngine is running ! Quit it before !')
             else:
-                self.info("Merge with remote database…")
-                discoveries = tuple(routines.user_discoveries())
-                gitctl.synchronize()
-                if discoveries:
-                    self.info("{} discoveries detected. They will be send.".format(len(discoveries)))
-                    routines.integrate_discoveries_to_pioneers(discoveries)
-                self.log("Merge performed. Thank you !")
-                new_state = State.Done
+                self.prefetcher.stop()
+                self.run_task(self.merge_phases(), State.Done,
+                              "Merge performed. Thank you !", "ERROR: merge failed.")
 
         elif self.state is State.Done:
             self.quit()
         elif self.state is State.DoneWithError:
             self.quit()
 
-        if new_state is not self.state:
+        if new_state and new_state is not self.state:
             self.state = new_state
             self.render_state()
 
+    def daemon_phase(self, name:str, command:str) -> [(str, callable)]:
+        """Phase sending given command to the daemon of the install"""
+        def run(task):
+            task.report("Sent to the Pioneers daemon…")
+            with daemonclient.DaemonClient() as client:
+                answer = client.call(command)
+            for line in answer['output'].splitlines():
+                task.report(line)
+        return [(name, run)]
+
+    def initialization_phases(self) -> [(str, callable)]:
+        """Phases of the task initializing and synchronizing Pioneers"""
+        if daemonclient.running():  # initialized, and kept up to date
+            return self.daemon_phase('sync', 'sync')
+        def initialize(task):
+            if not routines.initialization_done():
+                task.report("Initialization not performed. Will do…")
+                routines.initialize(progress=lambda *args: task.report(progress_message(*args)))
+        def synchronize(task):
+            task.report("Synchronize with remote repository…")
+            gitctl.synchronize()
+        return [('init', initialize), ('sync', synchronize)]
+
+    def merge_phases(self) -> [(str, callable)]:
+        """Phases of the task sending discoveries to the remote repository"""
+        if daemonclient.running():
+            return self.daemon_phase('push', 'publish')
+        def detect(task):
+            task.report("Merge with remote database…")
+            return tuple(routines.user_discoveries())
+        def synchronize(task):
+            try:
+                gitctl.synchronize()
+            except gitctl.GitError as err:  # discoveries will wait in the outbox
+                task.report("WARNING: {}".format(err))
+        def publish(task):
+            discoveries = task.results['diff']
+            if discoveries:
+                task.report("{} discoveries detected. They will be send.".format(len(discoveries)))
+                routines.integrate_discoveries_to_pioneers(discoveries, cancelled=task.cancelled)
+            else:  # discoveries of previous sessions may wait in the outbox
+                routines.publish_outbox(cancelled=task.cancelled)
+        return [('diff', detect), ('sync', synchronize), ('push', publish)]
+
+    def run_task(self, phases:[(str, callable)], next_state:State,
+                 success:str, failure:str):
+        """Run given phases in background, then go to next_state"""
+        def on_done(_):
+            timings = ', '.join('{} {:.1f}s'.format(name, duration)
+                                for name, duration in task.timings.items())
+            self.log('{} ({})'.format(success, timings))
+            if next_state is State.WaitSE and not daemonclient.running():  # else, the daemon prefetches
+                self.prefetcher.start()
+            self.state = next_state
+            self.render_state()
+        def on_error(err):
+            self.err(failure)
+            self.set_current_text(str(err))
+            self.state = State.DoneWithError
+            self.render_state()
+        def on_cancel():
+            self.render_state()
+            self.log("Cancelled. Hit the button to retry.")
+        task = Task(phases, on_progress=self.info, on_done=on_done,
+                    on_error=on_error, on_cancel=on_cancel)
+        self.runner.run(task)
+        self.set_current_text('Working… Hit the button below to cancel after the current step.')
+        self.set_str_next_step('Stop after step')
+
 
     def render_state(self):
         """Modify widgets to represent the current state"""
@@ -193,8 +401,36 @@ class Application(tk.Frame):
             False: 'unknow'
         }.get(routines.detect_spaceengine_pid(), 'running')
 
+    def follow_se_state(self):
+        """Detect the state of SpaceEngine in background, then follow
+        its starts and stops with the process tracker"""
+        def update(state):
+            self.current_se_state = state
+            self.render_se_state()
+            tracker.start()
+        def failed(err):
+            self.err("ERROR: SpaceEngine state not detected ({}).".format(err))
+            update('unknow')
+        tracker = proctracker.tracker()
+        tracker.on_start = lambda pid: self.runner.notify(self.on_se_start, pid)
+        tracker.on_stop = lambda pid: self.runner.notify(self.on_se_stop, pid)
+        self.runner.call(self.se_state, update, failed)
+
+    def on_se_start(self, pid:int):
+        self.current_se_state = 'running'
+        self.render_se_state()
+
+    def on_se_stop(self, pid:int):
+        """SpaceEngine stopped: merge, if user was waiting for that"""
+        self.current_se_state = 'stopped'
+        self.render_se_state()
+        if self.state is State.WaitSE and not self.runner.busy:
+            self.next_step(None)
+
     def render_se_state(self):
-        self.str_se_state.set('Space Engine is ' + self.se_state())
+        self.str_se_state.set('Space Engine is ' + self.current_se_state)
+        if hasattr(self, 'lab_se_state'):
+            self.lab_se_state.configure(fg=SE_STATE_AS_COLOR[self.current_se_state])
 
     def err(self, msg:str):
         """Report given error message to user"""
@@ -216,5 +452,14 @@ class Application(tk.Frame):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profile', type=str, default=None, metavar='FILE',
+                        help='Write duration, memory and counts of each phase in FILE')
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable(args.profile)
+    if not daemonclient.running():  # else, its files are being written
+        gitctl.recover_interrupted_writes()
     gui = Application()
     gui.mainloop()
+    gui.runner.shutdown()
@@ -0,0 +1,221 @@
+"""Map of the explored universe, built from the whole database.
+
+Positions are decoded from the RS codes of stars, assumed to follow
+the SpaceEngine layout:
+
+    RS <galaxy, 4 components>-<sector>-<level>-<block>-<star>[-...]
+
+where block is the index of a cell of the octree of the galaxy at given
+level, the bits of its x, y and z coordinates being interleaved
+(Morton order). Other objects are counted, but not placed on the map.
+Cells are projected on the (x, y) plane of their galaxy, in a grid
+of MAP_RESOLUTION² pixels.
+
+Records are read and aggregated by chunks, so the memory used does not
+depend on the size of the database. NumPy is used if available.
+
+The exported map is a directory holding index.json (totals, discoveries
+per day, list of layers), one PNG image per galaxy, and JSON tiles
+of the density grid of each galaxy and each pioneer.
+
+"""
+
+import os
+import re
+import json
+import math
+import zlib
+import struct
+import itertools
+from array import array
+from collections import Counter
+import pobject
+from constants import LOCAL_GIT_DB, MAP_RESOLUTION, MAP_CHUNK_SIZE, MAP_TILE_SIZE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAX_LEVEL = 20  # deepest octree level whose blocks fit in 63 bits
+UNKNOWN_PIONEER = '?'
+REG_STAR_CODE = re.compile(r'RS[ \t]+((?:\d+-){3}\d+)-\d+-(\d{1,2})-(\d{1,18})-\d+(?:-\d+)*')
+# star codes of a chunk of LocNames, one per line: empty groups for other lines
+REG_STAR_LINES = re.compile(r'^[ \t]*(?:{}[ \t]*$|.*)'.format(REG_STAR_CODE.pattern), re.MULTILINE)
+
+
+def decode_star(locname:str) -> (str, int, int) or None:
+    """Return galaxy, level and block of given star code,
+    or None if it is not one"""
+    match = REG_STAR_CODE.fullmatch(locname.strip())
+    if not match:
+        return None
+    galaxy, level, block = match.group(1), int(match.group(2)), int(match.group(3))
+    if level > MAX_LEVEL or block >= 1 << (3 * level):
+        return None
+    return galaxy, level, block
+
+
+def morton_xy(block:int, level:int) -> (int, int):
+    """Return the x and y coordinates of given octree block"""
+    x = y = 0
+    for bit in range(level):
+        x |= ((block >> (3 * bit)) & 1) << bit
+        y |= ((block >> (3 * bit + 1)) & 1) << bit
+    return x, y
+
+
+class ExplorationMap:
+    """Density grids of discoveries, per galaxy and per pioneer,
+    and number of discoveries per day.
+
+    Grids are flat arrays of resolution² counters, row after row.
+
+    """
+
+    def __init__(self, resolution:int=MAP_RESOLUTION):
+        self.resolution = resolution
+        self.galaxies = {}  # galaxy -> grid
+        self.pioneers = {}  # pioneer -> grid
+        self.pioneer_counts = Counter()
+        self.days = Counter()  # day (YYYY.MM.DD) -> discoveries
+        self.total = 0
+        self.unplaced = 0  # discoveries without a position
+
+    def _grid(self, grids:dict, name:str):
+        if name not in grids:
+            size = self.resolution * self.resolution
+            grids[name] = numpy.zeros(size, dtype=numpy.uint32) if numpy else array('L', [0]) * size
+        return grids[name]
+
+    def add_records(self, records:[pobject.PObject], chunk_size:int=MAP_CHUNK_SIZE):
+        """Aggregate given records, chunk after chunk"""
+        records = iter(records)
+        while True:
+            chunk = tuple(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            self.add_chunk(chunk)
+
+    def add_chunk(self, records:[pobject.PObject]):
+        self.total += len(records)
+        self.days.update((record.date or '')[:10] for record in records)
+        pioneers = [record.pioneer or UNKNOWN_PIONEER for record in records]
+        self.pioneer_counts.update(pioneers)
+        locnames = [record.locname or '' for record in records]
+        if numpy:
+            self._add_numpy(locnames, pioneers)
+            return
+        for locname, pioneer in zip(locnames, pioneers):
+            star = decode_star(locname)
+            if star is None:
+                self.unplaced += 1
+                continue
+            galaxy, level, block = star
+            x, y = morton_xy(block, level)
+            cell = (y * self.resolution >> level) * self.resolution + (x * self.resolution >> level)
+            self._grid(self.galaxies, galaxy)[cell] += 1
+            self._grid(self.pioneers, pioneer)[cell] += 1
+
+    def _add_numpy(self, locnames:[str], pioneers:[str]):
+        """Aggregate given columns, decoded all at once"""
+        columns = REG_STAR_LINES.findall('\n'.join(locnames))
+        if len(columns) != len(locnames):  # a LocName holds a newline
+            columns = [decode_star(locname) or ('', '0', '0') for locname in locnames]
+        galaxies, levels, blocks = (numpy.array(column) for column in zip(*columns))
+        placed = galaxies != ''
+        levels = numpy.where(placed, levels, '0').astype(numpy.int64)
+        blocks = numpy.where(placed, blocks, '0').astype(numpy.int64)
+        placed &= (levels <= MAX_LEVEL) & (blocks < numpy.left_shift(1, 3 * numpy.minimum(levels, MAX_LEVEL)))
+        self.unplaced += len(locnames) - int(placed.sum())
+        levels, blocks = levels[placed], blocks[placed]
+        x = numpy.zeros_like(blocks)
+        y = numpy.zeros_like(blocks)
+        for bit in range(int(levels.max(initial=0))):
+            x |= ((blocks >> (3 * bit)) & 1) << bit
+            y |= ((blocks >> (3 * bit + 1)) & 1) << bit
+        cells = ((y * self.resolution) >> levels) * self.resolution + ((x * self.resolution) >> levels)
+        self._count_numpy(self.galaxies, galaxies[placed], cells)
+        self._count_numpy(self.pioneers, numpy.array(pioneers)[placed], cells)
+
+    def _count_numpy(self, grids:dict, names:'numpy.ndarray', cells:'numpy.ndarray'):
+        """Add each cell in the grid of its name"""
+        if not len(cells):
+            return
+        names, groups = numpy.unique(names, return_inverse=True)
+        order = numpy.argsort(groups, kind='stable')
+        groups, cells = groups[order], cells[order]
+        bounds = numpy.flatnonzero(numpy.diff(groups)) + 1
+        for start, group_cells in zip(numpy.r_[0, bounds], numpy.split(cells, bounds)):
+            numpy.add.at(self._grid(grids, str(names[groups[start]])), group_cells, 1)
+
+    def export(self, directory:str, tile_size:int=MAP_TILE_SIZE) -> str:
+        """Write the map in given directory, return the path of its index"""
+        os.makedirs(directory, exist_ok=True)
+        layers = {}
+        for kind, grids in (('galaxy', self.galaxies), ('pioneer', self.pioneers)):
+            for name, grid in sorted(grids.items()):
+                layer = '{}-{}'.format(kind, re.sub(r'[^\w.-]', '_', str(name)))
+                layers[layer] = {'kind': kind, 'name': name,
+                                 'tiles': self._write_tiles(grid, os.path.join(directory, 'tiles', layer), tile_size)}
+                if kind == 'galaxy':
+                    layers[layer]['image'] = layer + '.png'
+                    write_png(os.path.join(directory, layer + '.png'), grid, self.resolution)
+        index = {
+            'resolution': self.resolution, 'tile_size': tile_size,
+            'total': self.total, 'unplaced': self.unplaced,
+            'pioneers': dict(self.pioneer_counts.most_common()),
+            'days': sorted(self.days.items()),
+            'layers': layers,
+        }
+        path = os.path.join(directory, 'index.json')
+        with open(path, 'w') as fd:
+            json.dump(index, fd)
+        return path
+
+    def _write_tiles(self, grid, directory:str, tile_size:int) -> [str]:
+        """Write the non-empty tiles of given grid, return their names"""
+        os.makedirs(directory, exist_ok=True)
+        rows = _rows(grid, self.resolution)
+        names = []
+        for ty in range(0, self.resolution, tile_size):
+            for tx in range(0, self.resolution, tile_size):
+                counts = [row[tx:tx+tile_size] for row in rows[ty:ty+tile_size]]
+                if not any(any(row) for row in counts):
+                    continue
+                name = '{}-{}.json'.format(tx // tile_size, ty // tile_size)
+                with open(os.path.join(directory, name), 'w') as fd:
+                    json.dump({'x': tx // tile_size, 'y': ty // tile_size, 'counts': counts}, fd)
+                names.append(name)
+        return names
+
+
+def _rows(grid, resolution:int) -> [[int]]:
+    """Return given flat grid as a list of rows of int"""
+    values = grid.tolist()
+    return [values[start:start+resolution] for start in range(0, len(values), resolution)]
+
+
+def write_png(filename:str, grid, resolution:int):
+    """Write given grid as a grayscale PNG image, in logarithmic scale"""
+    rows = _rows(grid, resolution)
+    scale = 255 / math.log1p(max(map(max, rows)) or 1)
+    raw = b''.join(b'\x00' + bytes(int(math.log1p(count) * scale) for count in row)
+                   for row in reversed(rows))  # y axis goes up
+    def chunk(kind:bytes, data:bytes) -> bytes:
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    with open(filename, 'wb') as fd:
+        fd.write(b'\x89PNG\r\n\x1a\n')
+        fd.write(chunk(b'IHDR', struct.pack('>IIBBBBB', resolution, resolution, 8, 0, 0, 0, 0)))
+        fd.write(chunk(b'IDAT', zlib.compress(raw, 9)))
+        fd.write(chunk(b'IEND', b''))
+
+
+def build(database:str=LOCAL_GIT_DB, resolution:int=MAP_RESOLUTION,
+          chunk_size:int=MAP_CHUNK_SIZE) -> ExplorationMap:
+    """Return the map of given database"""
+    exploration = ExplorationMap(resolution)
+    exploration.add_records(pobject.parse_file(database), chunk_size)
+    return exploration
@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+"""Pioneers hub: a service committing the discoveries of many explorers.
+
+Without hub, each explorer pulls, commits and pushes the database by themselves,
+and needs the rights to push on the central repository. With a hub, explorers
+only send their discoveries to it (see pioneers.py --hub), and the hub is
+the only one writing in the database:
+
+- discoveries are validated, and kept in memory, one record per object:
+  those already in the database are dropped, and among those received
+  since the last batch, the first explorer wins,
+- every HUB_BATCH_INTERVAL seconds, a single writer commits all received
+  records at once, through the outbox, and pushes them. With --packs,
+  the resulting database is also published as delta packs (see packs.py).
+
+The hub is a small HTTP/1.1 service, keeping connections alive:
+
+    POST /discoveries   body: records in the database format
+                        answer: {"accepted": <int>, "duplicates": <int>}
+    GET  /status        answer: counts of records pending, known and commited
+
+Usage: run it in a directory that will hold the hub's clone of the database.
+
+    python hub.py [--remote URL] [--port 8765] [--interval 10] [--packs DIR]
+
+Records received since the last batch are lost if the hub is killed:
+they are committed when it is stopped with ctrl-c.
+
+"""
+
+import os
+import json
+import asyncio
+import argparse
+import concurrent.futures
+from http import HTTPStatus
+import gitctl
+import outbox
+import packs
+import shards
+import pobject
+import parsecache
+import routines
+import validator
+import instrument
+from mergedriver import DATE_OF_UNDATED
+from constants import LOCAL_GIT_DIR, LOCAL_GIT_DB, REMOTE_GIT_DB
+from constants import HUB_HOST, HUB_PORT, HUB_BATCH_INTERVAL, VALIDATION_MAX_BYTES
+
+
+class Hub:
+    """Discoveries received from explorers, and their periodic commit.
+
+    Must be used from the thread running its event loop: git operations
+    are run by a single writer thread.
+
+    """
+
+    def __init__(self, interval:float=HUB_BATCH_INTERVAL, max_bytes:int=VALIDATION_MAX_BYTES,
+                 packs_dir:str=None):
+        self.interval = interval
+        self.packs_dir = packs_dir  # where versions of the database are published, if any
+        self.max_bytes = max_bytes
+        self.known = set()  # objects in the database, or in a batch being commited
+        self.pending = {}  # object -> (record, text), waiting for the next batch
+        self.commited = 0  # records commited since the start
+        self.batches = 0
+        self.retry = False  # last batch is not fully commited and pushed
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.flush_lock = None  # created in the event loop
+
+    async def load(self):
+        """Read the objects already in the git database"""
+        loop = asyncio.get_running_loop()
+        self.known = await loop.run_in_executor(self.writer, _known_objects)
+        self.retry = await loop.run_in_executor(self.writer, _unpublished)  # by a previous run
+        if self.packs_dir:
+            await loop.run_in_executor(self.writer, _publish_packs, self.packs_dir)
+        print("Hub ready: {} objects already discovered.".format(len(self.known)))
+
+    def accept(self, data:bytes) -> (int, int):
+        """Keep the new records of given discoveries for the next batch.
+        Return the numbers of records accepted and of duplicates.
+        Raise ValidationError if data is not valid."""
+        validator.validate(data, max_bytes=self.max_bytes)
+        accepted = duplicates = 0
+        for record in pobject.parse(data):
+            key = pobject.record_key(record)
+            if key in self.known:
+                duplicates += 1
+                continue
+            previous = self.pending.get(key)
+            if previous is not None:
+                duplicates += 1
+                if (previous[0].date or DATE_OF_UNDATED) <= (record.date or DATE_OF_UNDATED):
+                    continue  # first explorer wins
+            else:
+                accepted += 1
+            text = data[record.offset:record.offset+record.length].decode(pobject.ENCODING)
+            self.pending[key] = record, text.strip() + '\n'
+        return accepted, duplicates
+
+    def status(self) -> dict:
+        return {'pending': len(self.pending), 'known': len(self.known),
+                'commited': self.commited, 'batches': self.batches}
+
+    async def flush(self):
+        """Commit and push the records received since the last batch"""
+        if self.flush_lock is None:
+            self.flush_lock = asyncio.Lock()
+        async with self.flush_lock:
+            if not self.pending and not self.retry:
+                return
+            batch, self.pending = self.pending, {}
+            self.known.update(batch)  # received from now, they are duplicates
+            discoveries = ''.join(text for _, text in batch.values())
+            loop = asyncio.get_running_loop()
+            try:
+                self.retry = await loop.run_in_executor(self.writer, _publish, discoveries,
+                                                        self.packs_dir)
+            except Exception as err:  # kept in the outbox, retried with next batch
+                print("WARNING: batch not published: {}".format(err))
+                self.retry = True
+                return
+            self.commited += len(batch)
+            self.batches += 1
+
+    async def write_batches(self):
+        """Flush periodically, forever"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def route(self, method:str, path:str, body:bytes) -> (HTTPStatus, dict):
+        """Return status and JSON answer of given request"""
+        path = path.split('?', 1)[0].rstrip('/')
+        if path == '/discoveries':
+            if method != 'POST':
+                return HTTPStatus.METHOD_NOT_ALLOWED, {'error': 'use POST'}
+            try:
+                accepted, duplicates = self.accept(body)
+            except (validator.ValidationError, pobject.ParseError) as err:
+                return HTTPStatus.BAD_REQUEST, {'error': str(err)}
+            return HTTPStatus.OK, {'accepted': accepted, 'duplicates': duplicates}
+        if path == '/status':
+            return HTTPStatus.OK, self.status()
+        return HTTPStatus.NOT_FOUND, {'error': 'unknown path ' + path}
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        """Answer the requests sent on given connection, until it is closed"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > self.max_bytes:
+                    await _respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                   {'error': 'more than {} bytes'.format(self.max_bytes)}, False)
+                    break
+                body = await reader.readexactly(length)
+                status, answer = self.route(method, path, body)
+                keep_alive = (version == 'HTTP/1.1'
+                              and headers.get('connection', '').lower() != 'close')
+                await _respond(writer, status, answer, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass  # malformed request, or client gone
+        finally:
+            writer.close()
+
+    async def serve(self, host:str=HUB_HOST, port:int=HUB_PORT,
+                    started:callable=None):
+        """Serve until cancelled, then commit the last records.
+
+        started -- called with the server once it listens
+
+        """
+        await self.load()
+        server = await asyncio.start_server(self.handle, host, port)
+        batches = asyncio.ensure_future(self.write_batches())
+        if started:
+            started(server)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches.cancel()
+            await self.flush()
+            self.writer.shutdown()
+
+
+async def _respond(writer:asyncio.StreamWriter, status:HTTPStatus, answer:dict, keep_alive:bool):
+    body = json.dumps(answer).encode()
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                 'Content-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                     status.value, status.phrase, len(body),
+                     'keep-alive' if keep_alive else 'close').encode('latin-1') + body)
+    await writer.drain()
+
+
+def _known_objects() -> {str}:
+    if shards.is_sharded():
+        shards.compile_database()
+    if not os.path.exists(LOCAL_GIT_DB):
+        return set()
+    return set(parsecache.keys(LOCAL_GIT_DB)) - {None}
+
+
+@instrument.traced('hub batch')
+def _publish(discoveries:str, packs_dir:str=None) -> bool:
+    """Commit and push given discoveries, with those of batches not
+    yet published. Return True if some are still not published."""
+    if discoveries:
+        outbox.Outbox().enqueue(discoveries)
+    routines.publish_outbox(install=False)
+    if packs_dir:
+        _publish_packs(packs_dir)
+    return _unpublished()
+
+
+def _publish_packs(directory:str):
+    version = packs.publish(LOCAL_GIT_DB, directory)
+    if version is not None:
+        print("Version {} of the database published in {}.".format(version, directory))
+
+
+def _unpublished() -> bool:
+    """True if discoveries are waiting to be commited or pushed"""
+    return bool(outbox.Outbox().pending()) or gitctl.has_unpushed_commits()
+
+
+def cli_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--remote', type=str, default=REMOTE_GIT_DB,
+                        help='url of the centralized database, cloned if needed')
+    parser.add_argument('--host', type=str, default=HUB_HOST)
+    parser.add_argument('--port', type=int, default=HUB_PORT)
+    parser.add_argument('--interval', type=float, default=HUB_BATCH_INTERVAL,
+                        help='seconds between two commits of the received discoveries')
+    parser.add_argument('--packs', type=str, default=None, metavar='DIR',
+                        help='publish each version of the database as delta packs in DIR')
+    parser.add_argument('--profile', type=str, default=None, metavar='FILE',
+                        help='Write duration, memory and counts of each phase in FILE')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = cli_args()
+    if args.profile:
+        instrument.enable(args.profile)
+    gitctl.recover_interrupted_writes()
+    if not os.path.exists(LOCAL_GIT_DIR):
+        print("Clone Pioneers database… ", end='', flush=True)
+        gitctl.clone_repository(args.remote, target=LOCAL_GIT_DIR, shallow=True)
+        print("Done !")
+    print("Serving on http://{}:{}/ (ctrl-c to stop)".format(args.host, args.port))
+    try:
+        asyncio.run(Hub(args.interval, packs_dir=args.packs).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,107 @@
+"""Client of a Pioneers hub (see hub.py).
+
+Connections to the hub are kept open between requests (HTTP keep-alive),
+and shared among threads through a small pool, so sending many
+discoveries does not pay a TCP handshake for each of them.
+
+"""
+
+import json
+import threading
+import http.client
+import urllib.parse
+from constants import HUB_POOL_SIZE, HUB_TIMEOUT
+
+
+class HubError(Exception):
+    """Raised when the hub answers with an error status"""
+    def __init__(self, status:int, reason:str):
+        super().__init__('hub answered {}: {}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+
+    @property
+    def rejected(self) -> bool:
+        """True if the request itself is refused, and would be again"""
+        return 400 <= self.status < 500
+
+
+class HubClient:
+    """Send requests to the hub at given url, like http://localhost:8765"""
+
+    def __init__(self, url:str, pool_size:int=HUB_POOL_SIZE, timeout:float=HUB_TIMEOUT):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ValueError("Invalid hub url {!r}, expected like http://host:port".format(url))
+        self.connection_class = (http.client.HTTPSConnection if parsed.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.host, self.port = parsed.hostname, parsed.port
+        self.prefix = parsed.path.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = []  # connections not used by any thread
+        self.lock = threading.Lock()
+
+    def _acquire(self) -> (http.client.HTTPConnection, bool):
+        """Return a connection, and whether it was already opened"""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, connection:http.client.HTTPConnection):
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method:str, path:str, body:bytes=None) -> dict:
+        """Return the JSON answer of the hub to given request"""
+        headers = {'Content-Type': 'text/plain; charset=utf-8'} if body is not None else {}
+        while True:
+            connection, reused = self._acquire()
+            try:
+                connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = connection.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                connection.close()
+                if reused:  # closed by the hub while idle: retry with a new one
+                    continue
+                raise
+            except OSError:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            break
+        try:
+            answer = json.loads(payload.decode()) if payload else {}
+        except ValueError:
+            answer = {}
+        if response.status >= 300:
+            raise HubError(response.status, answer.get('error', response.reason))
+        return answer
+
+    def submit(self, discoveries:str) -> dict:
+        """Send given discoveries to the hub. Return its answer,
+        giving the number of records accepted and of duplicates."""
+        return self.request('POST', '/discoveries', discoveries.encode('utf-8'))
+
+    def status(self) -> dict:
+        return self.request('GET', '/status')
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
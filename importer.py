@@ -0,0 +1,116 @@
+"""Import of existing databases, like the ones of explorers that played
+before joining Pioneers.
+
+Files are split in chunks on record boundaries, and chunks are validated
+and parsed by a pool of processes. Workers only send back the object,
+date and position of each record: the records themselves are read
+from the files by the main process, for the ones to import.
+
+Records are imported only for objects not in the git database.
+Among the records of an object, the first explorer wins: the one with
+the earliest date, and, for records of the same date, the last one
+of the files, as SpaceEngine would do.
+
+"""
+
+import os
+import re
+import mmap
+import concurrent.futures
+import bloom
+import pobject
+import validator
+from mergedriver import DATE_OF_UNDATED
+from constants import LOCAL_GIT_DB, VALIDATION_MAX_FIELD_LENGTH, IMPORT_CHUNK_SIZE
+
+
+# end of a record: a closing brace alone on its line
+REG_RECORD_END = re.compile(rb'\n\}[ \t]*\r?\n')
+
+
+def split(data:bytes, chunk_size:int=IMPORT_CHUNK_SIZE) -> [(int, int)]:
+    """Return the (start, end) of the chunks of given data, each
+    holding complete records, and about chunk_size bytes"""
+    chunks, start = [], 0
+    while start < len(data):
+        found = REG_RECORD_END.search(data, start + chunk_size) if start + chunk_size < len(data) else None
+        end = found.end() if found else len(data)
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def parse_chunk(filename:str, start:int, end:int,
+                max_field_length:int=VALIDATION_MAX_FIELD_LENGTH) -> [(str, str, int, int)]:
+    """Return (object, date, offset, length) of each record in given
+    chunk of given file. Raise ValidationError if the chunk is not valid."""
+    with open(filename, 'rb') as fd:
+        fd.seek(start)
+        data = fd.read(end - start)
+    try:
+        validator.validate(data, max_records=None, max_field_length=max_field_length, max_bytes=None)
+    except validator.ValidationError as err:
+        raise validator.ValidationError('{}: {}'.format(filename, err.reason), start + err.offset)
+    return [(pobject.record_key(record), record.date, record.offset, record.length)
+            for record in pobject.parse(data, base_offset=start)]
+
+
+def read_records(filenames:[str], workers:int=None,
+                 chunk_size:int=IMPORT_CHUNK_SIZE) -> {str: (str, int, int, int)}:
+    """Return, for each object found in given files, (date, file index,
+    offset, length) of the record of its first explorer.
+
+    workers -- number of processes (default: one per core). With 1,
+               chunks are parsed in the current process.
+
+    Raise ValidationError, naming the file, if one is not valid.
+
+    """
+    chunks = []  # (file index, start, end)
+    for index, filename in enumerate(filenames):
+        if not os.path.getsize(filename):
+            continue
+        with open(filename, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunks.extend((index, start, end) for start, end in split(data, chunk_size))
+    workers = workers or os.cpu_count() or 1
+    args = ([filenames[index] for index, _, _ in chunks],
+            [start for _, start, _ in chunks], [end for _, _, end in chunks])
+    if workers == 1:
+        results = map(parse_chunk, *args)
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        results = pool.map(parse_chunk, *args)
+    firsts = {}
+    try:
+        for (index, _, _), records in zip(chunks, results):
+            for key, date, offset, length in records:  # in order of the files
+                if key is None:
+                    continue
+                date = date or DATE_OF_UNDATED
+                best = firsts.get(key)
+                if best is None or date <= best[0]:
+                    firsts[key] = date, index, offset, length
+    finally:
+        if workers != 1:
+            pool.shutdown(cancel_futures=True)
+    return firsts
+
+
+def new_discoveries(filenames:[str], workers:int=None, database:str=LOCAL_GIT_DB,
+                    chunk_size:int=IMPORT_CHUNK_SIZE) -> (str, int, int):
+    """Return the records of given files to add to the database, and the
+    numbers of objects found in the files and already in the database.
+    Records are given oldest first, as SpaceEngine writes them."""
+    firsts = read_records(filenames, workers, chunk_size)
+    known = bloom.known_objects(firsts, database, exact=True)
+    records = sorted((value for key, value in firsts.items() if key not in known))
+    texts = []
+    fds = [open(filename, 'rb') for filename in filenames]
+    try:
+        for _, index, offset, length in records:
+            fds[index].seek(offset)
+            texts.append(fds[index].read(length).decode(pobject.ENCODING) + '\n')
+    finally:
+        for fd in fds:
+            fd.close()
+    return ''.join(texts), len(firsts), len(known)
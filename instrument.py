@@ -0,0 +1,203 @@
+"""Instrumentation of the Pioneers phases.
+
+A phase is delimited by a span, recording its duration, the peak of memory
+allocated by Python during the phase (with tracemalloc), and the counts
+given to the span, like bytes or records handled.
+
+The peak of tracemalloc is shared by all threads: spans overlapping
+spans of other threads (hub, daemon, gui workers) get no peak (null).
+
+Spans are written in a file, as JSON lines, or in the Chrome trace format
+if its name ends with .json (to open in chrome://tracing or ui.perfetto.dev).
+
+Instrumentation is enabled by the --profile option of the scripts,
+or by the PIONEERS_PROFILE environment variable naming the output file.
+When disabled, span() returns a shared object doing nothing.
+
+"""
+
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import tracemalloc
+
+
+ENV_VARIABLE = 'PIONEERS_PROFILE'
+
+
+class _NoSpan:
+    """Span used when instrumentation is disabled"""
+    def __enter__(self):
+        return self
+    def __exit__(self, *_):
+        return False
+    def add(self, **counts):
+        pass
+
+NO_SPAN = _NoSpan()
+
+
+class Span:
+    """A phase being recorded. Use add to count things during the phase."""
+    __slots__ = ('recorder', 'name', 'counts', 'parent', 'start', 'base_memory', 'peak_memory',
+                 'concurrent')
+
+    def __init__(self, recorder:'Recorder', name:str, counts:dict):
+        self.recorder = recorder
+        self.name = name
+        self.counts = counts
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        stack = self.recorder.stack()
+        self.parent = stack[-1] if stack else None
+        self.concurrent = False
+        self.recorder.opened(self)
+        self.base_memory, peak = tracemalloc.get_traced_memory()
+        if not self.concurrent:  # the peak is reset for this span: keep it for the parent
+            if self.parent:
+                self.parent.peak_memory = max(self.parent.peak_memory, peak)
+            tracemalloc.reset_peak()
+        self.peak_memory = self.base_memory
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter_ns()
+        self.peak_memory = max(self.peak_memory, tracemalloc.get_traced_memory()[1])
+        self.recorder.stack().pop()
+        self.recorder.closed(self)
+        if self.parent:
+            self.parent.peak_memory = max(self.parent.peak_memory, self.peak_memory)
+        if exc_type:
+            self.counts['error'] = exc_type.__name__
+        self.recorder.write(self, end)
+        return False
+
+
+class Recorder:
+    """Write the spans in a file, as JSON lines or Chrome trace"""
+
+    def __init__(self, filename:str):
+        self.filename = filename
+        self.chrome = filename.endswith('.json')
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.perf_counter_ns()
+        self.events = []  # chrome trace is written at once, when closed
+        self.open = {}  # span -> ident of its thread
+        self.fd = None if self.chrome else open(filename, 'w')
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stack(self) -> [Span]:
+        """Return the spans opened by current thread"""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def opened(self, span:Span):
+        """Register given span, and mark it and the spans of other
+        threads as concurrent if they overlap"""
+        ident = threading.get_ident()
+        with self.lock:
+            if any(other != ident for other in self.open.values()):
+                span.concurrent = True
+                for other in self.open:
+                    other.concurrent = True
+            self.open[span] = ident
+
+    def closed(self, span:Span):
+        with self.lock:
+            del self.open[span]
+
+    def write(self, span:Span, end:int):
+        thread = threading.current_thread()
+        peak = None if span.concurrent else span.peak_memory - span.base_memory
+        if self.chrome:
+            event = {'name': span.name, 'cat': 'pioneers', 'ph': 'X',
+                     'ts': (span.start - self.origin) / 1000, 'dur': (end - span.start) / 1000,
+                     'pid': os.getpid(), 'tid': thread.ident,
+                     'args': dict(span.counts, peak_bytes=peak)}
+            with self.lock:
+                self.events.append(event)
+            return
+        line = json.dumps(dict(span.counts, name=span.name, thread=thread.name,
+                               parent=span.parent.name if span.parent else None,
+                               start=(span.start - self.origin) / 1e9,
+                               duration=(end - span.start) / 1e9, peak_bytes=peak))
+        with self.lock:
+            self.fd.write(line + '\n')
+            self.fd.flush()
+
+    def close(self):
+        with self.lock:
+            if self.chrome:
+                with open(self.filename, 'w') as fd:
+                    json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fd)
+            else:
+                self.fd.close()
+
+
+_recorder = None
+
+
+def enable(filename:str) -> Recorder:
+    """Record spans in given file, until the end of the program"""
+    global _recorder
+    disable()
+    _recorder = Recorder(filename)
+    atexit.register(disable)
+    return _recorder
+
+
+def disable():
+    """Stop recording spans, and write the trace"""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder:
+        recorder.close()
+
+
+def enabled() -> bool:
+    return _recorder is not None
+
+
+def span(name:str, **counts) -> Span or _NoSpan:
+    """Return a context manager recording the phase of given name"""
+    if _recorder is None:
+        return NO_SPAN
+    return Span(_recorder, name, counts)
+
+
+def current() -> Span or _NoSpan:
+    """Return the innermost span of current thread, to add counts to it"""
+    if _recorder is None:
+        return NO_SPAN
+    stack = _recorder.stack()
+    return stack[-1] if stack else NO_SPAN
+
+
+def traced(name:str=None) -> callable:
+    """Decorator recording each call of the function in a span"""
+    def decorator(func:callable) -> callable:
+        span_name = name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            with Span(_recorder, span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if os.environ.get(ENV_VARIABLE):
+    enable(os.environ[ENV_VARIABLE])
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+"""Git merge driver merging Pioneers databases record by record.
+
+The merge result is the union of the records of both versions,
+minus the records removed by one of them. When new records share
+a LocName with others, only the one with the earliest Date is kept:
+the first explorer wins.
+
+New records of the other version are added on top of the database,
+or at the end of a shard, as Pioneers does for discoveries.
+
+Git calls it with:
+
+    python mergedriver.py %O %A %B %P
+
+where %O is the ancestor, %A our version, that will receive the result,
+%B their version, and %P the path of the merged file in the repository.
+
+"""
+
+import sys
+import pobject
+from constants import DATABASE_FILENAME
+
+
+DATE_OF_UNDATED = '\uffff'  # undated records are considered the last ones
+
+
+def _records(filename:str) -> [(pobject.PObject, bytes)]:
+    """Return records of given file, with their raw data"""
+    with open(filename, 'rb') as fd:
+        data = fd.read()
+    return [(record, data[record.offset:record.offset+record.length])
+            for record in pobject.parse(data)]
+
+
+def merge_records(ancestor:[pobject.PObject], ours:[pobject.PObject],
+                  theirs:[pobject.PObject], append:bool=False) -> [pobject.PObject]:
+    """Return the merge of given lists of records, as explained in module doc.
+
+    append -- put new records of theirs after ours, instead of on top
+
+    """
+    base, in_ours, in_theirs = set(ancestor), set(ours), set(theirs)
+    removed = (base - in_ours) | (base - in_theirs)
+    added = [record for record in theirs if record not in in_ours]
+    kept = [record for record in ours if record not in removed]
+    merged = kept + added if append else added + kept
+    # first explorer wins for objects involved in new records
+    new_locnames = {record.locname for record in (in_ours | in_theirs) - base}
+    first = {}
+    for record in merged:
+        if record.locname in new_locnames:
+            best = first.get(record.locname)
+            if best is None or (record.date or DATE_OF_UNDATED) < (best.date or DATE_OF_UNDATED):
+                first[record.locname] = record
+    seen, result = set(), []
+    for record in merged:
+        if record.locname in new_locnames and first[record.locname] is not record:
+            continue
+        if record not in seen:
+            seen.add(record)
+            result.append(record)
+    return result
+
+
+def merge_files(ancestor:str, ours:str, theirs:str, path:str=DATABASE_FILENAME):
+    """Write in ours the merge of given files"""
+    raws = {}
+    def records_of(filename):
+        records = []
+        for record, raw in _records(filename):
+            raws.setdefault(record, raw)
+            records.append(record)
+        return records
+    merged = merge_records(records_of(ancestor), records_of(ours), records_of(theirs),
+                           append=path != DATABASE_FILENAME)  # shards are append-only
+    with open(ours, 'wb') as fd:
+        fd.write(b''.join(raws[record] + b'\n' for record in merged))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in {4, 5}:
+        print(__doc__)
+        exit(2)
+    try:
+        merge_files(*sys.argv[1:])
+    except (OSError, pobject.ParseError) as err:
+        print("Pioneers merge driver: {}".format(err), file=sys.stderr)
+        exit(1)  # let git report a conflict
@@ -0,0 +1,99 @@
+"""Durable queue of the discoveries waiting to be committed.
+
+Discoveries are first written in an append-only journal, then committed
+all together in the git database. They are acknowledged in the journal
+only once the commit exists, so discoveries are never lost, even if
+Pioneers is stopped or the network is down.
+
+Before the commit, its batch id is written in the journal, and in the
+commit message. If Pioneers is stopped before acknowledging the
+discoveries, the next run finds the commit by its batch id, and
+acknowledges them instead of committing them again.
+
+Journal lines are JSON objects, either:
+
+    {"add": <id>, "text": <discoveries>}
+    {"commit": <batch id>, "uids": [<id>, …]}
+    {"done": [<id>, …]}
+
+"""
+
+import os
+import json
+import uuid
+from constants import OUTBOX_FILE
+
+
+class Outbox:
+    """Journal of discoveries, stored in given file"""
+
+    def __init__(self, path:str=OUTBOX_FILE):
+        self.path = path
+
+    def _append(self, entry:dict):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as fd:
+            fd.write(json.dumps(entry) + '\n')
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def _entries(self) -> [dict]:
+        try:
+            with open(self.path, encoding='utf-8') as fd:
+                for line in fd:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:  # interrupted while writing it
+                        continue
+        except FileNotFoundError:
+            return
+
+    def enqueue(self, discoveries:str) -> str:
+        """Add given discoveries to the journal, return their id"""
+        uid = uuid.uuid4().hex
+        self._append({'add': uid, 'text': discoveries})
+        return uid
+
+    def pending(self) -> [(str, str)]:
+        """Return (id, discoveries) not yet acknowledged, in order of arrival"""
+        added, done = {}, set()
+        for entry in self._entries():
+            if 'add' in entry:
+                added[entry['add']] = entry['text']
+            else:
+                done.update(entry.get('done', ()))
+        return [(uid, text) for uid, text in added.items() if uid not in done]
+
+    def begin(self, uids:[str]) -> str:
+        """Record that given discoveries are about to be committed,
+        return the batch id to write in the commit message"""
+        batch = uuid.uuid4().hex
+        self._append({'commit': batch, 'uids': list(uids)})
+        return batch
+
+    def batches(self) -> {str: [str]}:
+        """Return batch id -> ids of the discoveries of the commits begun,
+        but not acknowledged: they may exist or not"""
+        batches, done = {}, set()
+        for entry in self._entries():
+            if 'commit' in entry:
+                batches[entry['commit']] = entry['uids']
+            else:
+                done.update(entry.get('done', ()))
+        return {batch: uids for batch, uids in batches.items() if not done.issuperset(uids)}
+
+    def acknowledge(self, uids:[str]):
+        """Mark given discoveries as committed. The journal is emptied
+        once all discoveries are committed."""
+        self._append({'done': list(uids)})
+        if not self.pending():
+            os.replace(self._emptied(), self.path)
+
+    def _emptied(self) -> str:
+        """Return path to an empty file, next to the journal"""
+        tempname = self.path + '.tmp'
+        open(tempname, 'w').close()
+        return tempname
+
+    def __len__(self):
+        return len(self.pending())
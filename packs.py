@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+"""Distribution of the database as numbered versions, in delta packs.
+
+Instead of pulling the git history and copying the whole database,
+a client can get the versions published since its own as delta packs,
+holding only the records added or removed by each version.
+
+A pack source is a directory, or an url serving it, holding:
+
+    manifest.json           last version, and the files giving each version
+    snapshot-<N>.cfg.gz     whole database at version N
+    delta-<N>.pack.gz       changes from version N-1 to N
+    database.cfg            last version, to compute the next delta
+
+A delta pack is compressed with gzip. Its first line is a JSON header
+giving the removed records, by their distance from the end of the previous
+version (unchanged by records added on top), and the hash of the result.
+The following bytes are the records to add on top of the database.
+
+A snapshot is written every PACK_SNAPSHOT_INTERVAL versions, and when
+a version can't be expressed as a delta (records reordered). A client
+applies the deltas following its own version, or, if it is cheaper,
+starts again from the last snapshot.
+
+Usage, to publish the current database as a new version:
+
+    python packs.py DATABASE DIRECTORY
+
+"""
+
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+import collections
+import urllib.parse
+import urllib.request
+import deploy
+import pobject
+import checkpoint
+import instrument
+from constants import LOCAL_GIT_DB, DATABASE_FILE, PACKS_STATE_FILE, PACK_SNAPSHOT_INTERVAL
+
+
+MANIFEST = 'manifest.json'
+LATEST = 'database.cfg'
+SNAPSHOT = 'snapshot-{}.cfg.gz'
+DELTA = 'delta-{}.pack.gz'
+
+
+class PackError(ValueError):
+    """Raised when packs are missing, or do not give the expected database"""
+
+
+def _sha1(data:bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def make_delta(old:bytes, new:bytes) -> (bytes, [(int, int)]) or None:
+    """Return the bytes to add on top of old, and the (distance from end,
+    length) of the records to remove from old, to get new.
+    Return None if new is not old with records added on top and removed."""
+    if new.endswith(old):  # usual case: discoveries added on top
+        return new[:len(new)-len(old)], []
+    remaining = collections.Counter(new[obj.offset:obj.offset+obj.length]
+                                    for obj in pobject.parse(new))
+    removed = []
+    for obj in pobject.parse(old):
+        raw = old[obj.offset:obj.offset+obj.length]
+        if remaining[raw]:
+            remaining[raw] -= 1
+            continue
+        end = obj.offset + obj.length
+        if old[end:end+1] == b'\n':
+            end += 1
+        removed.append((len(old) - obj.offset, end - obj.offset))
+    kept = _remove(old, removed)
+    if not new.endswith(kept):
+        return None
+    return new[:len(new)-len(kept)], removed
+
+
+def _remove(data:bytes, removed:[(int, int)]) -> bytes:
+    """Return data without the given spans, located from its end"""
+    parts, end = [], len(data)
+    for rear, length in sorted(removed):  # from the end of data
+        start = len(data) - rear
+        if start < 0 or start + length > end:
+            raise PackError("removed record out of the database")
+        parts.append(data[start+length:end])
+        end = start
+    parts.append(data[:end])
+    return b''.join(reversed(parts))
+
+
+def apply_delta(old:bytes, pack:bytes) -> bytes:
+    """Return the database obtained by applying given delta pack on old"""
+    header, _, added = gzip.decompress(pack).partition(b'\n')
+    header = json.loads(header.decode())
+    new = added + _remove(old, header['removed'])
+    if _sha1(new) != header['sha1']:
+        raise PackError("delta {} does not give the expected database".format(header['to']))
+    return new
+
+
+def load_manifest(directory:str) -> dict:
+    try:
+        with open(os.path.join(directory, MANIFEST)) as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return {'version': 0, 'sha1': None, 'snapshots': {}, 'deltas': {}}
+
+
+def _write(directory:str, name:str, data:bytes) -> dict:
+    with deploy.replacing(os.path.join(directory, name)) as fd:
+        fd.write(data)
+    return {'file': name, 'size': len(data)}
+
+
+@instrument.traced('publish pack')
+def publish(database:str, directory:str,
+            snapshot_interval:int=PACK_SNAPSHOT_INTERVAL) -> int or None:
+    """Publish given database in directory as a new version, if it changed.
+    Return the new version, or None if nothing changed."""
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_manifest(directory)
+    with open(database, 'rb') as fd:
+        new = fd.read()
+    sha1 = _sha1(new)
+    if sha1 == manifest['sha1']:
+        return None
+    version = manifest['version'] + 1
+    delta = None
+    if manifest['version']:
+        with open(os.path.join(directory, LATEST), 'rb') as fd:
+            delta = make_delta(fd.read(), new)
+    # pack files are written before the manifest referencing them
+    if delta is not None:
+        added, removed = delta
+        header = {'from': version - 1, 'to': version, 'removed': removed, 'sha1': sha1}
+        pack = gzip.compress(json.dumps(header).encode() + b'\n' + added)
+        manifest['deltas'][str(version)] = _write(directory, DELTA.format(version), pack)
+        instrument.current().add(delta_bytes=len(pack))
+    if delta is None or version % snapshot_interval == 0:
+        manifest['snapshots'][str(version)] = _write(directory, SNAPSHOT.format(version),
+                                                     gzip.compress(new))
+    _write(directory, LATEST, new)
+    manifest.update(version=version, sha1=sha1)
+    _write(directory, MANIFEST, json.dumps(manifest, indent=1).encode())
+    return version
+
+
+def fetch(source:str, name:str) -> bytes:
+    """Return the content of given file of the pack source,
+    which is a directory or an url"""
+    if urllib.parse.urlsplit(source).scheme in ('http', 'https', 'file'):
+        with urllib.request.urlopen(source.rstrip('/') + '/' + name) as response:
+            return response.read()
+    with open(os.path.join(source, name), 'rb') as fd:
+        return fd.read()
+
+
+def plan(manifest:dict, version:int) -> (int, [int]):
+    """Return the snapshot to start from (0 to start from given version),
+    and the deltas to apply, the cheapest to download"""
+    target = manifest['version']
+    snapshots = [int(number) for number in manifest['snapshots'] if int(number) <= target]
+    if not snapshots:
+        raise PackError("no snapshot in the pack source")
+    def cost(start:int, snapshot:int) -> int or None:
+        sizes = [manifest['deltas'].get(str(number), {}).get('size') for number in range(start + 1, target + 1)]
+        if None in sizes:
+            return None
+        return sum(sizes) + (manifest['snapshots'][str(snapshot)]['size'] if snapshot else 0)
+    snapshot = max(snapshots)
+    from_version = cost(version, 0) if 0 < version <= target else None
+    if from_version is not None and from_version <= cost(snapshot, snapshot):
+        return 0, list(range(version + 1, target + 1))
+    return snapshot, list(range(snapshot + 1, target + 1))
+
+
+def load_state(state_file:str=PACKS_STATE_FILE) -> dict:
+    try:
+        with open(state_file) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {'version': 0}
+
+
+def _local_version(database:str, state:dict) -> (int, bytes):
+    """Return the version of the local database, and its content,
+    or version 0 if it is not in the recorded state"""
+    try:
+        with open(database, 'rb') as fd:
+            data = fd.read(state['size']) if state.get('size') is not None else b''
+    except OSError:
+        return 0, b''
+    if not state['version'] or _sha1(data) != state.get('sha1'):
+        return 0, b''
+    return state['version'], data
+
+
+@instrument.traced('synchronize packs')
+def synchronize(source:str, database:str=LOCAL_GIT_DB, used:str=DATABASE_FILE,
+                state_file:str=PACKS_STATE_FILE) -> (int, int):
+    """Bring the local database to the last version of given pack source,
+    and install it as used database. Return the version and the number
+    of bytes downloaded. Raise PackError or OSError on failure."""
+    manifest = json.loads(fetch(source, MANIFEST).decode())
+    version, data = _local_version(database, load_state(state_file))
+    if version == manifest['version'] and os.path.exists(used):
+        return version, 0
+    snapshot, deltas = plan(manifest, version)
+    downloaded = 0
+    if snapshot:
+        pack = fetch(source, manifest['snapshots'][str(snapshot)]['file'])
+        downloaded += len(pack)
+        data = gzip.decompress(pack)
+    for number in deltas:
+        pack = fetch(source, manifest['deltas'][str(number)]['file'])
+        downloaded += len(pack)
+        data = apply_delta(data, pack)
+    if _sha1(data) != manifest['sha1']:
+        raise PackError("packs do not give the last version")
+    os.makedirs(os.path.dirname(database) or '.', exist_ok=True)
+    with deploy.replacing(database) as fd:  # a new file, even if hardlinked to the used one
+        fd.write(data)
+    os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+    with open(state_file, 'w') as fd:
+        json.dump({'version': manifest['version'], 'sha1': manifest['sha1'], 'size': len(data)}, fd)
+    install(database, used)
+    instrument.current().add(bytes=downloaded)
+    return manifest['version'], downloaded
+
+
+def install(database:str=LOCAL_GIT_DB, used:str=DATABASE_FILE) -> bool:
+    """Install given database as used database, keeping the records
+    appended to the used database since its installation.
+    Return False if the used database was modified before its end."""
+    if not os.path.exists(used) or checkpoint.is_unchanged(used):
+        deploy.install(database, used)
+        checkpoint.record(used)
+        return True
+    appended = checkpoint.appended_data(used)
+    if appended is None:
+        print("WARNING: the used database holds unintegrated modifications. "
+              "It is therefore not replaced by the new version.")
+        return False
+    with deploy.replacing(used) as fd, open(database, 'rb') as src:
+        shutil.copyfileobj(src, fd)
+        size = fd.tell()
+        fd.write(appended)  # the discoveries stay after the checkpoint
+    checkpoint.record(used, size=size)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database', type=str, help='database to publish')
+    parser.add_argument('directory', type=str, help='directory holding the packs')
+    parser.add_argument('--snapshot-interval', type=int, default=PACK_SNAPSHOT_INTERVAL,
+                        help='versions between two snapshots')
+    args = parser.parse_args()
+    version = publish(args.database, args.directory, args.snapshot_interval)
+    if version is None:
+        print("Database unchanged since last version.")
+    else:
+        print("Version {} published in {}.".format(version, args.directory))
@@ -0,0 +1,314 @@
+"""Persistent cache of the parsed git database.
+
+Parsing the whole database takes seconds, although its content changes
+only with its git blob. Once parsed, the records are stored in a cache
+entry named after the git blob SHA of the file, and loaded back from it
+while the database is unchanged. The SHA itself is computed once for each
+state of the file (size, modification time and inode), so an unchanged
+database is not even read. After a synchronization moving HEAD, the
+database is hashed again (see gitctl.synchronize).
+
+An entry stores the records by columns: positions as arrays of integers,
+each field as its values followed by a NUL byte, and, in JSON, the rare
+records having another kind or other fields, and the number of records of
+each pioneer. Columns are decoded only when used, so the set of objects
+is obtained without decoding the descriptions, and records are decoded
+one at a time from the mapped entry, so memory stays bounded.
+
+The RS trie of the objects (see rstrie.py) is stored next to the entry,
+so that sector queries do not build it again at each run.
+
+Entries used least recently are removed once the cache exceeds
+PARSE_CACHE_MAX_BYTES.
+
+"""
+
+import os
+import json
+import mmap
+import shutil
+import struct
+import hashlib
+import tempfile
+import contextlib
+import collections
+from array import array
+import deploy
+import pobject
+import rstrie
+from constants import LOCAL_GIT_DB, PARSE_CACHE_DIR, PARSE_CACHE_MAX_BYTES
+
+
+MAGIC = b'PPRC'
+FORMAT = 1
+HEADER = struct.Struct('<4sHQ')  # magic, format, records
+SECTION = struct.Struct('<QQ')  # offset, length
+FIELDS = ('locname', 'name', 'pioneer', 'date', 'descr')
+SECTIONS = ('offsets', 'lengths') + FIELDS + ('others', 'pioneers')
+NONE = '\udcff'  # the byte 0xFF, never found in UTF-8, decoded with surrogateescape
+SUFFIX = '.records'
+TRIE_SUFFIX = '.trie'
+STATES_FILE = 'states.json'  # path -> size, mtime, inode and blob SHA of the file
+HASH_CHUNK_SIZE = 1 << 20
+VALUES_CHUNK_SIZE = 1 << 20
+
+
+class ParsedDatabase:
+    """Records of a database, read from a cache entry"""
+
+    def __init__(self, data:bytes, blob:str=None):
+        self.data = data
+        self.blob = blob
+        magic, version, self.count = HEADER.unpack_from(data)
+        if magic != MAGIC or version != FORMAT:
+            raise ValueError("not a cache entry")
+        self.sections = {name: SECTION.unpack_from(data, HEADER.size + index * SECTION.size)
+                         for index, name in enumerate(SECTIONS)}
+        self._columns = {}
+        self._others = None
+
+    def __len__(self):
+        return self.count
+
+    def _section(self, name:str) -> memoryview:
+        offset, length = self.sections[name]
+        return memoryview(self.data)[offset:offset+length]
+
+    def positions(self, name:str) -> memoryview:
+        """Return the offsets or lengths of all records, read in place"""
+        return self._section(name).cast('Q')
+
+    def column(self, name:str) -> [str]:
+        """Return the values of given field of all records"""
+        if name not in self._columns:
+            self._columns[name] = [None if value == NONE else value for value in
+                                   bytes(self._section(name)).decode(pobject.ENCODING, 'surrogateescape').split('\0')[:self.count]]
+        return self._columns[name]
+
+    def values(self, name:str, chunk_size:int=VALUES_CHUNK_SIZE) -> [str]:
+        """Yield the values of given field, decoded a chunk at a time"""
+        offset, length = self.sections[name]
+        end, rest = offset + length, b''
+        while offset < end:
+            *values, rest = (rest + self.data[offset:min(offset + chunk_size, end)]).split(b'\0')
+            offset += chunk_size
+            for value in values:
+                value = value.decode(pobject.ENCODING, 'surrogateescape')
+                yield None if value == NONE else value
+
+    def _json(self, name:str):
+        return json.loads(bytes(self._section(name)).decode())
+
+    def others(self) -> {int: (str, tuple)}:
+        """Return kind and extra fields of the records having any"""
+        if self._others is None:
+            self._others = {int(index): (kind, tuple(map(tuple, extra)))
+                            for index, (kind, extra) in self._json('others').items()}
+        return self._others
+
+    @property
+    def pioneer_counts(self) -> collections.Counter:
+        """Number of records of each pioneer (None for unknown)"""
+        return collections.Counter(dict(map(tuple, self._json('pioneers'))))
+
+    def keys(self) -> [str]:
+        """Return the object of each record, as pobject.record_key"""
+        return [locname or name for locname, name in zip(self.column('locname'), self.column('name'))]
+
+    def records(self) -> [pobject.PObject]:
+        """Yield the records, in the order of the database"""
+        others = self.others()
+        columns = [self.values(name) for name in FIELDS]
+        columns += [self.positions('offsets'), self.positions('lengths')]
+        for index, (locname, name, pioneer, date, descr, offset, length) in enumerate(zip(*columns)):
+            kind, extra = others.get(index, ('PObject', ()))
+            yield pobject.PObject(kind, locname, name, pioneer, date, descr,
+                                  extra=extra, offset=offset, length=length)
+
+
+class _NotStorable(Exception):
+    """Raised to abort the storage of records that can't be cached"""
+
+
+def encode(records:[pobject.PObject], fd, spool_dir:str=None) -> bool:
+    """Write the cache entry of given records in given binary file.
+    Return False if they can't be stored (field values holding a NUL byte).
+
+    Fields are spooled to temporary files in spool_dir, so that
+    only the positions of the records are kept in memory.
+
+    """
+    offsets, lengths = array('Q'), array('Q')
+    others, pioneers = {}, collections.Counter()
+    with contextlib.ExitStack() as stack:
+        columns = {name: stack.enter_context(tempfile.TemporaryFile(dir=spool_dir)) for name in FIELDS}
+        for index, record in enumerate(records):
+            offsets.append(record.offset)
+            lengths.append(record.length)
+            for name in FIELDS:
+                value = getattr(record, name)
+                if value is not None and '\0' in value:
+                    return False
+                columns[name].write((NONE if value is None else value).encode(pobject.ENCODING, 'surrogateescape') + b'\0')
+            pioneers[record.pioneer] += 1
+            if record.kind != 'PObject' or record.extra:
+                others[index] = (record.kind, record.extra)
+        sections = [offsets.tobytes(), lengths.tobytes()] + [columns[name] for name in FIELDS]
+        sections += [json.dumps(others).encode(), json.dumps(list(pioneers.items())).encode()]
+        sizes = [len(section) if isinstance(section, bytes) else section.tell() for section in sections]
+        fd.write(HEADER.pack(MAGIC, FORMAT, len(offsets)))
+        offset = HEADER.size + SECTION.size * len(SECTIONS)
+        for size in sizes:
+            fd.write(SECTION.pack(offset, size))
+            offset += size
+        for section in sections:
+            if isinstance(section, bytes):
+                fd.write(section)
+            else:
+                section.seek(0)
+                shutil.copyfileobj(section, fd)
+    return True
+
+
+def blob_sha(filename:str) -> str:
+    """Return the SHA of given file as a git blob, like git hash-object"""
+    with open(filename, 'rb') as fd:
+        sha1 = hashlib.sha1(b'blob %d\0' % os.fstat(fd.fileno()).st_size)
+        for chunk in iter(lambda: fd.read(HASH_CHUNK_SIZE), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _load_states(cache_dir:str) -> dict:
+    try:
+        with open(os.path.join(cache_dir, STATES_FILE)) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_states(cache_dir:str, states:dict):
+    with deploy.replacing(os.path.join(cache_dir, STATES_FILE)) as fd:
+        fd.write(json.dumps(states).encode())
+
+
+def file_blob(filename:str, cache_dir:str=PARSE_CACHE_DIR) -> str:
+    """Return the blob SHA of given file, hashing it only if it changed
+    since last call"""
+    stat = os.stat(filename)
+    state = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    path = os.path.abspath(filename)
+    states = _load_states(cache_dir)
+    known = states.get(path)
+    if known and known[:3] == state:
+        return known[3]
+    blob = blob_sha(filename)
+    states[path] = state + [blob]
+    _save_states(cache_dir, states)
+    return blob
+
+
+def forget(filename:str=LOCAL_GIT_DB, cache_dir:str=PARSE_CACHE_DIR):
+    """Hash given file again at next load"""
+    states = _load_states(cache_dir)
+    if states.pop(os.path.abspath(filename), None) is not None:
+        _save_states(cache_dir, states)
+
+
+def load(filename:str=LOCAL_GIT_DB, cache_dir:str=PARSE_CACHE_DIR,
+         max_bytes:int=PARSE_CACHE_MAX_BYTES) -> ParsedDatabase or None:
+    """Return the parsed records of given database, from the cache,
+    or parsed and then stored in the cache. Return None if they can't be
+    cached: records must then be parsed from the file.
+    Raise ParseError if the database is not valid."""
+    os.makedirs(cache_dir, exist_ok=True)
+    blob = file_blob(filename, cache_dir)
+    entry = os.path.join(cache_dir, blob + SUFFIX)
+    parsed = _open_entry(entry, blob)
+    if parsed is not None:
+        os.utime(entry)  # recently used
+        return parsed
+    try:
+        with deploy.replacing(entry) as fd:
+            if not encode(pobject.parse_file(filename), fd, cache_dir):
+                raise _NotStorable()
+    except _NotStorable:
+        return None
+    evict(cache_dir, max_bytes, keep=entry)
+    return _open_entry(entry, blob)
+
+
+def _open_entry(entry:str, blob:str) -> ParsedDatabase or None:
+    """Return the records of given cache entry, or None if
+    it does not exist or is corrupted"""
+    try:
+        with open(entry, 'rb') as fd:
+            return ParsedDatabase(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ), blob)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def cached(filename:str) -> ParsedDatabase or None:
+    """Return the parsed records of given database if it is the git
+    database: other files (benchmarks, imports) are not cached"""
+    if os.path.abspath(filename) != os.path.abspath(LOCAL_GIT_DB):
+        return None
+    return load(filename)
+
+
+def pioneer_counts(filename:str=LOCAL_GIT_DB) -> collections.Counter:
+    """Return the number of records of each pioneer in given database,
+    from the cache if possible"""
+    parsed = cached(filename)
+    if parsed is None:
+        return collections.Counter(record.pioneer for record in pobject.parse_file(filename))
+    return parsed.pioneer_counts
+
+
+def keys(filename:str=LOCAL_GIT_DB) -> [str]:
+    """Return the object of each record of given database (None for
+    records without LocName nor Name), from the cache if possible"""
+    parsed = cached(filename)
+    if parsed is None:
+        return [pobject.record_key(record) for record in pobject.parse_file(filename)]
+    return parsed.keys()
+
+
+def rs_trie(filename:str=LOCAL_GIT_DB, cache_dir:str=PARSE_CACHE_DIR,
+            max_bytes:int=PARSE_CACHE_MAX_BYTES) -> rstrie.RSTrie:
+    """Return the RS trie of the records of given database, with their
+    offset as payload. It is stored next to the cache entry."""
+    parsed = cached(filename)
+    if parsed is None:
+        return rstrie.RSTrie((record.locname, record.offset) for record in pobject.parse_file(filename)
+                             if record.locname)
+    entry = os.path.join(cache_dir, parsed.blob + TRIE_SUFFIX)
+    try:
+        with open(entry, 'rb') as fd:
+            trie = rstrie.RSTrie.loads(fd.read())
+        os.utime(entry)  # recently used
+        return trie
+    except (OSError, ValueError, struct.error):
+        pass  # not stored yet, or corrupted
+    trie = rstrie.RSTrie((locname, offset) for locname, offset
+                         in zip(parsed.column('locname'), parsed.positions('offsets')) if locname)
+    with deploy.replacing(entry) as fd:
+        fd.write(trie.dumps())
+    evict(cache_dir, max_bytes, keep=entry)
+    return trie
+
+
+def evict(cache_dir:str=PARSE_CACHE_DIR, max_bytes:int=PARSE_CACHE_MAX_BYTES, keep:str=None):
+    """Remove the entries used least recently, until the cache
+    holds at most max_bytes, except given entry"""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith((SUFFIX, TRIE_SUFFIX)) and entry.path != keep:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries) + (os.path.getsize(keep) if keep else 0)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
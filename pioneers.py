@@ -9,11 +9,24 @@ See last lines for exact application sequence.
 import os
 import re
 import shutil
-import difflib
-import tempfile
 import argparse
-import subprocess
-from collections import Counter
+import gitctl
+import outbox
+import packs
+import hubclient
+import daemonclient
+import shards
+import dbindex
+import heatmap
+import instrument
+import pobject
+import routines
+import watcher
+import prefetch
+import checkpoint
+import validator
+import diffengine
+from constants import MAP_DIR, MAP_RESOLUTION
 
 
 DATABASE_FILENAME = 'user-eng-db.cfg'
@@ -34,40 +47,59 @@ def cli_args():
     parser.add_argument('--remote', type=str,
                         default=REMOTE_GIT_DB,
                         help='url to use as remote centralized database')
-    # see watchdog tierce-party module
-    # parser.add_argument('--watch', type=bool, action='store_true',
-                        # default=False,
-                        # help='Wait any modification of the database, push it immediately.')
+    # uses watchdog tierce-party module if available
+    parser.add_argument('--watch', action='store_true',
+                        default=False,
+                        help='Wait any modification of the database, push it immediately '
+                        '(until ctrl-c).')
+    parser.add_argument('--full-clone', action='store_true',
+                        default=False,
+                        help='Clone the whole history of the database, not only its last version')
     parser.add_argument('--show-discoveries', action='store_true',
                         default=False,
                         help='Show the lines added to the database')
+    parser.add_argument('--hub', type=str, default=None, metavar='URL',
+                        help='Send discoveries to the Pioneers hub at URL, which commits them, '
+                        'instead of pushing them to the remote')
+    parser.add_argument('--packs', type=str, default=None, metavar='SOURCE',
+                        help='Get the database as delta packs from SOURCE (directory or url) '
+                        'instead of git. Discoveries are then sent to the hub given by --hub.')
+    parser.add_argument('--profile', type=str, default=None, metavar='FILE',
+                        help='Write duration, memory and counts of each phase in FILE, '
+                        'as JSON lines, or as Chrome trace if FILE ends with .json')
+    subparsers = parser.add_subparsers(dest='command')
+    query = subparsers.add_parser('query', help='Search the local index of the database, '
+                                  'without publishing anything. Criterions are combined.')
+    query.add_argument('object', type=str, nargs='?', default=None,
+                       help='LocName or Name of the object, giving its first explorer')
+    query.add_argument('--pioneer', type=str, default=None,
+                       help='Objects discovered by given pioneer')
+    query.add_argument('--since', type=str, default=None,
+                       help='Objects discovered since given date, like 2017.10.17')
+    query.add_argument('--sector', type=str, default=None,
+                       help='Show the discoveries in given RS sector, like "RS 0-4-1388"')
+    query.add_argument('--nearest', type=str, default=None,
+                       help='Show the discovered object closest to given RS code')
+    query.add_argument('--limit', type=int, default=None,
+                       help='Maximal number of objects to show')
+    query.add_argument('--rebuild', action='store_true', default=False,
+                       help='Rebuild the index from scratch before searching')
+    exploration_map = subparsers.add_parser('map', help='Export the map of the explored '
+                                            'universe: images and JSON tiles')
+    exploration_map.add_argument('--output', type=str, default=MAP_DIR,
+                                 help='directory receiving the map')
+    exploration_map.add_argument('--resolution', type=int, default=MAP_RESOLUTION,
+                                 help='pixels on each side of the map of a galaxy')
+    importing = subparsers.add_parser('import', help='Publish the objects of existing database '
+                                      'files (like config/user-eng-db.cfg of explorers joining Pioneers) '
+                                      'not discovered yet, as a single commit')
+    importing.add_argument('files', type=str, nargs='+', metavar='FILE',
+                           help='database files to import')
+    importing.add_argument('--workers', type=int, default=None,
+                           help='processes parsing the files (default: one per core)')
     return parser.parse_args()
 
 
-def clone_repository(remote_url:str, target:str):
-    """Will clone the repository"""
-    # TODO: use a better tech for that. gitpython for instance.
-    subprocess.call(['git', 'clone', remote_url, target])
-
-def update_repository():
-    """Will update the repository"""
-    # TODO: use a better tech for that. gitpython for instance.
-    # TODO: handle conflicts
-    os.chdir(LOCAL_GIT_DIR)
-    subprocess.call(['git', 'pull'])
-    os.chdir('..')
-
-def commit_and_push(commit_message:str):
-    # TODO: use a better tech for that. gitpython for instance.
-    # TODO: handle conflicts
-    update_repository()
-    os.chdir(LOCAL_GIT_DIR)
-    subprocess.call(['git', 'add', DATABASE_FILENAME])
-    subprocess.call(['git', 'commit', '-m', commit_message])
-    subprocess.call(['git', 'push'])
-    os.chdir('..')
-
-
 def verify_working_directory():
     """Raise error if working directory do not seems to be the one expected"""
     files = frozenset(entry.name for entry in os.scandir('.'))
@@ -83,13 +115,16 @@ def verify_working_directory():
             )
 
 
-def initialize(remote_url:str=REMOTE_GIT_DB):
+@instrument.traced('initialize')
+def initialize(remote_url:str=REMOTE_GIT_DB, shallow:bool=True):
     """Initialize working directory as a git repository, and retrieve the
     data from the centralized repository.
 
     It will only consider the database file, making a backup
     if one already exists.
 
+    shallow -- only clone the last version of the database, not its history
+
     """
     verify_working_directory()
     if os.path.exists(LOCAL_GIT_DIR):
@@ -101,11 +136,13 @@ def initialize(remote_url:str=REMOTE_GIT_DB):
         shutil.move(DATABASE_FILE, DATABASE_FILE + '.bak')
         print("The database file already exists. Backup saved.")
     print("Clone Pioneers database… ", end='', flush=True)
-    clone_repository(remote_url, target=LOCAL_GIT_DIR)
+    gitctl.clone_repository(remote_url, target=LOCAL_GIT_DIR, shallow=shallow)
     print("Done !")
     assert os.path.exists(LOCAL_GIT_DIR), "The Pioneers directory {} is not in the working directory (did the cloning succeed ?)".format(LOCAL_GIT_DIR)
     print("Install Pioneers database… ", end='', flush=True)
-    shutil.copy(LOCAL_GIT_DB, DATABASE_FILE)  # TODO: maybe a symbolic link could be better ?
+    if shards.is_sharded():
+        shards.compile_database()
+    gitctl.install_database()  # TODO: maybe a symbolic link could be better ?
     print("Done !")
 
 
@@ -113,18 +150,25 @@ def user_discoveries() -> [str]:
     """Yield the lines corresponding to user discoveries. Will indicate warnings
     if anything as been deleted."""
     print("Discoveries will be discovered…")
-    comparer = difflib.Differ()
-    with open(LOCAL_GIT_DB) as fref, open(DATABASE_FILE) as fnew:
-        ref, new = tuple(fref), tuple(fnew)  # TODO: will not scale. Best algorithm: read line by line until one is different. Start diff then.
-        comparison = comparer.compare(ref, new)
-        # comparison = tuple(comparison) ; print(comparison)  # debug
-        states, lines = zip(*((line[0], line) for line in comparison))
-        counts = Counter(states)
-        if len(counts) == 1 and counts.get(' '):
+    # SpaceEngine only appends: the data after the installation checkpoint is enough
+    appended = checkpoint.appended_lines(DATABASE_FILE)
+    if appended is not None:
+        if not appended:
             print("No modification. Nothing to do.")
-            return
         else:
-            print("Modifications: " + ', '.join('{} {}'.format(v, DIFFLIB_TO_HUMAN[k]) for k, v in counts.items()))
+            print("Modifications: {} added".format(len(appended)))
+            yield from appended
+        return
+    print("Used database modified before its end. Full comparison needed.")
+    gitctl.detach_git_database()
+    # only the window between common prefix and suffix is really diffed
+    counts, lines = diffengine.compare_files(LOCAL_GIT_DB, DATABASE_FILE)
+    # print(counts, lines)  # debug
+    if not counts.keys() - {' '}:
+        print("No modification. Nothing to do.")
+        return
+    else:
+        print("Modifications: " + ', '.join('{} {}'.format(v, DIFFLIB_TO_HUMAN[k]) for k, v in counts.items()))
     if counts.get('-'):
         print("Lines have been deleted. That's unexpected ! No modification is considered valid.")
     elif counts.get('+'):
@@ -140,13 +184,18 @@ def user_have_discovered_something() -> bool:
 def verified_discoveries(added_text:str) -> bool:
     """Run sanity checks on new lines in database. Return Falsy value
     if unexpected data."""
-    # print('AYYELZ:', added_text)
-    # TODO: verify fields. With a grammar, it should be easy to verify that
-    #  new data is correctly formatted.
+    try:
+        validator.validate(added_text)
+    except validator.ValidationError as err:
+        print("Discoveries are not valid: {}. They will not be commited.".format(err))
+        return False
     return True
 
 
-def integrate_discoveries_to_pioneers(show_discoveries:bool=False) -> bool:
+@instrument.traced('integrate discoveries')
+def integrate_discoveries_to_pioneers(show_discoveries:bool=False,
+                                      hub:hubclient.HubClient=None,
+                                      packs_source:str=None, synchronized:bool=False) -> bool:
     """If user modified its database while gaming (by marking systems
     as discovered, for instance), this function will retrieve and commit
     the diff on the Pioneers database.
@@ -154,55 +203,182 @@ def integrate_discoveries_to_pioneers(show_discoveries:bool=False) -> bool:
     It will perform some sanity checks (no destruction of data, only a subset
     of the language is accepted).
 
-    Return True if any discoveries have been commited.
+    hub -- client of the hub receiving the discoveries, if any
+    packs_source -- where to get the database updates, instead of git
+    synchronized -- the database was just synchronized from packs_source
+
+    Return True if any discoveries have been commited (or accepted by the hub).
 
     """
-    update_repository()
-    discoveries = ''.join(user_discoveries())
+    if packs_source:
+        if not synchronized:
+            synchronize_packs(packs_source)
+    else:
+        try:
+            gitctl.update_repository()
+        except gitctl.GitError as err:
+            print("WARNING: repository not updated ({}).".format(err))
+        if shards.is_sharded():
+            shards.compile_database()
+        if hub:  # get the discoveries commited by the hub since last session
+            gitctl.refresh_used_database()
+    gitctl.update_filter()
+    with instrument.span('user discoveries') as span:
+        discoveries = ''.join(user_discoveries())
+        span.add(bytes=len(discoveries))
     if show_discoveries and discoveries:
         print()
         print(discoveries)
         print()
     if discoveries and verified_discoveries(discoveries):
-        print("Discoveries will be commited to remote repository…")
-        # SpaceEngine add the last modification in the end
-        # of the file, meaning that last modification is the one to keep.
-        # However, in Pioneers system, it is the opposite:
-        #  the first explorer is the preferred version.
-        # This is implemented by adding the discoveries on top of the database file,
-        #  instead of the end like SpaceEngine do.
-        with tempfile.NamedTemporaryFile('w', delete=False) as fd, open(LOCAL_GIT_DB) as fref:
-            fd.write(discoveries)
-            fd.write(fref.read())
-            # use the tempfile as local database
-            tempname = fd.name
-        shutil.move(tempname, LOCAL_GIT_DB)
-        shutil.copy(LOCAL_GIT_DB, DATABASE_FILE)
-        commit_and_push(commit_message_from_addendum(discoveries))
-        return True
-    return False
+        discoveries = routines.drop_known_discoveries(discoveries)
+        discoveries = routines.drop_pending_discoveries(discoveries)
+        if discoveries:
+            print("Discoveries will be commited to remote repository…")
+            # kept in the outbox until commited
+            outbox.Outbox().enqueue(discoveries)
+        if hub:  # they are in the outbox: the used database will be replaced by the database
+            checkpoint.record(DATABASE_FILE)  # once the hub has commited them
+    if hub:
+        return routines.submit_outbox(hub)
+    if packs_source:
+        print("WARNING: no hub given (--hub), discoveries can't be published. "
+              "They are kept locally, and will be sent next time.")
+        return False
+    # also send the discoveries left by previous sessions
+    return routines.publish_outbox()
+
+
+def synchronize_packs(source:str):
+    """Bring the database to the last version published in given pack source,
+    and install it"""
+    print("Update Pioneers database from packs… ", end='', flush=True)
+    try:
+        version, downloaded = packs.synchronize(source)
+    except (packs.PackError, OSError, ValueError) as err:
+        print("Failed !")
+        print("WARNING: database not updated ({}).".format(err))
+        return
+    print("Done ! Version {} ({} bytes downloaded).".format(version, downloaded))
 
 
 def commit_message_from_addendum(added_text:str) -> str:
     """Return a commit message describing the added text"""
-    # TODO: use a grammar to parse the added_text, and therefore
-    #  get a way better commit messaging.
     COMMIT_MESSAGE_TEMPLATE = """
 {pioneer} discovered {name} at {date}
 
 Location: {location}
     """.strip()
-    run_regex = lambda reg: reg.search(added_text).groups(0)[0]
-    return COMMIT_MESSAGE_TEMPLATE.format(
-        location=run_regex(REG_DATA_LOCATION),
-        name=run_regex(REG_DATA_NAME),
-        pioneer=run_regex(REG_DATA_PIONEER),
-        date=run_regex(REG_DATA_DATE),
+    try:
+        records = tuple(record for record in pobject.parse(added_text)
+                        if record.locname is not None)
+    except pobject.ParseError:  # not a valid block: just find the fields
+        records = ()
+    if not records:
+        run_regex = lambda reg: reg.search(added_text).groups(0)[0]
+        return COMMIT_MESSAGE_TEMPLATE.format(
+            location=run_regex(REG_DATA_LOCATION),
+            name=run_regex(REG_DATA_NAME),
+            pioneer=run_regex(REG_DATA_PIONEER),
+            date=run_regex(REG_DATA_DATE),
+        )
+    if len(records) == 1:
+        record = records[0]
+        return COMMIT_MESSAGE_TEMPLATE.format(location=record.locname,
+                                              name=record.name or record.locname,
+                                              pioneer=record.pioneer, date=record.date)
+    pioneers = sorted(set(record.pioneer for record in records if record.pioneer))
+    return '{} discovered {} objects\n\n{}'.format(
+        ', '.join(pioneers) or 'unknown pioneer', len(records),
+        '\n'.join('Location: {} ({}, {})'.format(record.locname, record.name, record.date)
+                  for record in records)
     )
 
 
+def query(args):
+    """Print the records of the git database matching given criterions"""
+    if not os.path.exists(LOCAL_GIT_DB):
+        print("Pioneers is not initialized: there is no database to search.")
+        return
+    if args.rebuild:
+        dbindex.rebuild()
+    else:
+        dbindex.update()
+    routines.print_query(args.object, args.pioneer, args.since, args.sector, args.nearest, args.limit)
+
+
+def delegate_to_daemon(args) -> bool:
+    """Send the command to the daemon of the install, if it runs.
+    Return False if it must be run here."""
+    if args.command == 'query' and not args.rebuild:
+        command = 'query'
+        params = {'object': args.object, 'pioneer': args.pioneer, 'since': args.since,
+                  'sector': args.sector, 'nearest': args.nearest, 'limit': args.limit}
+    elif args.command is None and not (args.watch or args.hub or args.packs):
+        command, params = 'publish', {}
+    else:
+        return False
+    if not daemonclient.running():
+        return False
+    try:
+        daemonclient.run(command, **{key: value for key, value in params.items() if value is not None})
+    except (daemonclient.DaemonError, OSError) as err:
+        print("ERROR: the Pioneers daemon failed ({}).".format(err))
+    return True
+
+
+def export_map(args):
+    """Build the map of the git database, and export it"""
+    if not os.path.exists(LOCAL_GIT_DB):
+        print("Pioneers is not initialized: there is no database to map.")
+        return
+    print("Map the explored universe… ", end='', flush=True)
+    exploration = heatmap.build(LOCAL_GIT_DB, resolution=args.resolution)
+    index = exploration.export(args.output)
+    print("Done !")
+    print("{} discoveries by {} pioneers in {} galaxies ({} not placed). Map index: {}"
+          "".format(exploration.total, len(exploration.pioneer_counts), len(exploration.galaxies),
+                    exploration.unplaced, index))
+
+
 if __name__ == "__main__":
     args = cli_args()
     # print(args)
-    initialize(remote_url=args.remote)
-    integrate_discoveries_to_pioneers(args.show_discoveries)
+    if args.profile:
+        instrument.enable(args.profile)
+    if delegate_to_daemon(args):
+        exit()
+    if args.command != 'map' and daemonclient.running():
+        print("ERROR: the Pioneers daemon is running, and modifies the database. "
+              "Stop it first (python daemonclient.py stop).")
+        exit(1)
+    gitctl.recover_interrupted_writes()
+    if args.command == 'query':
+        query(args)
+        exit()
+    if args.command == 'map':
+        export_map(args)
+        exit()
+    if args.command == 'import':
+        initialize(remote_url=args.remote, shallow=not args.full_clone)
+        routines.import_databases(args.files, args.workers)
+        exit()
+    if args.packs:
+        verify_working_directory()
+        synchronize_packs(args.packs)
+    else:
+        initialize(remote_url=args.remote, shallow=not args.full_clone)
+    hub = hubclient.HubClient(args.hub) if args.hub else None
+    if args.watch:
+        print("Watching the database. Run SpaceEngine, and hit ctrl-c when finished.")
+        publisher = watcher.Publisher(publish=lambda: routines.submit_outbox(hub)) if hub else None
+        prefetcher = prefetch.Prefetcher()
+        if not args.packs:  # else, the database is not pulled
+            prefetcher.start()
+        watcher.watch(publisher=publisher)
+        prefetcher.stop()
+    # after a watched session, packs published meanwhile are synchronized
+    integrate_discoveries_to_pioneers(args.show_discoveries, hub=hub, packs_source=args.packs,
+                                      synchronized=not args.watch)
+    if hub:
+        hub.close()
@@ -5,14 +5,65 @@ in a much more user-friendly manner.
 
 import os
 import shutil
+import argparse
+import threading
 import gitctl
+import daemonclient
 import routines
+import prefetch
 import constants
+import instrument
+import proctracker
 
 
 TERM_WIDTH = shutil.get_terminal_size().columns
 
 
+def print_progress(stage:str, percent:float or None, message:str):
+    """Show progress of a git operation on a single line"""
+    line = stage if percent is None else '{}: {:3.0f}%'.format(stage, percent)
+    print('\r' + line.ljust(TERM_WIDTH - 1)[:TERM_WIDTH - 1], end='', flush=True)
+
+
+def wait_end_of_session():
+    """Return when user hits enter, or when SpaceEngine stops"""
+    finished = threading.Event()
+    def on_start(pid):
+        print("SpaceEngine is running (pid {}). Pioneers will continue "
+              "when it stops.".format(pid))
+    def on_stop(pid):
+        print("SpaceEngine stopped.")
+        finished.set()
+    tracker = proctracker.tracker()
+    tracker.on_start, tracker.on_stop = on_start, on_stop
+    tracker.start()
+    def wait_input():
+        input('<enter>')  # TODO: put here a real terminal, with control commands
+        finished.set()
+    threading.Thread(target=wait_input, daemon=True).start()
+    finished.wait()
+    tracker.stop()
+
+
+def run_through_daemon():
+    """Same sequence, with commands sent to the daemon of the install"""
+    print("The Pioneers daemon is running: it will do the work.")
+    try:
+        print("Synchronize with remote repository…")
+        daemonclient.run('sync')
+        print()
+        print("You can now run SpaceEngine. Hit enter key when finished.")
+        wait_end_of_session()
+        print()
+        print("Merge with remote repository…")
+        daemonclient.run('publish')
+    except (daemonclient.DaemonError, OSError) as err:
+        print("ERROR: {}".format(err))
+        exit(1)
+    print("Finished.")
+    print("Thank you for using Pioneers !")
+
+
 def run_pioneer_high_level_interface():
     print('#' * TERM_WIDTH)
     print(('PIONEERS' + ' ' * (TERM_WIDTH//2)).center(TERM_WIDTH))
@@ -38,30 +89,51 @@ def run_pioneer_high_level_interface():
         exit(1)
 
 
+    if daemonclient.running():
+        run_through_daemon()
+        return
+    gitctl.recover_interrupted_writes()
     if not routines.initialization_done():
         print("Initialization not performed. Will do…")
-        routines.initialize()
+        routines.initialize(progress=print_progress)
+        print()
         print()
         print("Initialization performed.")
 
 
     print("Synchronize with remote repository…")
-    gitctl.synchronize()
+    try:
+        gitctl.synchronize()
+    except gitctl.GitError as err:
+        print("ERROR: {}".format(err))
+        exit(1)
     print("Synchronization performed.")
 
 
     print()
     print("You can now run SpaceEngine. Hit enter key when finished.")
-    input('<enter>')  # TODO: put here a real terminal, with control commands
+    prefetcher = prefetch.Prefetcher()  # the final synchronization will not wait for the network
+    prefetcher.start()
+    wait_end_of_session()
+    prefetcher.stop()
     print()
 
 
     print("Merge with remote repository…")
-    discoveries = routines.user_discoveries()
-    gitctl.synchronize()
-    if discoveries:
-        print("{} discoveries detected. They will be send.".format(len(discoveries)))
-        routines.integrate_discoveries_to_pioneers(discoveries)
+    discoveries = tuple(routines.user_discoveries())
+    try:
+        gitctl.synchronize()
+    except gitctl.GitError as err:  # discoveries will wait in the outbox
+        print("WARNING: {}".format(err))
+    try:
+        if discoveries:
+            print("{} discoveries detected. They will be send.".format(len(discoveries)))
+            routines.integrate_discoveries_to_pioneers(discoveries)
+        else:  # discoveries of previous sessions may wait in the outbox
+            routines.publish_outbox()
+    except gitctl.GitError as err:
+        print("ERROR: {}".format(err))
+        exit(1)
     print("Merge performed.")
 
     print("Finished.")
@@ -69,4 +141,10 @@ def run_pioneer_high_level_interface():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profile', type=str, default=None, metavar='FILE',
+                        help='Write duration, memory and counts of each phase in FILE')
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable(args.profile)
     run_pioneer_high_level_interface()
@@ -0,0 +1,186 @@
+"""Parsing of the SpaceEngine database format, as found in user-eng-db.cfg:
+
+    PObject
+    {
+            LocName "RS 0-4-1388-500-11085-8-6447711-79"
+            Name    "RS 0-4-1388-500-11085-8-6447711-79"
+            Pioneer "lucas"
+            Date    "2017.10.17 20:55:59.13"
+            Descr   "Testing the saving framework for Pioneers"
+    }
+
+The data is scanned once, block after block, and each block is yielded
+as a compact PObject keeping its byte offset and length in the source,
+allowing to index the database and to get back any record in O(1).
+
+"""
+
+import os
+import re
+import mmap
+
+
+ENCODING = 'utf-8'
+
+# one block: kind, then fields between braces (that may appear in quoted values).
+#  Comments are accepted before it.
+REG_BLOCK = re.compile(rb'\s*(?://[^\n]*\s*)*(\w+)\s*\{([^{}"]*(?:"[^"]*"[^{}"]*)*)\}')
+REG_FIELD = re.compile(rb'(\w+)\s+(?:"([^"]*)"|([^\s"{}]+))')
+REG_SEPARATOR = re.compile(rb'\s*(?://[^\n]*\s*)*')  # spaces and comments
+# the block as written by SpaceEngine, parsed without looping over the fields
+REG_STANDARD_BLOCK = re.compile(rb'\s*(?://[^\n]*\s*)*(PObject)\s*\{\s*' + rb'\s*'.join(
+    key + rb'\s+"([^"]*)"' for key in (b'LocName', b'Name', b'Pioneer', b'Date', b'Descr')
+) + rb'\s*\}')
+
+KNOWN_ATTRIBUTES = {  # field name -> PObject attribute
+    'LocName': 'locname',
+    'Name': 'name',
+    'Pioneer': 'pioneer',
+    'Date': 'date',
+    'Descr': 'descr',
+}
+
+
+class ParseError(ValueError):
+    """Raised when data do not follow the database format"""
+    def __init__(self, message:str, offset:int):
+        super().__init__('{} (at byte {})'.format(message, offset))
+        self.offset = offset
+
+
+class PObject:
+    """A block of the database. Known fields are attributes,
+    others are kept, in order, in extra as (key, value) pairs."""
+    __slots__ = ('kind', 'locname', 'name', 'pioneer', 'date', 'descr',
+                 'extra', 'offset', 'length')
+
+    def __init__(self, kind:str='PObject', locname:str=None, name:str=None,
+                 pioneer:str=None, date:str=None, descr:str=None,
+                 extra:tuple=(), offset:int=None, length:int=None):
+        self.kind = kind
+        self.locname = locname
+        self.name = name
+        self.pioneer = pioneer
+        self.date = date
+        self.descr = descr
+        self.extra = extra
+        self.offset = offset
+        self.length = length
+
+    @property
+    def fields(self) -> [(str, str)]:
+        """Return (key, value) pairs of the record, known fields first"""
+        known = ((key, getattr(self, attr)) for key, attr in KNOWN_ATTRIBUTES.items())
+        return tuple((key, value) for key, value in known if value is not None) + self.extra
+
+    def to_text(self) -> str:
+        """Return the record in the database format"""
+        return '{}\n{{\n{}}}\n'.format(self.kind, ''.join(
+            '\t{:<7} "{}"\n'.format(key, value) for key, value in self.fields
+        ))
+
+    def __eq__(self, other):
+        return (isinstance(other, PObject) and self.kind == other.kind
+                and self.fields == other.fields)
+
+    def __hash__(self):
+        return hash((self.kind, self.fields))
+
+    def __repr__(self):
+        return '<{} {!r} by {!r} at {!r}>'.format(self.kind, self.locname,
+                                                  self.pioneer, self.date)
+
+
+def record_key(record:PObject) -> str:
+    """Return the object described by given record"""
+    return record.locname or record.name
+
+
+def _decode(value:bytes) -> str:
+    return value.decode(ENCODING, errors='replace')
+
+
+def _make_record(kind:bytes, body:bytes, offset:int, length:int, body_offset:int) -> PObject:
+    record = PObject(_decode(kind), offset=offset, length=length)
+    extra = []
+    position, end = 0, len(body)
+    while True:
+        position = REG_SEPARATOR.match(body, position).end()
+        if position == end:
+            break
+        match = REG_FIELD.match(body, position)
+        if not match:
+            raise ParseError("expected a field", body_offset + position)
+        key, quoted, bare = match.groups()
+        key, value = _decode(key), _decode(quoted if quoted is not None else bare)
+        attr = KNOWN_ATTRIBUTES.get(key)
+        if attr and getattr(record, attr) is None:
+            setattr(record, attr, value)
+        else:
+            extra.append((key, value))
+        position = match.end()
+    record.extra = tuple(extra)
+    return record
+
+
+def parse(data:bytes or str, base_offset:int=0) -> [PObject]:
+    """Yield records found in given data (bytes, str or mmap).
+    Offsets are given in bytes, relative to base_offset.
+
+    Raise ParseError on unexpected data.
+
+    """
+    if isinstance(data, str):
+        data = data.encode(ENCODING)
+    position, end = 0, len(data)
+    standard = REG_STANDARD_BLOCK.match
+    while position < end:
+        match = standard(data, position)
+        if match:
+            start = match.start(1)
+            yield PObject('PObject', *map(_decode, match.groups()[1:]),
+                          offset=base_offset + start, length=match.end() - start)
+            position = match.end()
+            continue
+        match = REG_BLOCK.match(data, position)
+        if not match:
+            trailing = REG_SEPARATOR.match(data, position).end()
+            if trailing < end:
+                raise ParseError("expected a block", base_offset + trailing)
+            return
+        kind, body = match.groups()
+        start = match.start(1)
+        yield _make_record(kind, body, base_offset + start, match.end() - start,
+                           base_offset + match.start(2))
+        position = match.end()
+
+
+def parse_file(filename:str) -> [PObject]:
+    """Yield records found in given file, without loading it in memory"""
+    if not os.path.getsize(filename):
+        return
+    with open(filename, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield from parse(data)
+
+
+def build_index(records:[PObject]) -> {str: (int, int)}:
+    """Return the map LocName -> (offset, length) of given records.
+
+    When a LocName appears many times, the last record is kept,
+    since it is the one SpaceEngine uses (and, because discoveries are
+    added on top of the Pioneers database, the one of the first explorer).
+
+    """
+    return {record.locname: (record.offset, record.length)
+            for record in records if record.locname is not None}
+
+
+def read_record(filename:str, offset:int, length:int) -> PObject:
+    """Return the record found in given file at given position"""
+    with open(filename, 'rb') as fd:
+        fd.seek(offset)
+        data = fd.read(length)
+    records = tuple(parse(data, base_offset=offset))
+    if len(records) != 1:
+        raise ParseError("expected exactly one block, not {}".format(len(records)), offset)
+    return records[0]
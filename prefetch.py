@@ -0,0 +1,73 @@
+"""Fetch the remote database in background during a session.
+
+While SpaceEngine runs, the network is idle. The remote branch is then
+fetched from time to time, without touching the local database, so that
+the synchronization at the end of the session only merges what was
+fetched (see gitctl.update_repository), without waiting for the network.
+
+The interval between two fetches adapts to the activity of the remote:
+it is reset to PREFETCH_MIN_INTERVAL when the remote moved, and doubled,
+up to PREFETCH_MAX_INTERVAL, when it did not, or could not be reached.
+A random part (PREFETCH_JITTER) is added, so explorers do not all fetch
+at the same time.
+
+"""
+
+import random
+import threading
+import gitctl
+from constants import PREFETCH_MIN_INTERVAL, PREFETCH_MAX_INTERVAL, PREFETCH_JITTER
+
+
+class Prefetcher:
+    """Fetch the remote database in background, until stopped"""
+
+    def __init__(self, min_interval:float=PREFETCH_MIN_INTERVAL,
+                 max_interval:float=PREFETCH_MAX_INTERVAL, jitter:float=PREFETCH_JITTER,
+                 fetch:callable=gitctl.prefetch):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.fetch = fetch  # returns True if the remote moved
+        self.interval = min_interval
+        self.fetches = 0
+        self.failures = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+        # each thread has its own event: a thread stopped while fetching
+        #  ends after its fetch, even if another one is started meanwhile
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(self.stopped,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop fetching. A fetch in progress is not waited for: the
+        operations on the repository wait for it anyway, and its thread
+        ends right after."""
+        self.stopped.set()
+        self.thread = None
+
+    def fetch_once(self) -> bool or None:
+        """Fetch, and adapt the interval. Return whether the remote
+        moved, or None if the fetch failed."""
+        try:
+            moved = self.fetch()
+        except gitctl.GitError:  # offline: retried later, less often
+            self.failures += 1
+            moved = None
+        else:
+            self.fetches += 1
+        self.interval = self.min_interval if moved else min(2 * self.interval, self.max_interval)
+        return moved
+
+    def next_delay(self) -> float:
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _run(self, stopped:threading.Event):
+        # the session starts with a synchronization: first fetch is delayed
+        while not stopped.wait(self.next_delay()):
+            self.fetch_once()
@@ -0,0 +1,121 @@
+"""Tracking of the SpaceEngine process.
+
+The process table is scanned only to find SpaceEngine. Once found,
+its pid and creation time are kept, and its end is awaited without
+polling: with a pidfd on Linux, or else with psutil.
+
+A tracker can run in background, calling callbacks when SpaceEngine
+starts and stops.
+
+"""
+
+import os
+import select
+import threading
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+SPACEENGINE_PROCNAMES = frozenset({'SpaceEngine', 'SpaceEngine.exe'})
+SCAN_INTERVAL = 2.  # seconds between two scans, when SpaceEngine is not running
+
+
+class ProcessTracker:
+    """Find and follow the process having one of given names"""
+
+    def __init__(self, procnames:iter=SPACEENGINE_PROCNAMES,
+                 on_start:callable=None, on_stop:callable=None,
+                 scan_interval:float=SCAN_INTERVAL):
+        self.procnames = frozenset(procnames)
+        self.on_start = on_start  # called with the pid
+        self.on_stop = on_stop  # called with the pid
+        self.scan_interval = scan_interval
+        self.process = None  # psutil.Process found
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def available(self) -> bool:
+        return psutil is not None
+
+    def find(self) -> int or None or False:
+        """Return the pid of the process, or None if it is not running,
+        or False if detection is not available"""
+        if psutil is None:
+            return False
+        with self.lock:
+            if self.process is not None and self.process.is_running():
+                return self.process.pid  # is_running also compares creation time
+            self.process = None
+            for proc in psutil.process_iter(['name']):
+                if proc.info['name'] in self.procnames:
+                    self.process = proc
+                    return proc.pid
+        return None
+
+    def wait_exit(self, timeout:float=None) -> bool:
+        """Wait for the end of the found process. Return False
+        if it is still running after timeout seconds"""
+        proc = self.process
+        if proc is None:
+            return True
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(proc.pid)
+            except OSError:  # already finished
+                return True
+            try:
+                if not proc.is_running():  # pid may have been reused
+                    return True
+                readable, _, _ = select.select([pidfd], [], [], timeout)
+                return bool(readable)
+            finally:
+                os.close(pidfd)
+        _, alive = psutil.wait_procs([proc], timeout=timeout)
+        return not alive
+
+    def start(self):
+        """Follow the process in background, calling on_start and on_stop"""
+        if psutil is None or self.thread:
+            return
+        # each thread has its own event: a thread stopped while busy
+        #  ends on its own, even if another one is started meanwhile
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(self.stopped,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread = None
+
+    def _run(self, stopped:threading.Event):
+        while not stopped.is_set():
+            pid = self.find()
+            if not pid:
+                stopped.wait(self.scan_interval)
+                continue
+            if self.on_start and not stopped.is_set():
+                self.on_start(pid)
+            # wake up regularly only to honor stop()
+            while not self.wait_exit(timeout=self.scan_interval):
+                if stopped.is_set():
+                    return
+            with self.lock:
+                self.process = None
+            if self.on_stop and not stopped.is_set():
+                self.on_stop(pid)
+
+
+_TRACKERS = {}  # procnames -> ProcessTracker
+
+
+def tracker(procnames:iter=SPACEENGINE_PROCNAMES) -> ProcessTracker:
+    """Return the tracker shared by the whole run for given names"""
+    procnames = frozenset(procnames)
+    if procnames not in _TRACKERS:
+        _TRACKERS[procnames] = ProcessTracker(procnames)
+    return _TRACKERS[procnames]
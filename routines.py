@@ -4,30 +4,55 @@
 
 import os
 import shutil
+import threading
 import gitctl
-import difflib
-import tempfile
-from collections import Counter
-from constants import LOCAL_GIT_DIR, LOCAL_GIT_DB, REMOTE_GIT_DB, DATABASE_FILE
+import deploy
+import bloom
+import importer
+import outbox
+import hubclient
+import shards
+import rstrie
+import dbindex
+import pobject
+import parsecache
+import checkpoint
+import instrument
+import proctracker
+import validator
+import diffengine
+from constants import LOCAL_GIT_DIR, LOCAL_GIT_DB, REMOTE_GIT_DB, DATABASE_FILE, DIFFLIB_TO_HUMAN
+from constants import PUSH_ATTEMPTS, PUSH_BASE_DELAY, IMPORT_WORKERS, OUTBOX_TRAILER
+from proctracker import SPACEENGINE_PROCNAMES
+from constants import REG_DATA_LOCATION, REG_DATA_NAME, REG_DATA_PIONEER, REG_DATA_DATE
 
 
-def initialize(remote_url:str=REMOTE_GIT_DB):
+@instrument.traced('initialize')
+def initialize(remote_url:str=REMOTE_GIT_DB, shallow:bool=True,
+               progress:callable=None):
     """Initialize working directory as a git repository, and retrieve the
     data from the centralized repository.
 
     It will only consider the database file, making a backup
     if one already exists.
 
+    shallow -- only clone the last version of the database, not its history
+    progress -- callable receiving the cloning progress,
+                as (stage name, percent or None, message)
+
     """
     if os.path.exists(DATABASE_FILE):
         shutil.move(DATABASE_FILE, DATABASE_FILE + '.bak')
         print("The database file already exists. Backup saved.")
     print("Clone Pioneers database… ", end='', flush=True)
-    gitctl.clone_repository(remote_url, target=LOCAL_GIT_DIR)
+    gitctl.clone_repository(remote_url, target=LOCAL_GIT_DIR, shallow=shallow,
+                            progress=progress)
     print("Done !")
     assert os.path.exists(LOCAL_GIT_DIR), "The Pioneers directory {} is not in the working directory (did the cloning succeed ?)".format(LOCAL_GIT_DIR)
     print("Install Pioneers database… ", end='', flush=True)
-    shutil.copy(LOCAL_GIT_DB, DATABASE_FILE)  # TODO: maybe a symbolic link could be better ?
+    if shards.is_sharded():
+        shards.compile_database()
+    gitctl.install_database()  # TODO: maybe a symbolic link could be better ?
     print("Done !")
 
 
@@ -48,19 +73,33 @@ def initialization_done() -> bool:
 def user_discoveries() -> [str]:
     """Yield the lines corresponding to user discoveries. Will indicate warnings
     if anything as been deleted."""
+    with instrument.span('user discoveries') as span:
+        lines = tuple(_user_discoveries())  # the span must not stay open between yields
+        span.add(lines=len(lines), bytes=sum(map(len, lines)))
+    yield from lines
+
+
+def _user_discoveries() -> [str]:
     print("Discoveries will be discovered…")
-    comparer = difflib.Differ()
-    with open(LOCAL_GIT_DB) as fref, open(DATABASE_FILE) as fnew:
-        ref, new = tuple(fref), tuple(fnew)  # TODO: will not scale. Best algorithm: read line by line until one is different. Start diff then.
-        comparison = comparer.compare(ref, new)
-        # comparison = tuple(comparison) ; print(comparison)  # debug
-        states, lines = zip(*((line[0], line) for line in comparison))
-        counts = Counter(states)
-        if len(counts) == 1 and counts.get(' '):
+    # SpaceEngine only appends: the data after the installation checkpoint is enough
+    appended = checkpoint.appended_lines(DATABASE_FILE)
+    if appended is not None:
+        if not appended:
             print("No modification. Nothing to do.")
-            return
         else:
-            print("Modifications: " + ', '.join('{} {}'.format(v, DIFFLIB_TO_HUMAN[k]) for k, v in counts.items()))
+            print("Modifications: {} added".format(len(appended)))
+            yield from appended
+        return
+    print("Used database modified before its end. Full comparison needed.")
+    gitctl.detach_git_database()
+    # only the window between common prefix and suffix is really diffed
+    counts, lines = diffengine.compare_files(LOCAL_GIT_DB, DATABASE_FILE)
+    # print(counts, lines)  # debug
+    if not counts.keys() - {' '}:
+        print("No modification. Nothing to do.")
+        return
+    else:
+        print("Modifications: " + ', '.join('{} {}'.format(v, DIFFLIB_TO_HUMAN[k]) for k, v in counts.items()))
     if counts.get('-'):
         print("Lines have been deleted. That's unexpected ! No modification is considered valid.")
     elif counts.get('+'):
@@ -73,17 +112,68 @@ def user_have_discovered_something() -> bool:
     return any(user_discoveries())
 
 
+@instrument.traced('validate discoveries')
 def verified_discoveries(added_text:str) -> bool:
     """Run sanity checks on new lines in database. Return Falsy value
     if unexpected data."""
-    # print('AYYELZ:', added_text)
-    # TODO: verify fields. With a grammar, it should be easy to verify that
-    #  new data is correctly formatted.
+    try:
+        validator.validate(added_text)
+    except validator.ValidationError as err:
+        print("Discoveries are not valid: {}. They will not be commited.".format(err))
+        return False
     return True
 
 
+@instrument.traced('drop known discoveries')
+def drop_known_discoveries(discoveries:str) -> str:
+    """Return given discoveries without the objects already in the git
+    database, whoever explored them first: the record in the database
+    wins anyway, even over a later update of the same explorer.
+    They are found with the Bloom filter of the database, then checked
+    in the database."""
+    data = discoveries.encode(pobject.ENCODING)
+    records = tuple(pobject.parse(data))
+    known = bloom.already_discovered(records)
+    if not known:
+        return discoveries
+    kept = []
+    for record in records:
+        first = known.get(pobject.record_key(record))
+        if first is None:
+            kept.append(data[record.offset:record.offset+record.length].decode(pobject.ENCODING) + '\n')
+        elif first.pioneer is not None and first.pioneer == record.pioneer:
+            print("{} was already published by {} at {}. This update will not be published."
+                  "".format(pobject.record_key(record), first.pioneer, first.date))
+        else:
+            print("{} was already discovered by {} at {}. It will not be published."
+                  "".format(pobject.record_key(record), first.pioneer or 'someone', first.date))
+    instrument.current().add(dropped=len(records) - len(kept))
+    return ''.join(kept)
+
+
+def drop_pending_discoveries(discoveries:str, box:outbox.Outbox=None) -> str:
+    """Return given discoveries without the records already waiting
+    in the outbox, found again because they were not published yet"""
+    box = box or outbox.Outbox()
+    pending = set()
+    for _, text in box.pending():
+        data = text.encode(pobject.ENCODING)
+        pending.update(data[record.offset:record.offset+record.length] for record in pobject.parse(data))
+    if not pending:
+        return discoveries
+    data = discoveries.encode(pobject.ENCODING)
+    records = tuple(pobject.parse(data))
+    kept = [data[record.offset:record.offset+record.length].decode(pobject.ENCODING) + '\n'
+            for record in records if data[record.offset:record.offset+record.length] not in pending]
+    if len(kept) < len(records):
+        print("{} discoveries are already waiting to be published.".format(len(records) - len(kept)))
+    return ''.join(kept)
+
+
+@instrument.traced('integrate discoveries')
 def integrate_discoveries_to_pioneers(discoveries:[str],
-                                      show_discoveries:bool=False) -> bool:
+                                      show_discoveries:bool=False,
+                                      cancelled:threading.Event=None) -> bool:
     """If user modified its database while gaming (by marking systems
     as discovered, for instance), this function will retrieve and commit
     the diff on the Pioneers database.
@@ -91,6 +181,10 @@ def integrate_discoveries_to_pioneers(discoveries:[str],
     It will perform some sanity checks (no destruction of data, only a subset
     of the language is accepted).
 
+    Discoveries go through the outbox, so they are kept until
+    they are commited, and pushed with the ones of previous sessions.
+    Setting cancelled stops the push attempts (see publish_outbox).
+
     Return True if any discoveries have been commited.
 
     """
@@ -100,63 +194,262 @@ def integrate_discoveries_to_pioneers(discoveries:[str],
         print(discoveries)
         print()
     if discoveries and verified_discoveries(discoveries):
-        # SpaceEngine add the last modification in the end
-        # of the file, meaning that last modification is the one to keep.
-        # However, in Pioneers system, it is the opposite:
-        #  the first explorer is the preferred version.
-        # This is implemented by adding the discoveries on top of the database file,
-        #  instead of the end like SpaceEngine do.
-        with tempfile.NamedTemporaryFile('w', delete=False) as fd, open(LOCAL_GIT_DB) as fref:
-            fd.write(discoveries)
-            fd.write(fref.read())
-            # use the tempfile as local database
-            tempname = fd.name
-        shutil.move(tempname, LOCAL_GIT_DB)
-        shutil.copy(LOCAL_GIT_DB, DATABASE_FILE)
-        gitctl.commit_and_push(commit_message_from_addendum(discoveries))
-        return True
+        discoveries = drop_pending_discoveries(drop_known_discoveries(discoveries))
+        if discoveries:
+            outbox.Outbox().enqueue(discoveries)
+            return publish_outbox(cancelled=cancelled)
     return False
 
 
+@instrument.traced('publish outbox')
+def publish_outbox(max_attempts:int=PUSH_ATTEMPTS, base_delay:float=PUSH_BASE_DELAY,
+                   install:bool=True, cancelled:threading.Event=None) -> bool:
+    """Commit all discoveries waiting in the outbox as a single commit,
+    then push local commits, retrying with exponential backoff.
+
+    install -- copy the resulting git database to used database
+               (must be False while SpaceEngine is running)
+    cancelled -- event stopping the push attempts once set; local commits
+                 are then sent next time
+
+    Return True if any discoveries have been commited.
+
+    """
+    box = outbox.Outbox()
+    recover_outbox(box)
+    pending = box.pending()
+    instrument.current().add(entries=len(pending))
+    commited = False
+    if pending:
+        try:
+            gitctl.update_repository()
+        except gitctl.GitError as err:
+            print("WARNING: repository not updated ({}). Discoveries will be commited locally.".format(err))
+        discoveries = ''.join(text for _, text in pending)
+        batch = box.begin(uid for uid, _ in pending)
+        paths = write_discoveries(discoveries)
+        try:
+            commited = gitctl.commit(commit_message_from_addendum(discoveries)
+                                     + '\n\n' + OUTBOX_TRAILER.format(batch), paths)
+        except gitctl.GitError:  # still in the outbox: written again at next attempt
+            gitctl.discard_changes(paths)
+            raise
+        if install:
+            gitctl.install_database()
+        box.acknowledge(uid for uid, _ in pending)
+    if gitctl.has_unpushed_commits():
+        if gitctl.push_with_backoff(max_attempts, base_delay, cancelled):
+            if install:  # push may have merged remote discoveries
+                gitctl.refresh_used_database()
+        else:
+            print("WARNING: discoveries could not be pushed. "
+                  "They are kept locally, and will be sent next time.")
+    return commited
+
+
+def recover_outbox(box:outbox.Outbox):
+    """Acknowledge the discoveries committed by a run stopped before
+    acknowledging them, and discard those written but not committed"""
+    for batch, uids in box.batches().items():
+        if gitctl.has_commit_with(OUTBOX_TRAILER.format(batch)):
+            print("Discoveries commited by an interrupted run acknowledged.")
+            box.acknowledge(uids)
+        else:  # stopped before the commit: discoveries will be written again
+            gitctl.discard_database_changes()
+
+
+@instrument.traced('submit outbox')
+def submit_outbox(client:hubclient.HubClient) -> bool:
+    """Send the discoveries waiting in the outbox to a hub, that will commit
+    them with those of other explorers.
+
+    Discoveries refused by the hub are dropped. Those that could not
+    be sent are kept in the outbox, and will be sent next time.
+
+    Return True if any discoveries have been accepted.
+
+    """
+    box = outbox.Outbox()
+    pending = box.pending()
+    instrument.current().add(entries=len(pending))
+    accepted = 0
+    for uid, text in pending:
+        try:
+            answer = client.submit(text)
+        except hubclient.HubError as err:
+            if not err.rejected:
+                print("WARNING: discoveries not sent ({}). They will be sent next time.".format(err))
+                break
+            print("WARNING: discoveries refused by the hub ({}). They are dropped.".format(err))
+        except OSError as err:
+            print("WARNING: hub unreachable ({}). Discoveries will be sent next time.".format(err))
+            break
+        else:
+            accepted += answer.get('accepted', 0)
+            print("Hub accepted {} discoveries ({} already discovered).".format(
+                answer.get('accepted', 0), answer.get('duplicates', 0)))
+        box.acknowledge([uid])
+    return accepted > 0
+
+
+@instrument.traced('import databases')
+def import_databases(filenames:[str], workers:int=IMPORT_WORKERS,
+                     max_attempts:int=PUSH_ATTEMPTS, base_delay:float=PUSH_BASE_DELAY) -> int:
+    """Commit as a single commit the objects of given database files
+    not discovered yet, then push it.
+
+    Files are validated as a whole: nothing is imported if one is not valid.
+    Return the number of imported objects.
+
+    """
+    try:
+        gitctl.update_repository()
+    except gitctl.GitError as err:
+        print("WARNING: repository not updated ({}). Objects will be imported locally.".format(err))
+    if shards.is_sharded():
+        shards.compile_database()
+    gitctl.update_filter()
+    try:
+        discoveries, found, known = importer.new_discoveries(filenames, workers)
+    except validator.ValidationError as err:
+        print("ERROR: nothing imported, {}.".format(err))
+        return 0
+    imported = found - known
+    print("{} objects found, {} already discovered, {} to import.".format(found, known, imported))
+    if not imported:
+        return 0
+    pioneers = sorted({record.pioneer or 'unknown pioneer' for record in pobject.parse(discoveries)})
+    paths = write_discoveries(discoveries)
+    try:
+        gitctl.commit('Import of {} objects discovered by {}'.format(imported, ', '.join(pioneers)), paths)
+    except gitctl.GitError:
+        gitctl.discard_changes(paths)
+        raise
+    gitctl.refresh_used_database()  # keeps the discoveries not yet integrated
+    if gitctl.push_with_backoff(max_attempts, base_delay):
+        gitctl.refresh_used_database()
+    else:
+        print("WARNING: import could not be pushed. It is kept locally, and will be sent next time.")
+    return imported
+
+
+@instrument.traced('write discoveries')
+def write_discoveries(discoveries:str) -> [str]:
+    """Add given discoveries to the git database, return the modified files"""
+    # SpaceEngine add the last modification in the end
+    # of the file, meaning that last modification is the one to keep.
+    # However, in Pioneers system, it is the opposite:
+    #  the first explorer is the preferred version.
+    # This is implemented by adding the discoveries on top of the database file,
+    #  instead of the end like SpaceEngine do.
+    # In sharded layout, discoveries are appended to their shard,
+    #  and the compiled database gives them in reversed order.
+    instrument.current().add(bytes=len(discoveries))
+    gitctl.detach_git_database()
+    if shards.is_sharded():
+        paths = shards.add_records(pobject.parse(discoveries))
+        shards.compile_database()
+        return paths
+    # the database is replaced only once completely written
+    with deploy.replacing(LOCAL_GIT_DB) as fd, open(LOCAL_GIT_DB, 'rb') as fref:
+        fd.write(discoveries.encode(pobject.ENCODING))
+        shutil.copyfileobj(fref, fd)
+    return [LOCAL_GIT_DB]
+
+
+@instrument.traced('commit message')
 def commit_message_from_addendum(added_text:str) -> str:
     """Return a commit message describing the added text"""
-    # TODO: use a grammar to parse the added_text, and therefore
-    #  get a way better commit messaging.
     COMMIT_MESSAGE_TEMPLATE = """
 {pioneer} discovered {name} at {date}
 
 Location: {location}
     """.strip()
-    run_regex = lambda reg: reg.search(added_text).groups(0)[0]
-    return COMMIT_MESSAGE_TEMPLATE.format(
-        location=run_regex(REG_DATA_LOCATION),
-        name=run_regex(REG_DATA_NAME),
-        pioneer=run_regex(REG_DATA_PIONEER),
-        date=run_regex(REG_DATA_DATE),
+    try:
+        records = tuple(record for record in pobject.parse(added_text)
+                        if record.locname is not None)
+    except pobject.ParseError:  # not a valid block: just find the fields
+        records = ()
+    if not records:
+        run_regex = lambda reg: reg.search(added_text).groups(0)[0]
+        return COMMIT_MESSAGE_TEMPLATE.format(
+            location=run_regex(REG_DATA_LOCATION),
+            name=run_regex(REG_DATA_NAME),
+            pioneer=run_regex(REG_DATA_PIONEER),
+            date=run_regex(REG_DATA_DATE),
+        )
+    if len(records) == 1:
+        record = records[0]
+        return COMMIT_MESSAGE_TEMPLATE.format(location=record.locname,
+                                              name=record.name or record.locname,
+                                              pioneer=record.pioneer, date=record.date)
+    pioneers = sorted(set(record.pioneer for record in records if record.pioneer))
+    return '{} discovered {} objects\n\n{}'.format(
+        ', '.join(pioneers) or 'unknown pioneer', len(records),
+        '\n'.join('Location: {} ({}, {})'.format(record.locname, record.name, record.date)
+                  for record in records)
     )
 
 
-def detect_spaceengine_pid(procname:str or iter='SpaceEngine') -> int or None or False:
+def print_query(name:str=None, pioneer:str=None, since:str=None, sector:str=None,
+                nearest:str=None, limit:int=None, trie:callable=None):
+    """Print the records of the index matching given criterions,
+    or the discoveries around given RS codes.
+
+    trie -- function returning the RSTrie of the database, called only
+            for sector and nearest searches (default: from the parse cache)
+
+    """
+    if sector is not None or nearest is not None:
+        print_sectors(sector, nearest, limit, trie)
+        return
+    if name is not None and pioneer is None and since is None:
+        record = dbindex.discoverer(name)
+        records = [record] if record else []
+    else:
+        records = dbindex.search(name, pioneer, since, limit)
+    for record in records:
+        other_name = record['name'] if record['name'] != record['locname'] else None
+        print('{}  {:<16} {}'.format(record['date'], record['pioneer'] or '?', record['locname'])
+              + ('  ({})'.format(other_name) if other_name else ''))
+    if not records:
+        print("No matching object.")
+    elif pioneer is not None and name is None:
+        print("{} discoveries by {} in the database.".format(parsecache.pioneer_counts()[pioneer], pioneer))
+
+
+def print_sectors(sector:str=None, nearest:str=None, limit:int=None, trie:callable=None):
+    """Print the discoveries around given RS codes"""
+    for code in (sector, nearest):
+        if code is not None and rstrie.parse_code(code if code.startswith('RS') else 'RS ' + code) is None:
+            print("{!r} is not an RS code, like RS 0-4-1388.".format(code))
+            return
+    trie = trie() if trie else parsecache.rs_trie()
+    if nearest is not None:
+        found = trie.nearest(nearest)
+        print(found[0] if found else "No discovered object.")
+    if sector is not None:
+        print("{} discoveries in {}.".format(trie.count(sector), sector))
+        for level, nodes in enumerate(trie.density(sector), start=1):
+            print("  {} discovered sectors {} level(s) below".format(nodes, level))
+        for component, count in trie.children(sector)[:limit]:
+            print("  {}-{}: {}".format(sector, component, count))
+
+
+@instrument.traced('detect SpaceEngine')
+def detect_spaceengine_pid(procname:str or iter=SPACEENGINE_PROCNAMES) -> int or None or False:
     """Return the pid number of the SpaceEngine process, or None
     if no process is detected, or False if detection is not available.
 
     procname -- name or names to detect as SpaceEngine process
 
+    The process is searched only once, then its state is cached
+    by the process tracker.
+
     """
-    try:
-        import psutil
-    except ImportError:
+    procnames = {procname} if isinstance(procname, str) else frozenset(procname)
+    tracker = proctracker.tracker(procnames)
+    if not tracker.available:
         print("WARNING: psutil is not installed. SpaceEngine is assumed closed.")
         return False
-    procnames = {procname} if isinstance(procname, str) else frozenset(procname)
-    problem_encountered = True
-    while problem_encountered:
-        problem_encountered = False
-        try:
-            return next(p.pid for p in psutil.process_iter()
-                        if p.name() in procnames)
-        except psutil.NoSuchProcess:
-            problem_encountered = True  # retry
-        except StopIteration:  # no process
-            return None
-    return None
+    return tracker.find()
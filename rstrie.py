@@ -0,0 +1,295 @@
+"""Prefix tree of the RS codes of discovered objects.
+
+An RS code like `RS 0-4-1388-500-11085-8-6447711-79` is a path
+in the procedural hierarchy of the universe: each component is a node
+of a tree, the first ones being the largest sectors.
+
+The tree is stored level by level, in flat arrays: for each level,
+the component of each node, the index of its first child in the next
+level, and the range of its entries. Since the entries are sorted
+by code, the nodes of a subtree are contiguous at each level, as are
+its entries: counting or listing the discoveries of a sector only
+needs a descent of the tree, with a binary search at each level.
+A tree with integer payloads is stored as these arrays (see dumps).
+
+"""
+
+import re
+import bisect
+import struct
+from array import array
+
+
+REG_RS_CODE = re.compile(r'RS\s+(\d+(?:-\d+)*)')
+DUMP_MAGIC = b'PRST'
+DUMP_HEADER = struct.Struct('<4sQ')  # magic, levels
+DUMP_SECTION = struct.Struct('<Q')  # length
+
+
+def parse_code(locname:str) -> tuple or None:
+    """Return the components of given RS code, or None if it is not one"""
+    match = REG_RS_CODE.fullmatch(locname.strip())
+    if match:
+        return tuple(map(int, match.group(1).split('-')))
+    return None
+
+
+def _sort_key(code:tuple) -> bytes:
+    """Return bytes ordered as given code among other codes, but much
+    faster to compare than tuples"""
+    return struct.pack('>{}Q'.format(len(code)), *code)
+
+
+def _as_code(prefix:str or tuple) -> tuple:
+    if isinstance(prefix, str):
+        code = parse_code(prefix if prefix.startswith('RS') else 'RS ' + prefix)
+        if code is None:
+            raise ValueError("not an RS code: {!r}".format(prefix))
+        return code
+    return tuple(prefix)
+
+
+class RSTrie:
+    """Prefix tree over RS codes, each entry holding a payload.
+
+    Prefixes are given as tuple of components, or as string
+    like 'RS 0-4-1388' (or just '0-4-1388').
+
+    """
+
+    def __init__(self, entries:[(str, object)]=()):
+        self.components = []  # level -> component of each node
+        self.first_child = []  # level -> index of the first child of each node
+        self.first_entry = []  # level -> index of the first entry of each node
+        self.end_entry = []  # level -> index after the last entry of each node
+        self.locnames = []  # entries, sorted by code
+        self.payloads = []
+        self._build(entries)
+
+    def _build(self, entries:[(str, object)]):
+        coded, keys = [], []
+        for locname, payload in entries:
+            code = parse_code(locname)
+            if code:
+                coded.append((code, locname, payload))
+                keys.append(_sort_key(code))
+        # sort is stable: identical codes keep their order
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        del keys
+        codes = [coded[index][0] for index in order]
+        self.locnames = [coded[index][1] for index in order]
+        self.payloads = [coded[index][2] for index in order]
+        del coded, order
+        # length of the prefix shared by each code with the previous one
+        commons, previous = [], ()
+        for code in codes:
+            common = 0
+            for mine, theirs in zip(code, previous):
+                if mine != theirs:
+                    break
+                common += 1
+            commons.append(common)
+            previous = code
+        # a node of level L starts where the L+1 first components change,
+        #  and ends where they change again
+        for level in range(max(map(len, codes), default=0)):
+            bounds = [index for index, common in enumerate(commons) if common <= level]
+            bounds.append(len(codes))
+            nodes = [(start, end) for start, end in zip(bounds, bounds[1:])
+                     if len(codes[start]) > level]
+            self.components.append(array('q', (codes[start][level] for start, _ in nodes)))
+            self.first_entry.append(array('q', (start for start, _ in nodes)))
+            self.end_entry.append(array('q', (end for _, end in nodes)))
+        self.components.append(array('q'))  # children of the deepest nodes
+        for level, starts in enumerate(self.first_entry):
+            children = self.first_entry[level+1] if level + 1 < len(self.first_entry) else ()
+            self.first_child.append(array('q', (bisect.bisect_left(children, start)
+                                                for start in starts)))
+
+    def __len__(self):
+        return len(self.locnames)
+
+    def dumps(self) -> bytes:
+        """Return the tree as bytes, given back by RSTrie.loads.
+        Payloads must be integers."""
+        sections = [self.components[-1]]
+        for level in zip(self.components, self.first_child, self.first_entry, self.end_entry):
+            sections.extend(level)
+        sections = [array.tobytes() for array in sections]
+        sections.append(array('q', self.payloads).tobytes())
+        sections.append('\0'.join(self.locnames).encode())
+        return b''.join([DUMP_HEADER.pack(DUMP_MAGIC, len(self.first_child))]
+                        + [DUMP_SECTION.pack(len(section)) for section in sections] + sections)
+
+    @staticmethod
+    def loads(data:bytes) -> 'RSTrie':
+        """Return the tree stored in given bytes.
+        Raise ValueError if they are not a stored tree."""
+        magic, levels = DUMP_HEADER.unpack_from(data)
+        if magic != DUMP_MAGIC:
+            raise ValueError("not a stored RS trie")
+        nb_sections = 1 + 4 * levels + 2
+        offset = DUMP_HEADER.size + DUMP_SECTION.size * nb_sections
+        sections = []
+        for index in range(nb_sections):
+            length, = DUMP_SECTION.unpack_from(data, DUMP_HEADER.size + DUMP_SECTION.size * index)
+            sections.append(data[offset:offset+length])
+            offset += length
+        if offset != len(data):
+            raise ValueError("truncated RS trie")
+        trie = RSTrie()
+        *arrays, trie.payloads = [array('q', section) for section in sections[:-1]]
+        trie.components = arrays[1::4] + arrays[:1]
+        trie.first_child, trie.first_entry, trie.end_entry = arrays[2::4], arrays[3::4], arrays[4::4]
+        trie.locnames = sections[-1].decode().split('\0') if sections[-1] else []
+        return trie
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for level in self.components if level)
+
+    def _children(self, level:int, node:int or None) -> (int, int):
+        """Return the range of children of given node in the next level.
+        The root is the node None of level -1."""
+        if node is None:
+            return 0, len(self.components[0]) if self.components else 0
+        starts = self.first_child[level]
+        end = starts[node+1] if node + 1 < len(starts) else len(self.components[level+1])
+        return starts[node], end
+
+    def _entries(self, level:int, node:int or None) -> (int, int):
+        """Return the range of entries in the subtree of given node"""
+        if node is None:
+            return 0, len(self.locnames)
+        return self.first_entry[level][node], self.end_entry[level][node]
+
+    def _terminal(self, level:int, node:int) -> int:
+        """Return the number of entries ending at given node. They are
+        the first entries of the node, before those of its children."""
+        start, end = self._entries(level, node)
+        low, high = self._children(level, node)
+        return (self.first_entry[level+1][low] if low < high else end) - start
+
+    def _descend(self, code:tuple) -> (int, int or None, int):
+        """Return (level, node, position) of the deepest node matching
+        a prefix of given code, and the position, among the children
+        of this node, where the next component would be inserted"""
+        level, node = -1, None
+        for component in code:
+            if level + 1 >= len(self.components):
+                break
+            low, high = self._children(level, node)
+            position = bisect.bisect_left(self.components[level+1], component, low, high)
+            if position == high or self.components[level+1][position] != component:
+                return level, node, position
+            level, node = level + 1, position
+        return level, node, None
+
+    def _find(self, prefix:str or tuple) -> (int, int or None):
+        """Return level and node of given prefix, or None if not found"""
+        code = _as_code(prefix)
+        level, node, _ = self._descend(code)
+        if level != len(code) - 1:
+            return None
+        return level, node
+
+    def count(self, prefix:str or tuple=()) -> int:
+        """Return the number of entries in the subtree of given prefix"""
+        found = self._find(prefix)
+        if found is None:
+            return 0
+        start, end = self._entries(*found)
+        return end - start
+
+    def subtree(self, prefix:str or tuple=()) -> [(str, object)]:
+        """Return (locname, payload) of all entries in given sector"""
+        found = self._find(prefix)
+        if found is None:
+            return []
+        start, end = self._entries(*found)
+        return list(zip(self.locnames[start:end], self.payloads[start:end]))
+
+    def children(self, prefix:str or tuple=()) -> [(int, int)]:
+        """Return (component, number of entries) for each discovered
+        subsector of given sector"""
+        found = self._find(prefix)
+        if found is None:
+            return []
+        level, node = found
+        if level + 1 >= len(self.components):
+            return []
+        low, high = self._children(level, node)
+        return [(self.components[level+1][child], self._count_node(level + 1, child))
+                for child in range(low, high)]
+
+    def _count_node(self, level:int, node:int) -> int:
+        start, end = self._entries(level, node)
+        return end - start
+
+    def density(self, prefix:str or tuple=()) -> [int]:
+        """Return, for each level below given prefix, the number of
+        discovered nodes.
+
+        The nodes of the subtree are contiguous in each level,
+        so this only needs the bounds of the first and last node.
+
+        """
+        found = self._find(prefix)
+        if found is None:
+            return []
+        level, node = found
+        first, last = (node, node) if node is not None else (None, None)
+        densities = []
+        while level + 1 < len(self.components):
+            low, _ = self._children(level, first)
+            _, high = self._children(level, last)
+            if low >= high:
+                break
+            level, first, last = level + 1, low, high - 1
+            densities.append(high - low)
+        return densities
+
+    def nearest(self, locname:str or tuple) -> (str, object) or None:
+        """Return (locname, payload) of the entry closest to given code,
+        other than the code itself: the one sharing the longest prefix,
+        then having the closest component after this prefix.
+
+        Because entries are sorted by code, it is one of the two entries
+        around the place of the code.
+
+        """
+        code = _as_code(locname)
+        level, node, position = self._descend(code)
+        if position is None:  # the code, or one of its prefixes, is a node
+            start, end = self._entries(level, node)
+            if level == len(code) - 1:  # exactly the code: skip its entries
+                before, after = start - 1, start + self._terminal(level, node)
+            else:  # deeper than any entry: they all are prefixes of the code
+                before, after = end - 1, end
+        else:
+            low, high = self._children(level, node)
+            if position < high:
+                after = self._entries(level + 1, position)[0]
+            else:
+                after = self._entries(level, node)[1]
+            before = after - 1
+        candidates = [index for index in (before, after) if 0 <= index < len(self.locnames)]
+        if not candidates:
+            return None
+        def closeness(index):
+            other = parse_code(self.locnames[index])
+            common = 0
+            while common < min(len(code), len(other)) and code[common] == other[common]:
+                common += 1
+            if common < min(len(code), len(other)):
+                gap = abs(code[common] - other[common])
+            else:  # one contains the other: no component to compare
+                gap = float('inf')
+            return -common, gap
+        best = min(candidates, key=closeness)
+        return self.locnames[best], self.payloads[best]
+
+
+def from_records(records:[object]) -> RSTrie:
+    """Return the trie of given PObject, with themselves as payload"""
+    return RSTrie((record.locname, record) for record in records if record.locname)
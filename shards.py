@@ -0,0 +1,139 @@
+"""Sharded layout of the git database.
+
+Instead of one file where discoveries are added on top, the records
+are stored in many small files (the shards), chosen by LocName:
+RS codes are grouped by their first components, other names by hash.
+Adding a discovery only appends to one shard, keeping git deltas
+and conflicts local to that shard.
+
+The file used by SpaceEngine is compiled from the shards. Shards keep
+records in order of discovery (oldest first) ; the compiled file
+gives them in reversed order, so the record of the first explorer
+comes last, and is therefore the one SpaceEngine keeps.
+
+Usage, to convert a git database to the sharded layout:
+
+    python shards.py
+
+"""
+
+import os
+import re
+import zlib
+import deploy
+import pobject
+import validator
+from constants import LOCAL_GIT_DIR, LOCAL_GIT_DB, LOCAL_GIT_SHARDS, DATABASE_FILENAME
+
+
+SHARD_EXT = '.cfg'
+RS_SHARD_DEPTH = 3  # number of RS code components defining the shard
+NAMED_SHARDS = 64  # number of shards for objects not named by an RS code
+REG_RS_CODE = re.compile(r'RS\s+(\d+(?:-\d+)*)')
+
+
+def shard_name(locname:str) -> str:
+    """Return the name of the shard holding given LocName"""
+    match = REG_RS_CODE.fullmatch(locname.strip())
+    if match:
+        return 'RS-' + '-'.join(match.group(1).split('-')[:RS_SHARD_DEPTH])
+    return 'named-{:02x}'.format(zlib.crc32(locname.encode(pobject.ENCODING)) % NAMED_SHARDS)
+
+
+def is_sharded(shards_dir:str=LOCAL_GIT_SHARDS) -> bool:
+    return os.path.isdir(shards_dir)
+
+
+def shard_files(shards_dir:str=LOCAL_GIT_SHARDS) -> [str]:
+    """Return path to all shards, in compilation order"""
+    return sorted(entry.path for entry in os.scandir(shards_dir)
+                  if entry.name.endswith(SHARD_EXT))
+
+
+def add_records(records:[pobject.PObject], shards_dir:str=LOCAL_GIT_SHARDS) -> [str]:
+    """Append given records to their shard, return paths of modified shards"""
+    by_shard = {}
+    for record in records:
+        by_shard.setdefault(shard_name(record.locname or ''), []).append(record)
+    os.makedirs(shards_dir, exist_ok=True)
+    paths = []
+    for name, shard_records in sorted(by_shard.items()):
+        path = os.path.join(shards_dir, name + SHARD_EXT)
+        with open(path, 'a', encoding=pobject.ENCODING) as fd:
+            fd.write(''.join(record.to_text() for record in shard_records))
+        paths.append(path)
+    return paths
+
+
+def _raw_records(data:bytes) -> [bytes]:
+    """Return the raw bytes of each record of given shard data"""
+    return [data[record.offset:record.offset+record.length]
+            for record in pobject.parse(data)]
+
+
+def compile_database(target:str=LOCAL_GIT_DB, shards_dir:str=LOCAL_GIT_SHARDS,
+                     force:bool=False, validate:bool=True) -> bool:
+    """Write in target the database used by SpaceEngine, built from shards.
+    Return False if nothing had to be done, because target is more recent
+    than all the shards.
+
+    validate -- leave out (with a warning) the records that are not valid
+
+    Raise ParseError if a shard is not in the database format.
+
+    """
+    paths = shard_files(shards_dir)
+    if not force and os.path.exists(target):
+        target_mtime = os.path.getmtime(target)
+        if all(os.path.getmtime(path) <= target_mtime for path in paths):
+            return False
+    with deploy.replacing(target) as fd:
+        for path in paths:
+            with open(path, 'rb') as shard:
+                data = shard.read()
+            records = _raw_records(data)
+            if validate:
+                records = _valid_records(path, data, records)
+            for raw in reversed(records):
+                fd.write(raw + b'\n')
+    return True
+
+
+def _valid_records(path:str, data:bytes, records:[bytes]) -> [bytes]:
+    """Return the valid records of given shard, warning about the others.
+    Records are validated one by one only if the shard is not valid."""
+    try:
+        validator.validate(data, max_records=None, max_bytes=None)
+        return records
+    except validator.ValidationError:
+        pass
+    valid = []
+    for raw in records:
+        try:
+            validator.validate(raw, max_records=None, max_bytes=None)
+        except validator.ValidationError as err:
+            print("WARNING: record of {} in shard {} is not valid ({}). It is ignored."
+                  "".format(pobject.record_key(next(pobject.parse(raw))), path, err))
+            continue
+        valid.append(raw)
+    return valid
+
+
+def split_database(database:str=LOCAL_GIT_DB, shards_dir:str=LOCAL_GIT_SHARDS) -> [str]:
+    """Create the shards from given (not sharded) database.
+    Return paths of created shards."""
+    if is_sharded(shards_dir) and shard_files(shards_dir):
+        raise FileExistsError("Shards already exist in {}".format(shards_dir))
+    # database gives the most recent records first
+    records = tuple(pobject.parse_file(database))
+    return add_records(reversed(records), shards_dir)
+
+
+if __name__ == '__main__':
+    paths = split_database()
+    with open(os.path.join(LOCAL_GIT_DIR, '.gitignore'), 'a') as fd:
+        fd.write(DATABASE_FILENAME + '\n')  # compiled file is not versionned anymore
+    print("{} shards created in {}. Remove {} from the index and commit the shards with:"
+          "".format(len(paths), LOCAL_GIT_SHARDS, DATABASE_FILENAME))
+    print("    cd {} && git rm --cached {} && git add .gitignore shards && git commit"
+          "".format(LOCAL_GIT_DIR, DATABASE_FILENAME))
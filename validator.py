@@ -0,0 +1,107 @@
+"""Validation of data in the database format, before it is pushed
+to every explorer.
+
+The whole grammar of a record is a single compiled regex: known keys only,
+quoted values of bounded length, balanced braces, well-formed Date and
+RS code LocName. Records are matched one after the other, so the
+validation is linear in the size of the data, and stops at the first
+invalid record. Limits on the total size and the number of records
+are checked before and while matching.
+
+Only when data is invalid, a slower diagnosis explains why.
+
+"""
+
+import re
+import functools
+import pobject
+from constants import VALIDATION_MAX_RECORDS, VALIDATION_MAX_FIELD_LENGTH, VALIDATION_MAX_BYTES
+
+
+KNOWN_KEYS = ('LocName', 'Name', 'Pioneer', 'Date', 'Descr')
+REG_DATE = re.compile(r'\d{4}\.\d{2}\.\d{2} \d{2}:\d{2}:\d{2}(?:\.\d+)?')
+REG_RS_LOCNAME = re.compile(r'RS \d+(?:-\d+)*')
+
+
+class ValidationError(ValueError):
+    """Raised when data is not valid"""
+    def __init__(self, reason:str, offset:int):
+        super().__init__('{} (at byte {})'.format(reason, offset))
+        self.reason = reason
+        self.offset = offset
+
+    def __reduce__(self):  # sent back by the workers of an import
+        return ValidationError, (self.reason, self.offset)
+
+
+@functools.lru_cache(maxsize=8)
+def record_regex(max_field_length:int=VALIDATION_MAX_FIELD_LENGTH) -> re.Pattern:
+    """Return the compiled regex matching one valid record"""
+    value = '[^"]{{0,{}}}'.format(max_field_length)
+    fields = '|'.join((
+        r'Date\s+"{}"'.format(REG_DATE.pattern),
+        r'LocName\s+"(?:{}|(?!RS\s)[^"\n]{{1,{}}})"'.format(REG_RS_LOCNAME.pattern, max_field_length),
+        r'(?:{})\s+"{}"'.format('|'.join(key for key in KNOWN_KEYS
+                                          if key not in {'Date', 'LocName'}), value),
+    ))
+    return re.compile(r'\s*PObject\s*\{{\s*(?:(?:{})\s*)*\}}\s*'.format(fields).encode())
+
+
+def validate(data:bytes or str, max_records:int=VALIDATION_MAX_RECORDS,
+             max_field_length:int=VALIDATION_MAX_FIELD_LENGTH,
+             max_bytes:int=VALIDATION_MAX_BYTES) -> int:
+    """Return the number of records in given data, or raise ValidationError.
+
+    A None limit is not checked.
+
+    """
+    if isinstance(data, str):
+        data = data.encode(pobject.ENCODING)
+    if max_bytes is not None and len(data) > max_bytes:
+        raise ValidationError('data is larger than {} bytes'.format(max_bytes), max_bytes)
+    match = record_regex(max_field_length).match
+    position, end, count = 0, len(data), 0
+    while position < end:
+        found = match(data, position)
+        if not found:
+            if not data[position:].strip():
+                break
+            raise ValidationError(diagnose(data, position, max_field_length), position)
+        count += 1
+        if max_records is not None and count > max_records:
+            raise ValidationError('more than {} records'.format(max_records), position)
+        position = found.end()
+    return count
+
+
+def is_valid(data:bytes or str, **limits) -> bool:
+    try:
+        validate(data, **limits)
+    except ValidationError:
+        return False
+    return True
+
+
+def diagnose(data:bytes, position:int, max_field_length:int=VALIDATION_MAX_FIELD_LENGTH) -> str:
+    """Return the reason why record at given position is not valid"""
+    try:
+        record = next(pobject.parse(data[position:]), None)
+    except pobject.ParseError as err:
+        return 'malformed record: {}'.format(err)
+    if record is None:
+        return 'expected a record'
+    if record.kind != 'PObject':
+        return 'unexpected block {}'.format(record.kind)
+    for key, value in record.fields:
+        if key not in KNOWN_KEYS:
+            return 'unknown key {}'.format(key)
+        if max_field_length is not None and len(value) > max_field_length:
+            return 'value of {} longer than {} characters'.format(key, max_field_length)
+    if record.date is not None and not REG_DATE.fullmatch(record.date):
+        return 'malformed Date {!r}'.format(record.date)
+    locname = record.locname or ''
+    if locname.startswith('RS ') and not REG_RS_LOCNAME.fullmatch(locname):
+        return 'malformed RS code {!r}'.format(record.locname)
+    if not record.locname:
+        return 'empty LocName'
+    return 'invalid record'
@@ -0,0 +1,182 @@
+"""Watch the used database while SpaceEngine is running,
+and publish discoveries as soon as they are saved.
+
+The used database is watched with watchdog (inotify on Linux) if available,
+or else by polling its size and modification time. Since SpaceEngine may
+write it in many steps, the database is read only when no write occurred
+for some time. Only the records appended after the checkpoint are read,
+and the checkpoint is then moved after them, so the end of session
+only has to handle the discoveries not yet published.
+
+Discoveries go through the outbox, and are published in the background,
+at most once every WATCH_PUBLISH_INTERVAL seconds.
+
+"""
+
+import os
+import time
+import threading
+import checkpoint
+import outbox
+import routines
+from constants import DATABASE_FILE
+from constants import WATCH_DEBOUNCE_DELAY, WATCH_POLL_INTERVAL, WATCH_PUBLISH_INTERVAL
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+
+class FileWatcher:
+    """Call on_change when given file has been modified, and then left
+    untouched for debounce seconds"""
+
+    def __init__(self, filename:str, on_change:callable,
+                 debounce:float=WATCH_DEBOUNCE_DELAY,
+                 poll_interval:float=WATCH_POLL_INTERVAL):
+        self.filename = os.path.abspath(filename)
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.modified = threading.Event()
+        self.stopped = threading.Event()
+        self.observer = None
+        self.threads = []
+
+    def start(self):
+        if Observer:
+            self.observer = Observer()
+            self.observer.schedule(_Handler(self), os.path.dirname(self.filename))
+            self.observer.start()
+        else:
+            self.threads.append(threading.Thread(target=self._poll, daemon=True))
+        self.threads.append(threading.Thread(target=self._debounce, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.modified.set()  # wake up the debouncer
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+        for thread in self.threads:
+            thread.join()
+
+    def _stat(self) -> (int, int) or None:
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _poll(self):
+        last = self._stat()
+        while not self.stopped.wait(self.poll_interval):
+            current = self._stat()
+            if current != last:
+                last = current
+                self.modified.set()
+
+    def _debounce(self):
+        while not self.stopped.is_set():
+            self.modified.wait()
+            # wait until the file is left untouched
+            while self.modified.is_set() and not self.stopped.is_set():
+                self.modified.clear()
+                self.stopped.wait(self.debounce)
+            if not self.stopped.is_set():
+                self.on_change()
+
+
+if Observer:
+    class _Handler(FileSystemEventHandler):
+        """Notify the FileWatcher of events concerning its file"""
+
+        def __init__(self, watcher:FileWatcher):
+            self.watcher = watcher
+
+        def on_any_event(self, event):
+            paths = {getattr(event, 'src_path', None), getattr(event, 'dest_path', None)}
+            if self.watcher.filename in paths:
+                self.watcher.modified.set()
+
+
+class Publisher:
+    """Publish the outbox in background, at most once every interval seconds"""
+
+    def __init__(self, interval:float=WATCH_PUBLISH_INTERVAL, publish:callable=None):
+        self.interval = interval
+        # the used database must not be modified while SpaceEngine runs
+        self.publish = publish or (lambda: routines.publish_outbox(install=False))
+        self.pending = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop publishing. Discoveries not yet published stay in the outbox."""
+        self.stopped.set()
+        self.pending.set()
+        self.thread.join()
+
+    def submit(self, discoveries:str):
+        outbox.Outbox().enqueue(discoveries)
+        self.pending.set()
+
+    def _run(self):
+        last_publication = float('-inf')
+        while True:
+            self.pending.wait()
+            if self.stopped.is_set():
+                return
+            # rate limit: let other discoveries join the batch
+            if self.stopped.wait(last_publication + self.interval - time.monotonic()):
+                return
+            self.pending.clear()
+            last_publication = time.monotonic()
+            try:
+                self.publish()
+            except Exception as err:  # will be retried with next discoveries
+                print("WARNING: publication failed: {}".format(err))
+
+
+def watch(filename:str=DATABASE_FILE, stop:threading.Event=None,
+          publisher:Publisher=None):
+    """Publish discoveries saved in given used database, until stop is set
+    (or until KeyboardInterrupt if no stop event is given)"""
+    publisher = publisher or Publisher()
+    rejected = None  # invalid records, left after the checkpoint
+    def on_change():
+        nonlocal rejected
+        data = checkpoint.appended_records(filename)
+        if data is None:
+            print("WARNING: used database modified before its end. "
+                  "Discoveries will be detected at the end of the session.")
+        elif rejected and data.startswith(rejected):
+            return  # already reported, and kept for the end of the session
+        elif data.strip():
+            discoveries = data.decode()
+            if not routines.verified_discoveries(discoveries):
+                # the checkpoint stays before them: reported again at the end of the session
+                rejected = data
+                return
+            checkpoint.consume(filename, data)
+            discoveries = routines.drop_known_discoveries(discoveries)
+            if discoveries:
+                print("New discoveries detected. They will be published.")
+                publisher.submit(discoveries)
+    watcher = FileWatcher(filename, on_change)
+    publisher.start()
+    watcher.start()
+    try:
+        (stop or threading.Event()).wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+        publisher.stop()